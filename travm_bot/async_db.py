@@ -0,0 +1,177 @@
+"""Awaitable mirror of the `db` API.
+
+Every function runs the synchronous `db` function of the same name in a
+dedicated thread pool, so slow queries don't block the event loop.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+DB_WORKERS = int(os.getenv("DB_WORKERS", 8))
+
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+
+def _call(func, *args, **kwargs):
+    unit_of_work = db.current_unit_of_work.get()
+    if unit_of_work is not None:
+        with unit_of_work.lock:
+            if not unit_of_work.closed:
+                return _call_in_unit_of_work(func, *args, **kwargs)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # Don't keep identity maps of pool threads between calls
+        db.Session.remove()
+
+
+def _call_in_unit_of_work(func, *args, **kwargs):
+    # End the transaction, so the update doesn't hold a pooled connection
+    # while it waits for Telegram. Loaded objects stay in the session.
+    session = db.Session()
+    try:
+        result = func(*args, **kwargs)
+    except Exception:
+        session.rollback()
+        raise
+    session.commit()
+    return result
+
+
+async def run(func, *args, **kwargs):
+    """Run `func` in the db thread pool
+
+    Context variables of the caller are visible inside `func`.
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(
+        _executor, functools.partial(ctx.run, _call, func, *args, **kwargs)
+    )
+
+
+def _awaitable(name: str):
+    @functools.wraps(getattr(db, name))
+    async def wrapper(*args, **kwargs):
+        # Resolved on every call to pick up wrappers installed on `db`
+        return await run(getattr(db, name), *args, **kwargs)
+
+    return wrapper
+
+
+@contextlib.asynccontextmanager
+async def unit_of_work():
+    """Share one session between all queries made inside the block
+
+    The session is closed when the block exits. Queries made after that
+    by tasks started inside the block get a session per query again.
+    """
+    unit = db.UnitOfWork()
+    token = db.current_unit_of_work.set(unit)
+    try:
+        yield unit
+    finally:
+        await run(db.close_unit_of_work, unit)
+        db.current_unit_of_work.reset(token)
+
+
+async def shutdown(application=None) -> None:
+    """Wait for running queries and stop the thread pool"""
+    await asyncio.get_running_loop().run_in_executor(None, _executor.shutdown)
+
+
+# User
+create_or_update_user = _awaitable("create_or_update_user")
+load_user = _awaitable("load_user")
+update_user = _awaitable("update_user")
+get_all_users = _awaitable("get_all_users")
+get_broadcast_recipients = _awaitable("get_broadcast_recipients")
+get_broadcast_recipient_count = _awaitable("get_broadcast_recipient_count")
+get_all_users_wtih_block_status = _awaitable("get_all_users_wtih_block_status")
+set_users_blocked = _awaitable("set_users_blocked")
+get_user_count = _awaitable("get_user_count")
+get_blocked_user_count = _awaitable("get_blocked_user_count")
+
+
+async def get_user(user_id: int):
+    """Async version of `db.get_user`, cache hits don't leave the loop"""
+    user = db.user_cache.get(user_id)
+    if user is None:
+        user = await load_user(user_id)
+    return user
+
+
+async def _iter_chunks(get_chunk, after: int, chunk_size: int):
+    while True:
+        chunk = await get_chunk(after, chunk_size)
+        for row in chunk:
+            yield row
+        if len(chunk) < chunk_size:
+            return
+        after = chunk[-1].tg_id
+
+
+def iter_broadcast_recipients(after: int = 0, chunk_size: int = 1000):
+    """Lazily iterate over broadcast recipients
+
+    Recipients are fetched in chunks with keyset pagination on `tg_id`,
+    so memory usage doesn't depend on the number of users.
+
+    Args:
+        after (int, optional): Last processed `tg_id`. Defaults to 0.
+        chunk_size (int, optional): Defaults to 1000.
+
+    Returns:
+        AsyncIterator[Row]: Recipients with `tg_id`, `fullname` and
+            `username`
+    """
+    return _iter_chunks(get_broadcast_recipients, after, chunk_size)
+
+
+# Question
+save_question = _awaitable("save_question")
+index_pending_questions = _awaitable("index_pending_questions")
+get_question = _awaitable("get_question")
+get_question_with_owner = _awaitable("get_question_with_owner")
+get_question_count = _awaitable("get_question_count")
+get_question_attachments = _awaitable("get_question_attachments")
+set_attachment_messages = _awaitable("set_attachment_messages")
+get_pending_questions = _awaitable("get_pending_questions")
+get_last_question_id = _awaitable("get_last_question_id")
+delete_question = _awaitable("delete_question")
+pop_questions = _awaitable("pop_questions")
+pop_questions_between = _awaitable("pop_questions_between")
+
+# Persistence
+lock_persistent_data = _awaitable("lock_persistent_data")
+renew_persistent_data_lock = _awaitable("renew_persistent_data_lock")
+unlock_persistent_data = _awaitable("unlock_persistent_data")
+save_persistent_data = _awaitable("save_persistent_data")
+
+# Counters
+refresh_counters = _awaitable("refresh_counters")
+get_stats = _awaitable("get_stats")
+
+# Broadcast
+create_broadcast_job = _awaitable("create_broadcast_job")
+update_broadcast_job = _awaitable("update_broadcast_job")
+get_running_broadcast_jobs = _awaitable("get_running_broadcast_jobs")
+get_broadcast_unsent = _awaitable("get_broadcast_unsent")
+get_broadcast_unsent_count = _awaitable("get_broadcast_unsent_count")
+
+
+def iter_broadcast_unsent(job_id: int, chunk_size: int = 1000):
+    """Lazily iterate over unsent recipients of broadcast with `job_id`
+
+    Like `iter_broadcast_recipients`, rows deleted while iterating don't
+    shift the following chunks.
+    """
+    return _iter_chunks(
+        functools.partial(get_broadcast_unsent, job_id), 0, chunk_size
+    )
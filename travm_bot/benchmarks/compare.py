@@ -0,0 +1,102 @@
+"""Compare db backends under the same load
+
+Run from the `travm_bot` directory. Every `--db-url` gets a fresh run of
+`benchmarks.run` with the same options, which are passed after `--`:
+
+    docker run --rm -d --name bench-mysql -p 3306:3306 \\
+        -e MYSQL_ALLOW_EMPTY_PASSWORD=1 -e MYSQL_DATABASE=bench mysql:8
+    python -m benchmarks.compare \\
+        --db-url sqlite:////tmp/bench.db \\
+        --db-url mysql+pymysql://root@127.0.0.1/bench \\
+        -- --users 5000 --questions 1000 --latency 0
+
+A Bot API latency of 0 leaves the db as the main cost. Tables of every
+db are dropped and recreated, never point it at a db with real data. Env
+variables of the bot, e.g. `SQLITE_READERS`, apply to all runs.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the load benchmark against several dbs"
+    )
+    parser.add_argument(
+        "--db-url",
+        action="append",
+        required=True,
+        help="SQLAlchemy URL of a benchmark db, may be repeated",
+    )
+    parser.add_argument(
+        "run_args",
+        nargs=argparse.REMAINDER,
+        help="options of benchmarks.run, after --",
+    )
+    args = parser.parse_args(argv)
+    if args.run_args[:1] == ["--"]:
+        args.run_args = args.run_args[1:]
+    return args
+
+
+def run(db_url: str, run_args: list[str], output: str) -> list[dict]:
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.run",
+            *run_args,
+            "--db-url",
+            db_url,
+            "--json",
+            output,
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    with open(output) as f:
+        return json.load(f)
+
+
+def print_report(results: dict[str, list[dict]]) -> None:
+    header = (
+        f"{'path':<22}{'db':<12}{'errors':>8}{'rps':>10}"
+        f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    )
+    print(header)
+    print("-" * len(header))
+    paths = {}
+    for label, rows in results.items():
+        for row in rows:
+            paths.setdefault(row["path"], []).append((label, row))
+    for path, rows in paths.items():
+        for label, row in rows:
+            print(
+                f"{path:<22}{label:<12}{row['errors']:>8}"
+                f"{row['throughput']:>10.1f}{row['p50']:>10.1f}"
+                f"{row['p95']:>10.1f}{row['p99']:>10.1f}"
+            )
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for number, db_url in enumerate(args.db_url):
+            label = db_url.split(":", 1)[0].split("+", 1)[0]
+            if label in results:
+                label = f"{label}#{number + 1}"
+            print(f"Benchmarking {label}...", file=sys.stderr)
+            results[label] = run(
+                db_url, args.run_args, os.path.join(tmp, f"{number}.json")
+            )
+    print_report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""Local stand-in for the Telegram Bot API
+
+Answers the methods used by the bot with minimal valid results after a
+configurable delay. A share of requests that send messages can fail with
+429 (flood limit) or 403 (bot blocked by the user) to exercise the error
+handling of the bot under load.
+"""
+
+import collections
+import itertools
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+SEND_METHODS = {
+    "sendMessage",
+    "sendPhoto",
+    "sendVideo",
+    "sendMediaGroup",
+    "copyMessage",
+}
+
+
+class FakeBotAPI:
+    """Bot API server running in a background thread
+
+    Args:
+        latency (float): Delay of every response in seconds
+        jitter (float): Random extra delay up to `jitter` seconds
+        error_429 (float): Share of send requests failed with 429
+        error_403 (float): Share of chats that blocked the bot, sends to
+            them always fail with 403
+        retry_after (int): `retry_after` of 429 responses
+        seed (int): Seed of injected errors and jitter
+        never_blocked (Iterable[int]): Chats that never block the bot,
+            e.g. of admins and moderators
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_429: float = 0.0,
+        error_403: float = 0.0,
+        retry_after: int = 1,
+        seed: int = 0,
+        never_blocked=(),
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_429 = error_429
+        self.error_403 = error_403
+        self.retry_after = retry_after
+        self.never_blocked = frozenset(never_blocked)
+        # method -> number of requests, errors are counted as `method:code`
+        self.requests = collections.Counter()
+        self._random = random.Random(seed)
+        self._seed = seed
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        """Value for `ApplicationBuilder.base_url`"""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def is_blocked(self, chat_id) -> bool:
+        """Whether the chat blocked the bot, stable between requests"""
+        if chat_id in self.never_blocked:
+            return False
+        key = f"{self._seed}:{chat_id}".encode()
+        return zlib.crc32(key) % 10000 < self.error_403 * 10000
+
+    def handle(self, method: str, params: dict) -> tuple[int, dict]:
+        """Get status code and body of the response to `method`"""
+        with self._lock:
+            delay = self.latency + self._random.random() * self.jitter
+            flood = self._random.random() < self.error_429
+        if delay:
+            time.sleep(delay)
+
+        chat_id = _parse_id(params.get("chat_id"))
+        if method in SEND_METHODS:
+            if flood:
+                return self._error(
+                    method,
+                    429,
+                    f"Too Many Requests: retry after {self.retry_after}",
+                    {"retry_after": self.retry_after},
+                )
+            if self.is_blocked(chat_id):
+                return self._error(
+                    method, 403, "Forbidden: bot was blocked by the user"
+                )
+
+        self.requests[method] += 1
+        if method == "getMe":
+            result = {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "Benchmark",
+                "username": "benchmark_bot",
+            }
+        elif method == "getFile":
+            file_id = params.get("file_id", "")
+            result = {
+                "file_id": file_id,
+                "file_unique_id": f"u{file_id}",
+                "file_size": 1024,
+                "file_path": f"files/{file_id}.jpg",
+            }
+        elif method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            result = [self._message(chat_id) for _ in media]
+        elif method == "copyMessage":
+            result = {"message_id": next(self._message_ids)}
+        elif method in SEND_METHODS or method == "editMessageText":
+            result = self._message(chat_id)
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}
+
+    def _message(self, chat_id) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+        }
+
+    def _error(
+        self, method: str, code: int, description: str, parameters=None
+    ) -> tuple[int, dict]:
+        self.requests[f"{method}:{code}"] += 1
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return code, body
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so the connection pool of the bot is reused
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode()
+                params = dict(parse_qsl(body))
+                method = self.path.rsplit("/", 1)[-1]
+                status, response = api.handle(method, params)
+                data = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def _parse_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
@@ -0,0 +1,160 @@
+"""Load test of the bot against a fake Bot API server
+
+Run from the `travm_bot` directory:
+
+    python -m benchmarks.run --users 1000 --questions 500 --latency 0.05
+
+The question, moderation callback and broadcast paths are benchmarked
+through the real handlers and db layer. A fresh SQLite db in a temporary
+directory is used unless `--db-url` is given. Tables of that db are
+dropped and recreated, never point it at a db with real data.
+
+For every path the number of updates, handler errors, throughput and
+p50/p95/p99 latency are reported. Latency is measured per update, for the
+broadcast per sent message.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+
+from benchmarks.fake_bot_api import FakeBotAPI
+
+PATHS = ("question", "callback", "broadcast")
+ADMIN_ID = 1
+REPLY_USER_ID = 2
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the bot against a fake Bot API server"
+    )
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--questions", type=int, default=500)
+    parser.add_argument(
+        "--photo-share",
+        type=float,
+        default=0.2,
+        help="share of questions sent as photos",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=32,
+        help="updates processed at the same time",
+    )
+    parser.add_argument(
+        "--paths", nargs="+", choices=PATHS, default=list(PATHS)
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="Bot API response time in seconds",
+    )
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument(
+        "--error-429",
+        type=float,
+        default=0.0,
+        help="share of send requests answered with 429",
+    )
+    parser.add_argument(
+        "--error-403",
+        type=float,
+        default=0.0,
+        help="share of users who blocked the bot",
+    )
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument(
+        "--broadcast-rate",
+        type=float,
+        default=None,
+        help="messages per second, REQUEST_RATE_BULK by default",
+    )
+    parser.add_argument(
+        "--broadcast-text",
+        default="Hello, {name}!",
+        help="broadcast post, without placeholders it is sent as copies",
+    )
+    parser.add_argument(
+        "--db-url",
+        default=None,
+        help="benchmark db, its tables are dropped and recreated",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--json", default=None, help="also write results to this file"
+    )
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args(argv)
+
+
+def configure(args) -> None:
+    """Set env variables read by the bot modules on import"""
+    os.environ["DB_URL"] = args.db_url
+    os.environ["ADMIN_IDS"] = str(ADMIN_ID)
+    os.environ["REPLY_USER_ID"] = str(REPLY_USER_ID)
+    os.environ["DEVELOPER_CHAT_ID"] = str(ADMIN_ID)
+    os.environ["METRICS_PORT"] = ""
+    # Measure the intake itself, not flood protection
+    os.environ["QUESTION_USER_LIMIT"] = "0"
+    os.environ["QUESTION_GLOBAL_LIMIT"] = "0"
+    if args.broadcast_rate:
+        os.environ["REQUEST_RATE_BULK"] = str(args.broadcast_rate)
+
+
+def print_report(results) -> None:
+    header = (
+        f"{'path':<22}{'count':>8}{'errors':>8}{'rps':>10}"
+        f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        row = result.to_dict()
+        print(
+            f"{row['path']:<22}{row['count']:>8}{row['errors']:>8}"
+            f"{row['throughput']:>10.1f}{row['p50']:>10.1f}"
+            f"{row['p95']:>10.1f}{row['p99']:>10.1f}"
+        )
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    api = FakeBotAPI(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_429=args.error_429,
+        error_403=args.error_403,
+        retry_after=args.retry_after,
+        seed=args.seed,
+        # 403 is injected for users, the bot can't work without admins
+        never_blocked=(ADMIN_ID, REPLY_USER_ID),
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        if not args.db_url:
+            args.db_url = f"sqlite:///{tmp}/benchmark.db"
+        configure(args)
+        # Bot modules read their settings on import
+        from benchmarks import scenarios
+
+        logging.getLogger().setLevel(args.log_level)
+        api.start()
+        try:
+            results = asyncio.run(scenarios.run(args, api))
+        finally:
+            api.stop()
+
+    print_report(results)
+    print(f"\nBot API requests: {dict(sorted(api.requests.items()))}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([result.to_dict() for result in results], f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
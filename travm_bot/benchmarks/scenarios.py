@@ -0,0 +1,284 @@
+"""Benchmarked paths of the bot
+
+Settings of the bot modules are read from env variables at import time,
+so this module must be imported after `benchmarks.run.configure`.
+"""
+
+import asyncio
+import datetime
+import json
+import os
+import statistics
+import time
+
+from sqlalchemy import insert, select
+from telegram import Update
+from telegram.ext import Application
+
+import async_db as adb
+import broadcast
+import custom_logging as cl
+import db
+import main
+from models import Base, Question, User
+
+ADMIN_ID = int(os.getenv("ADMIN_IDS"))
+REPLY_USER_ID = int(os.getenv("REPLY_USER_ID"))
+FIRST_USER_ID = 100000
+
+logger = cl.logger
+
+
+class Result:
+    """Latencies of one benchmarked path"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.latencies = []
+        self.errors = 0
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self) -> float:
+        return len(self.latencies) / self.elapsed if self.elapsed else 0.0
+
+    def percentiles(self) -> dict:
+        """Get p50, p95 and p99 latency in milliseconds"""
+        if len(self.latencies) < 2:
+            values = self.latencies * 100 or [0.0] * 100
+        else:
+            values = statistics.quantiles(
+                self.latencies, n=100, method="inclusive"
+            )
+        return {
+            "p50": values[49] * 1000,
+            "p95": values[94] * 1000,
+            "p99": values[98] * 1000,
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            "path": self.path,
+            "count": len(self.latencies),
+            "errors": self.errors,
+            "elapsed": self.elapsed,
+            "throughput": self.throughput,
+            **self.percentiles(),
+        }
+
+
+def seed_users(count: int) -> None:
+    """Recreate all tables and insert the admin and `count` users"""
+    engine = db.init()
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    now = datetime.datetime.now()
+    rows = [
+        {
+            "tg_id": tg_id,
+            "fullname": f"User {tg_id}",
+            "username": f"user{tg_id}",
+            "first_start": now,
+            "is_admin": tg_id == ADMIN_ID,
+            "is_blocked": False,
+            "last_seen": now,
+        }
+        for tg_id in [ADMIN_ID]
+        + list(range(FIRST_USER_ID, FIRST_USER_ID + count))
+    ]
+    session = db.Session()
+    for start in range(0, len(rows), 1000):
+        session.execute(insert(User), rows[start : start + 1000])
+    session.commit()
+    db.Session.remove()
+
+
+def get_question_ids() -> list[int]:
+    session = db.Session()
+    ids = session.scalars(
+        select(Question.question_id).order_by(Question.question_id)
+    ).all()
+    db.Session.remove()
+    return ids
+
+
+class Runner:
+    """Feeds synthetic updates to the application and times them"""
+
+    def __init__(self, application: Application, concurrency: int) -> None:
+        self.application = application
+        self.concurrency = concurrency
+        self._update_ids = iter(range(1, 10**9))
+        self._current = None
+
+    async def count_error(self, update, context) -> None:
+        if self._current is not None:
+            self._current.errors += 1
+
+    async def feed(self, path: str, updates: list[dict]) -> Result:
+        """Process `updates` with at most `concurrency` at a time"""
+        result = Result(path)
+        self._current = result
+        semaphore = asyncio.Semaphore(self.concurrency)
+        bot = self.application.bot
+
+        async def process(data: dict) -> None:
+            async with semaphore:
+                update = Update.de_json(data, bot)
+                started = time.perf_counter()
+                await self.application.process_update(update)
+                result.latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(process(data) for data in updates))
+        result.elapsed = time.perf_counter() - started
+        self._current = None
+        return result
+
+    def message(self, user_id: int, **fields) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._update_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": _user(user_id),
+                **fields,
+            },
+        }
+
+    def callback(self, question_id: int, action: str) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(question_id),
+                "from": _user(ADMIN_ID),
+                "chat_instance": "benchmark",
+                "data": json.dumps(
+                    {"question": question_id, "action": action}
+                ),
+                "message": {
+                    "message_id": question_id,
+                    "date": int(time.time()),
+                    "chat": {"id": REPLY_USER_ID, "type": "private"},
+                },
+            },
+        }
+
+
+def _user(user_id: int) -> dict:
+    return {
+        "id": user_id,
+        "is_bot": False,
+        "first_name": f"User {user_id}",
+        "username": f"user{user_id}",
+    }
+
+
+async def bench_questions(runner: Runner, args) -> list[Result]:
+    users = [FIRST_USER_ID + i % args.users for i in range(args.questions)]
+    photos = int(args.questions * args.photo_share)
+    text_updates = [
+        runner.message(user_id, text=f"Question {i}")
+        for i, user_id in enumerate(users[photos:])
+    ]
+    photo_updates = [
+        runner.message(
+            user_id,
+            caption=f"Question {i}",
+            photo=[
+                {
+                    "file_id": f"photo{i}",
+                    "file_unique_id": f"uphoto{i}",
+                    "width": 1280,
+                    "height": 720,
+                }
+            ],
+        )
+        for i, user_id in enumerate(users[:photos])
+    ]
+    results = [await runner.feed("question_text", text_updates)]
+    if photo_updates:
+        results.append(await runner.feed("question_photo", photo_updates))
+    return results
+
+
+async def bench_callbacks(runner: Runner, args) -> list[Result]:
+    question_ids = await adb.run(get_question_ids)
+    updates = [
+        runner.callback(question_id, ("accept", "decline")[i % 2])
+        for i, question_id in enumerate(question_ids)
+    ]
+    return [await runner.feed("moderation_callback", updates)]
+
+
+async def bench_broadcast(application: Application, args) -> list[Result]:
+    result = Result("broadcast_send")
+    senders = {
+        "send_post": broadcast.send_post,
+        "copy_post": broadcast.copy_post,
+    }
+
+    def timed(send):
+        async def wrapper(*send_args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await send(*send_args, **kwargs)
+            finally:
+                result.latencies.append(time.perf_counter() - started)
+
+        return wrapper
+
+    post = {"text": args.broadcast_text, "type": "text", "attachment": None}
+    job = await adb.create_broadcast_job(ADMIN_ID, 1, post)
+    task = broadcast.Broadcast(application.bot, job)
+    for name, send in senders.items():
+        setattr(broadcast, name, timed(send))
+    try:
+        started = time.perf_counter()
+        try:
+            await task.run()
+        except Exception:
+            logger.exception("Broadcast crashed")
+            result.errors += 1
+        result.elapsed = time.perf_counter() - started
+    finally:
+        for name, send in senders.items():
+            setattr(broadcast, name, send)
+    result.errors = task.blocked + task.failed
+    return [result]
+
+
+async def run(args, api) -> list[Result]:
+    """Run benchmarks of all paths selected in `args`"""
+    await adb.run(seed_users, args.users)
+    application = main.build_application(
+        Application.builder().token("1:benchmark").base_url(api.base_url)
+    )
+    runner = Runner(application, args.concurrency)
+    application.add_error_handler(runner.count_error)
+
+    benches = (
+        ("question", bench_questions, runner),
+        ("callback", bench_callbacks, runner),
+        ("broadcast", bench_broadcast, application),
+    )
+    results = []
+    await application.initialize()
+    await application.post_init(application)
+    try:
+        for path, bench, target in benches:
+            if path not in args.paths:
+                continue
+            try:
+                results += await bench(target, args)
+            except Exception:
+                # Report the other paths anyway
+                logger.exception(f"Benchmark of {path} path crashed")
+                crashed = Result(path)
+                crashed.errors = 1
+                results.append(crashed)
+    finally:
+        await application.shutdown()
+        await application.post_shutdown(application)
+    return results
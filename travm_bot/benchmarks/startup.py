@@ -0,0 +1,158 @@
+"""Cold start benchmark of the bot
+
+Run from the `travm_bot` directory:
+
+    python -m benchmarks.startup --runs 10 --questions 1000
+
+Every run starts a fresh interpreter, so nothing is cached between runs.
+Reported steps:
+
+- `import db`, `import migrations`: what tooling pays, no db access
+- `import main`: all modules of the bot
+- `db init`: engine creation and the pending migrations check
+- `build application`: handlers and wrappers
+- `post_init db`: counters and the duplicate index of `--questions`
+  pending questions, loaded before the bot gets updates
+
+A fresh SQLite db in a temporary directory is used unless `--db-url` is
+given, it is migrated and filled with pending questions once.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+IMPORT_STEPS = ("db", "migrations", "main")
+
+# Runs in the child interpreter, prints durations of steps in ms
+_STARTUP = """
+import asyncio, json, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+import async_db as adb
+import db
+import migrations
+assert not migrations.pending(db.init())
+initialized = time.perf_counter()
+main.build_application()
+built = time.perf_counter()
+async def post_init():
+    await adb.refresh_counters()
+    await adb.index_pending_questions()
+    await adb.shutdown()
+asyncio.run(post_init())
+ready = time.perf_counter()
+print(json.dumps({
+    "import main": (imported - started) * 1000,
+    "db init": (initialized - imported) * 1000,
+    "build application": (built - initialized) * 1000,
+    "post_init db": (ready - built) * 1000,
+    "total": (ready - started) * 1000,
+}))
+"""
+
+_IMPORT = """
+import json, time
+started = time.perf_counter()
+import {module}
+print(json.dumps({{"import {module}": (time.perf_counter() - started) * 1000}}))
+"""
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark cold start of the bot"
+    )
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--questions",
+        type=int,
+        default=1000,
+        help="pending questions loaded on startup",
+    )
+    parser.add_argument(
+        "--db-url",
+        help="SQLAlchemy URL of a db the benchmark may overwrite",
+    )
+    return parser.parse_args(argv)
+
+
+def prepare_db(questions: int) -> None:
+    """Migrate the db and replace its questions with pending ones"""
+    from sqlalchemy import delete, insert
+
+    import db
+    import migrations
+    from models import Question
+
+    engine = db.init()
+    migrations.upgrade(engine)
+    with engine.begin() as connection:
+        connection.execute(delete(Question))
+        if questions:
+            connection.execute(
+                insert(Question),
+                [
+                    {"text": f"Question {number} about topic {number % 97}"}
+                    for number in range(questions)
+                ],
+            )
+
+
+def run_child(code: str, env: dict) -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def report(samples: dict[str, list[float]]) -> None:
+    print(f"{'step':<22}{'min ms':>10}{'p50 ms':>10}{'max ms':>10}")
+    print("-" * 52)
+    for step, values in samples.items():
+        print(
+            f"{step:<22}{min(values):>10.1f}"
+            f"{statistics.median(values):>10.1f}{max(values):>10.1f}"
+        )
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as tmp:
+        if not args.db_url:
+            args.db_url = f"sqlite:///{tmp}/startup.db"
+        env = {
+            **os.environ,
+            "DB_URL": args.db_url,
+            "API_TOKEN": os.getenv("API_TOKEN") or "123:benchmark",
+            "ADMIN_IDS": os.getenv("ADMIN_IDS") or "1",
+            "REPLY_USER_ID": os.getenv("REPLY_USER_ID") or "1",
+            "DEVELOPER_CHAT_ID": os.getenv("DEVELOPER_CHAT_ID") or "1",
+        }
+        os.environ.update(env)
+        prepare_db(args.questions)
+
+        samples = {}
+        for _ in range(args.runs):
+            results = [
+                run_child(_IMPORT.format(module=module), env)
+                for module in IMPORT_STEPS
+            ]
+            results.append(run_child(_STARTUP, env))
+            for result in results:
+                for step, value in result.items():
+                    samples.setdefault(step, []).append(value)
+    report(samples)
+
+
+if __name__ == "__main__":
+    main()
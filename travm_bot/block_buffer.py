@@ -0,0 +1,94 @@
+import asyncio
+import dataclasses
+import os
+
+import async_db as adb
+import custom_logging as cl
+import db
+
+logger = cl.logger
+
+BLOCK_BUFFER_SIZE = int(os.getenv("BLOCK_BUFFER_SIZE", 500))
+BLOCK_BUFFER_INTERVAL = float(os.getenv("BLOCK_BUFFER_INTERVAL", 5))
+
+
+class BlockStatusBuffer:
+    """Write-behind buffer for `is_blocked` changes of users
+
+    Changes are applied to the user cache right away and written to the
+    db in bulk updates once `max_size` changes are pending, every
+    `flush_interval` seconds and on shutdown.
+    """
+
+    def __init__(self, max_size: int, flush_interval: float) -> None:
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        # tg_id -> is_blocked, the latest change wins
+        self._pending = {}
+        self._lock = asyncio.Lock()
+        self._task = None
+        # Flushes started by `mark`, referenced until they are done
+        self._flushes = set()
+
+    def mark(self, user_id: int, blocked: bool) -> None:
+        """Schedule change of block status of user with `user_id`
+
+        Args:
+            user_id (int)
+            blocked (bool)
+        """
+        self._pending[user_id] = blocked
+        db.user_cache.replace(
+            user_id, lambda user: dataclasses.replace(user, is_blocked=blocked)
+        )
+        if len(self._pending) >= self.max_size and not self._lock.locked():
+            task = asyncio.create_task(self.flush())
+            self._flushes.add(task)
+            task.add_done_callback(self._flush_done)
+
+    async def flush(self) -> None:
+        """Write pending changes to the db"""
+        async with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            for blocked in (True, False):
+                user_ids = [
+                    user_id
+                    for user_id, value in pending.items()
+                    if value is blocked
+                ]
+                if not user_ids:
+                    continue
+                try:
+                    await adb.set_users_blocked(user_ids, blocked)
+                except Exception:
+                    logger.exception("Failed to flush block statuses")
+                    for user_id in user_ids:
+                        self._pending.setdefault(user_id, blocked)
+            logger.info(f"Flushed {len(pending)} block status changes")
+
+    def _flush_done(self, task: asyncio.Task) -> None:
+        self._flushes.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(
+                "Failed to flush block statuses", exc_info=task.exception()
+            )
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def start(self, application=None) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, application=None) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+        await self.flush()
+
+
+buffer = BlockStatusBuffer(BLOCK_BUFFER_SIZE, BLOCK_BUFFER_INTERVAL)
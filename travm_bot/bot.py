@@ -3,6 +3,9 @@ from telegram import (
     ReplyKeyboardRemove,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaPhoto,
+    InputMediaVideo,
+    Message,
     Update,
 )
 from telegram.ext import (
@@ -10,14 +13,23 @@ from telegram.ext import (
     ConversationHandler,
 )
 from telegram.constants import ParseMode
-from telegram.error import Forbidden
+from telegram.error import BadRequest, Forbidden
 
+import asyncio
+import broadcast
 import constants
+import async_db as adb
+import block_buffer
 import db
+import digest
+import flood
+import media
+import outbound
+import profiling
 import json
 import html
 import custom_logging as cl
-from models import Question
+from models import Question, QuestionAttachment
 import os
 import traceback
 
@@ -27,7 +39,8 @@ logger = cl.logger
 # Commands
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = constants.START_TEXT
-    db.create_or_update_user(update)
+    await adb.create_or_update_user(update)
+    block_buffer.buffer.mark(update.effective_user.id, False)
     await update.message.reply_text(text)
 
 
@@ -37,38 +50,64 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
 
 
+async def register_user(update: Update) -> None:
+    """Save the sender of `update` unless they are already cached
+
+    Whoever writes to the bot hasn't blocked it, so the block status is
+    reset as well.
+    """
+    user = db.user_cache.get(update.effective_user.id)
+    if user is None:
+        await adb.create_or_update_user(update)
+    if user is None or user.is_blocked:
+        block_buffer.buffer.mark(update.effective_user.id, False)
+
+
 async def send_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.edited_message:
         return
-    user = db.get_user(update.effective_user.id)
-    if not user:
-        db.create_or_update_user(update)
+    if not await flood.allow(update):
+        return
+    await register_user(update)
     question = Question(
         update.effective_user.id,
-        None,
         update.message.text,
     )
     if len(question.text) > 250:
         await update.message.reply_text(constants.LONG_TEXT)
         return
 
-    db.save_question(question)
-    await context.bot.send_message(
-        os.getenv("REPLY_USER_ID"),
-        text=question.text + f"\n\nUser id: {question.owner_id}",
-        reply_markup=InlineKeyboardMarkup(get_question_accept_btns(question)),
-    )
+    try:
+        original = await adb.save_question(question)
+    except Exception:
+        await update.message.reply_text(constants.QUESTION_ERROR_TEXT)
+        return
+    if original is None and not digest.enabled():
+        with outbound.priority(outbound.MODERATION):
+            await context.bot.send_message(
+                os.getenv("REPLY_USER_ID"),
+                text=question.text + f"\n\nUser id: {question.owner_id}",
+                reply_markup=InlineKeyboardMarkup(
+                    get_question_accept_btns(question)
+                ),
+            )
     await update.message.reply_text(constants.THANKS_FOR_QUESTION)
 
 
 async def send_img(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = db.get_user(update.effective_user.id)
-    if not user:
-        db.create_or_update_user(update)
+    if not await flood.allow(update):
+        return
+    await register_user(update)
+    if update.message.media_group_id:
+        media.albums.add(update.message, send_album)
+        return
     file = update.message.photo[-1]
-    photo = await file.get_file()
     question = Question(
-        update.effective_user.id, photo.file_path, update.message.caption
+        update.effective_user.id,
+        update.message.caption,
+        file.file_id,
+        file.file_unique_id,
+        Question.PHOTO,
     )
     text = (
         question.text if question.text else ""
@@ -76,25 +115,39 @@ async def send_img(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(text) > 250:
         await update.message.reply_text(constants.LONG_TEXT)
         return
-    db.save_question(question)
+    try:
+        original = await adb.save_question(question)
+    except Exception:
+        await update.message.reply_text(constants.QUESTION_ERROR_TEXT)
+        return
 
-    await context.bot.send_photo(
-        chat_id=os.getenv("REPLY_USER_ID"),
-        photo=file,
-        caption=text,
-        reply_markup=InlineKeyboardMarkup(get_question_accept_btns(question)),
-    )
+    if original is None and not digest.enabled():
+        with outbound.priority(outbound.MODERATION):
+            await context.bot.send_photo(
+                chat_id=os.getenv("REPLY_USER_ID"),
+                photo=file,
+                caption=text,
+                reply_markup=InlineKeyboardMarkup(
+                    get_question_accept_btns(question)
+                ),
+            )
     await update.message.reply_text(constants.THANKS_FOR_QUESTION)
 
 
 async def send_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = db.get_user(update.effective_user.id)
-    if not user:
-        db.create_or_update_user(update)
+    if not await flood.allow(update):
+        return
+    await register_user(update)
+    if update.message.media_group_id:
+        media.albums.add(update.message, send_album)
+        return
     file = update.message.video
-    video = await file.get_file()
     question = Question(
-        update.effective_user.id, video.file_path, update.message.caption
+        update.effective_user.id,
+        update.message.caption,
+        file.file_id,
+        file.file_unique_id,
+        Question.VIDEO,
     )
     text = (
         question.text if question.text else ""
@@ -102,30 +155,123 @@ async def send_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(text) > 250:
         await update.message.reply_text(constants.LONG_TEXT)
         return
-    db.save_question(question)
-    await context.bot.send_video(
-        chat_id=os.getenv("REPLY_USER_ID"),
-        video=file,
-        caption=text,
-        reply_markup=InlineKeyboardMarkup(get_question_accept_btns(question)),
-    )
+    try:
+        original = await adb.save_question(question)
+    except Exception:
+        await update.message.reply_text(constants.QUESTION_ERROR_TEXT)
+        return
+    if original is None and not digest.enabled():
+        with outbound.priority(outbound.MODERATION):
+            await context.bot.send_video(
+                chat_id=os.getenv("REPLY_USER_ID"),
+                video=file,
+                caption=text,
+                reply_markup=InlineKeyboardMarkup(
+                    get_question_accept_btns(question)
+                ),
+            )
     await update.message.reply_text(constants.THANKS_FOR_QUESTION)
 
 
+async def send_album(messages: list[Message]):
+    """Save files of one album as a single question
+
+    The album is forwarded to moderators as one media group followed by
+    a message with the moderation keyboard, which replies to the album.
+    Ids of the album messages are saved with the attachments, they are
+    deleted together with the keyboard.
+    """
+    first = messages[0]
+    caption = next((m.caption for m in messages if m.caption), None)
+    attachments = []
+    for message in messages:
+        if message.photo:
+            file = message.photo[-1]
+            media_type = Question.PHOTO
+        else:
+            file = message.video
+            media_type = Question.VIDEO
+        attachments.append(
+            QuestionAttachment(file.file_id, file.file_unique_id, media_type)
+        )
+    question = Question(first.from_user.id, caption, media_type=Question.ALBUM)
+    text = (
+        question.text if question.text else ""
+    ) + f"\n\n User id: {question.owner_id}"
+    if len(text) > 250:
+        await first.reply_text(constants.LONG_TEXT)
+        return
+    try:
+        original = await adb.save_question(question, attachments)
+    except Exception:
+        await first.reply_text(constants.QUESTION_ERROR_TEXT)
+        return
+
+    bot = first.get_bot()
+    if original is None and not digest.enabled():
+        with outbound.priority(outbound.MODERATION):
+            album = await bot.send_media_group(
+                chat_id=os.getenv("REPLY_USER_ID"),
+                media=get_media_group(attachments, text),
+            )
+            await adb.set_attachment_messages(
+                question.question_id, [message.message_id for message in album]
+            )
+            await bot.send_message(
+                chat_id=os.getenv("REPLY_USER_ID"),
+                text=constants.ALBUM_QUESTION_TEXT.format(count=len(album)),
+                reply_to_message_id=album[0].message_id,
+                reply_markup=InlineKeyboardMarkup(
+                    get_question_accept_btns(question)
+                ),
+            )
+    await first.reply_text(constants.THANKS_FOR_QUESTION)
+
+
+def get_media_group(attachments: list[QuestionAttachment], caption=None):
+    media_group = []
+    for i, attachment in enumerate(attachments):
+        if attachment.media_type == Question.PHOTO:
+            media_class = InputMediaPhoto
+        else:
+            media_class = InputMediaVideo
+        # Caption of the first file is shown as caption of the album
+        media_group.append(
+            media_class(attachment.file_id, caption=None if i else caption)
+        )
+    return media_group
+
+
+async def notify_accepted(bot, user_id: int, user=None) -> None:
+    """Tell the author of a question that it was accepted
+
+    Args:
+        bot (Bot)
+        user_id (int)
+        user (UserRecord, optional): Author if it's already loaded
+    """
+    try:
+        await bot.send_message(user_id, constants.USER_ACCEPTED_QUESTION)
+    except Forbidden:
+        block_buffer.buffer.mark(user_id, True)
+        return
+    if user is None:
+        user = await adb.get_user(user_id)
+    if user and user.is_blocked:
+        block_buffer.buffer.mark(user_id, False)
+
+
 def get_question_accept_btns(question: Question):
+    data = {"question": question.question_id}
     return [
         [
             InlineKeyboardButton(
                 "✅",
-                callback_data=json.dumps(
-                    {"question": question.question_id, "action": "accept"}
-                ),
+                callback_data=json.dumps({**data, "action": "accept"}),
             ),
             InlineKeyboardButton(
                 "❌",
-                callback_data=json.dumps(
-                    {"question": question.question_id, "action": "decline"}
-                ),
+                callback_data=json.dumps({**data, "action": "decline"}),
             ),
         ]
     ]
@@ -134,7 +280,9 @@ def get_question_accept_btns(question: Question):
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         text="/send_ad - Отправить рассылку\n"
-        "/stats - получить статистику бота\n",
+        "/stats - получить статистику бота\n"
+        "/profile - профилирование обработчиков\n"
+        "/digest - вопросы на модерации одним списком\n",
         parse_mode="HTML",
         reply_markup=ReplyKeyboardMarkup(
             keyboard=constants.ADMIN_MENU_BTNS,
@@ -187,10 +335,10 @@ async def send_ad_attachment(
         ad_attachment_type = "text"
         ad_attachment = None
     elif update.message.photo:
-        ad_attachment = update.message.photo[-1]
+        ad_attachment = update.message.photo[-1].file_id
         ad_attachment_type = "photo"
     elif update.message.video:
-        ad_attachment = update.message.video
+        ad_attachment = update.message.video.file_id
         ad_attachment_type = "video"
     else:
         await update.message.reply_text(
@@ -255,99 +403,13 @@ async def send_ad(
             ),
         )
         return ConversationHandler.END
-    users = db.get_all_users(inlcude_admin=False)
-    sended_users_number = 0
-    block_bot_users_number = 0
-    text = post["text"]
-    file = post["attachment"]
-    button = (
-        InlineKeyboardButton(
-            text=post["button"]["text"],
-            url=post["button"]["url"],
-        )
-        if post.get("button", None)
-        else None
+    progress_message = await update.message.reply_text(
+        constants.AD_STARTED_TEXT
     )
-    kb = InlineKeyboardMarkup([[button]]) if button else None
-
-    try:
-        for user in users:
-            text = text.format(
-                name=user.fullname or "Уважаемый пользователь",
-                username=user.username or "",
-            )
-            if not user.is_blocked:
-                if post["type"] == "photo":
-                    await context.bot.send_photo(
-                        chat_id=user.tg_id,
-                        photo=file,
-                        caption=text,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=kb,
-                    )
-                elif post["type"] == "video":
-                    await context.bot.send_video(
-                        chat_id=user.tg_id,
-                        video=file,
-                        caption=text,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=kb,
-                    )
-                else:
-                    await context.bot.send_message(
-                        user.tg_id,
-                        text=text,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=kb,
-                    )
-                sended_users_number += 1
-            else:
-                block_bot_users_number += 1
-    except Forbidden:
-        db.update_user(user.tg_id, {"is_blocked": True})
-        block_bot_users_number += 1
-    finally:
-        await update.message.reply_text(
-            f"Рассылка была отправлена {sended_users_number} пользователям!\n"
-            f"Пользователей, заблокировавших  бота: {block_bot_users_number}."
-            f"\n\nПост:",
-            reply_markup=ReplyKeyboardMarkup(
-                keyboard=constants.ADMIN_MENU_BTNS,
-                resize_keyboard=True,
-            ),
-        )
-        if post["type"] == "photo":
-            await context.bot.send_photo(
-                chat_id=update.effective_user.id,
-                photo=file,
-                caption=text.format(
-                    name=user.fullname or "Уважаемый пользователь",
-                    username=user.username or "",
-                ),
-                parse_mode=ParseMode.HTML,
-                reply_markup=kb,
-            )
-        elif post["type"] == "video":
-            await context.bot.send_video(
-                chat_id=update.effective_user.id,
-                video=file,
-                caption=text.format(
-                    name=user.fullname or "Уважаемый пользователь",
-                    username=user.username or "",
-                ),
-                parse_mode=ParseMode.HTML,
-                reply_markup=kb,
-            )
-        else:
-            await context.bot.send_message(
-                chat_id=update.effective_user.id,
-                text=text.format(
-                    name=user.fullname or "Уважаемый пользователь",
-                    username=user.username or "",
-                ),
-                parse_mode=ParseMode.HTML,
-                reply_markup=kb,
-            )
+    job = await adb.create_broadcast_job(
+        update.effective_user.id, progress_message.message_id, post
+    )
+    broadcast.start(context.bot, job)
 
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -356,19 +418,59 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def get_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_count = len(db.get_all_users(inlcude_admin=True))
-    user_blocked = db.get_blocked_user_count()
-    question_no_solved = db.get_question_count()
+    stats = await adb.get_stats()
+    cache_stats = db.user_cache.stats()
 
     text = (
         "Статистика:\n\n"
-        f"Кол-во пользователей:\n👤 {user_count}\n"
-        f"Кол-во пользователей, остановиших бота:\n🚫 {user_blocked}\n"
-        f"Кол-во не отвеченных вопросов:\n❔ {question_no_solved}"
+        f"Кол-во пользователей:\n👤 {stats[db.USERS_TOTAL]}\n"
+        f"Кол-во пользователей, остановиших бота:\n"
+        f"🚫 {stats[db.USERS_BLOCKED]}\n"
+        f"Кол-во не отвеченных вопросов:\n❔ {stats[db.QUESTIONS_PENDING]}\n"
+        f"Новых пользователей сегодня:\n🆕 {stats[db.USERS_NEW]}\n"
+        f"Вопросов сегодня:\n📨 {stats[db.QUESTIONS_NEW]}\n"
+        f"Кэш пользователей:\n"
+        f"🗂 попаданий {cache_stats['hits']}, "
+        f"промахов {cache_stats['misses']}"
     )
     await update.message.reply_text(text)
 
 
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Control the handler profiler: /profile [on <share>|off|dump]"""
+    profiler = profiling.profiler
+    args = context.args
+    if args and args[0] == "on":
+        try:
+            sample_rate = float(args[1]) if len(args) > 1 else 0.1
+        except ValueError:
+            sample_rate = 0
+        if not 0 < sample_rate <= 1:
+            await update.message.reply_text(constants.PROFILE_USAGE_TEXT)
+            return
+        profiler.enable(sample_rate)
+    elif args and args[0] == "off":
+        await asyncio.to_thread(profiler.disable)
+    elif args and args[0] == "dump":
+        paths = await asyncio.to_thread(profiler.dump)
+        await update.message.reply_text(
+            "\n".join(paths) if paths else "Нет новых замеров"
+        )
+        return
+    elif args:
+        await update.message.reply_text(constants.PROFILE_USAGE_TEXT)
+        return
+
+    if profiler.enabled:
+        text = (
+            f"Профилирование включено: {profiler.sample_rate:.0%} "
+            f"обновлений.\nФайлы сохраняются в {profiler.directory}"
+        )
+    else:
+        text = "Профилирование выключено"
+    await update.message.reply_text(text)
+
+
 async def error_handler(
     update: object, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
@@ -416,10 +518,11 @@ async def error_handler(
 
 
 # Callbacks
+@outbound.with_priority(outbound.MODERATION)
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = json.loads(query.data)
-    
+
     if not db.is_admin(update.effective_user):
         logger.error(
             f"Unauthorized access detected!\nId: {update.effective_user.id}"
@@ -427,30 +530,129 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("Отказано в доступе!")
         return
 
-    question = db.get_question(data["question"])
+    found = await adb.get_question_with_owner(data["question"])
 
-    if not question:
+    if not found:
         logger.error(f"Question with id {data['question']} not found")
         await query.answer(f"Вопрос с id {data['question']} не найден")
         return
 
-    user = db.get_user(question.owner_id)
-    
+    question, owner = found
+    chat_id = query.message.chat_id
+    album = []
+    if question.media_type == Question.ALBUM:
+        album = await adb.get_question_attachments(question.question_id)
+    answer = None
     if data["action"] == "accept":
-        await query.answer(constants.SUCCESS_QUESTION_TEXT)
-        try:
-            await context.bot.send_message(
-                question.owner_id, constants.USER_ACCEPTED_QUESTION
-            )
-            if user.is_blocked:
-                db.update_user(user.tg_id, {"is_blocked": False})
-        except Forbidden:
-            db.update_user(user.tg_id, {"is_blocked": True})
+        answer = constants.SUCCESS_QUESTION_TEXT
     elif data["action"] == "decline":
-        await query.answer(constants.DECLINE_QUESTION_TEXT)
-    await context.bot.delete_message(
-        update.callback_query.message.chat_id,
-        update.callback_query.message.message_id,
+        answer = constants.DECLINE_QUESTION_TEXT
+
+    # The steps don't depend on each other, so they run concurrently and
+    # a failed step doesn't stop the rest
+    steps = {"answer": query.answer(answer)}
+    if data["action"] == "accept":
+        steps["notify owner"] = notify_accepted(
+            context.bot, question.owner_id, owner
+        )
+    steps["delete keyboard"] = context.bot.delete_message(
+        chat_id, query.message.message_id
     )
+    for attachment in album:
+        if attachment.message_id is None:
+            continue
+        steps[f"delete album message {attachment.message_id}"] = (
+            context.bot.delete_message(chat_id, attachment.message_id)
+        )
+    steps["delete question"] = adb.delete_question(question)
+
+    results = await asyncio.gather(*steps.values(), return_exceptions=True)
+    for step, result in zip(steps, results):
+        if isinstance(result, Exception):
+            logger.error(
+                f"Moderation of question {question.question_id}: "
+                f"{step} failed",
+                exc_info=result,
+            )
+
+
+@outbound.with_priority(outbound.MODERATION)
+async def digest_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = json.loads(query.data)
+
+    if not db.is_admin(update.effective_user):
+        logger.error(
+            f"Unauthorized access detected!\nId: {update.effective_user.id}"
+        )
+        await query.answer("Отказано в доступе!")
+        return
+
+    action = data["digest"]
+    after = data.get("after", 0)
+    if action == "show":
+        question = await adb.get_question(data["question"])
+        if question:
+            await send_question_media(
+                context.bot, query.message.chat_id, question
+            )
+        await query.answer()
+        return
+
+    if action in ("accept", "decline"):
+        questions = await adb.pop_questions([data["question"]])
+    elif action in ("accept_page", "decline_page"):
+        questions = await adb.pop_questions_between(after, data["until"])
+    else:
+        questions = None
+
+    if questions is None:
+        await query.answer()
+    elif not questions:
+        await query.answer(constants.DIGEST_HANDLED_TEXT)
+    elif action.startswith("accept"):
+        await query.answer(constants.SUCCESS_QUESTION_TEXT)
+        # A failed notification doesn't stop the others and the page
+        results = await asyncio.gather(
+            *(
+                notify_accepted(context.bot, question.owner_id)
+                for question in questions
+            ),
+            return_exceptions=True,
+        )
+        for question, result in zip(questions, results):
+            if isinstance(result, Exception):
+                logger.error(
+                    f"Moderation of question {question.question_id}: "
+                    "notify owner failed",
+                    exc_info=result,
+                )
+    else:
+        await query.answer(constants.DECLINE_QUESTION_TEXT)
+
+    text, kb = await digest.render_page(after)
+    try:
+        await query.edit_message_text(
+            text, parse_mode=ParseMode.HTML, reply_markup=kb
+        )
+    except BadRequest:
+        # Message is not modified
+        pass
+
+
+async def send_question_media(bot, chat_id, question: Question) -> None:
+    """Send attachments of `question` to `chat_id`"""
+    if question.media_type == Question.ALBUM:
+        attachments = await adb.get_question_attachments(question.question_id)
+        await bot.send_media_group(
+            chat_id, media=get_media_group(attachments, question.text)
+        )
+    elif question.media_type == Question.PHOTO:
+        await bot.send_photo(chat_id, question.file_id, caption=question.text)
+    elif question.media_type == Question.VIDEO:
+        await bot.send_video(chat_id, question.file_id, caption=question.text)
+
 
-    db.delete_question(question)
+async def send_digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Post the moderation digest right away"""
+    await digest.poster.post(context.bot)
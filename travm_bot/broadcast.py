@@ -0,0 +1,610 @@
+import asyncio
+import html
+import json
+import os
+import re
+
+from telegram import (
+    Bot,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    ReplyKeyboardMarkup,
+)
+from telegram.constants import ParseMode
+from telegram.error import (
+    BadRequest,
+    Forbidden,
+    NetworkError,
+    RetryAfter,
+    TelegramError,
+)
+
+import constants
+import custom_logging as cl
+import async_db as adb
+import block_buffer
+import metrics
+import outbound
+from models import BroadcastJob
+
+logger = cl.logger
+
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+BROADCAST_PROGRESS_INTERVAL = float(
+    os.getenv("BROADCAST_PROGRESS_INTERVAL", 30)
+)
+BROADCAST_CHECKPOINT_BATCH = int(os.getenv("BROADCAST_CHECKPOINT_BATCH", 100))
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", 1000))
+BROADCAST_MAX_RETRIES = 3
+# Seconds before the first retry of a network error, doubled every retry
+BROADCAST_RETRY_DELAY = float(os.getenv("BROADCAST_RETRY_DELAY", 1))
+# Seconds before the first pass over recipients left unsent, doubled
+# every pass
+BROADCAST_UNSENT_DELAY = float(os.getenv("BROADCAST_UNSENT_DELAY", 30))
+BROADCAST_UNSENT_PASSES = 3
+# Outcome of a recipient the post couldn't be sent to because of a
+# network or local error, they are retried at the end of the broadcast
+UNSENT = "unsent"
+
+
+async def send_post(bot: Bot, chat_id: int, post: dict, text: str, kb):
+    """Send `post` to `chat_id` with already formatted `text`
+
+    Args:
+        bot (Bot)
+        chat_id (int)
+        post (dict): Post built by the ad conversation
+        text (str): Formatted post text
+        kb (InlineKeyboardMarkup | None)
+
+    Returns:
+        Message: Sent message
+    """
+    if post["type"] == "photo":
+        return await bot.send_photo(
+            chat_id=chat_id,
+            photo=post["attachment"],
+            caption=text,
+            parse_mode=ParseMode.HTML,
+            reply_markup=kb,
+        )
+    elif post["type"] == "video":
+        return await bot.send_video(
+            chat_id=chat_id,
+            video=post["attachment"],
+            caption=text,
+            parse_mode=ParseMode.HTML,
+            reply_markup=kb,
+        )
+    else:
+        return await bot.send_message(
+            chat_id,
+            text=text,
+            parse_mode=ParseMode.HTML,
+            reply_markup=kb,
+        )
+
+
+async def copy_post(
+    bot: Bot, chat_id: int, from_chat_id: int, message_id: int, kb
+) -> None:
+    """Send a copy of an already sent post to `chat_id`
+
+    Telegram copies the text and the file of the message, the request
+    is the same small payload for every recipient.
+    """
+    await bot.copy_message(
+        chat_id,
+        from_chat_id=from_chat_id,
+        message_id=message_id,
+        reply_markup=kb,
+    )
+
+
+class PostTemplate:
+    """Post text parsed once for all recipients
+
+    `{name}` and `{username}` are replaced with HTML-escaped values of the
+    recipient, `{{` and `}}` with single braces. The rest of the text is
+    the HTML written by the admin and is kept as is, including unknown
+    placeholders.
+    """
+
+    _token = re.compile(r"\{\{|\}\}|\{(name|username)\}")
+
+    def __init__(self, text: str) -> None:
+        # Literal parts around the placeholders in `_fields`
+        self._literals = []
+        self._fields = []
+        literal = []
+        position = 0
+        for match in self._token.finditer(text):
+            literal.append(text[position : match.start()])
+            if match.group(1):
+                self._literals.append("".join(literal))
+                self._fields.append(match.group(1))
+                literal = []
+            else:
+                literal.append(match.group()[0])
+            position = match.end()
+        literal.append(text[position:])
+        self._literals.append("".join(literal))
+
+    @property
+    def personalized(self) -> bool:
+        return bool(self._fields)
+
+    def render(self, fullname: str = None, username: str = None) -> str:
+        values = {
+            "name": html.escape(fullname or "Уважаемый пользователь"),
+            "username": html.escape(username or ""),
+        }
+        parts = [self._literals[0]]
+        for field, literal in zip(self._fields, self._literals[1:]):
+            parts.append(values[field])
+            parts.append(literal)
+        return "".join(parts)
+
+
+def get_post_keyboard(post: dict) -> InlineKeyboardMarkup | None:
+    if not post.get("button", None):
+        return None
+    button = InlineKeyboardButton(
+        text=post["button"]["text"],
+        url=post["button"]["url"],
+    )
+    return InlineKeyboardMarkup([[button]])
+
+
+class Broadcast:
+    """Send a post to every recipient with bounded concurrency
+
+    Sends are spread over `concurrency` workers and throttled by the
+    rate limit of the `outbound.BULK` request class. Failures are handled per recipient, so a user
+    who blocked the bot doesn't stop the whole broadcast.
+
+    Recipients are processed in `tg_id` order and the broadcast state is
+    checkpointed to its `BroadcastJob` every `checkpoint_batch`
+    recipients. The cursor only moves past a recipient once everyone
+    before it is done, so a restarted job never skips anybody and never
+    sends twice to anybody before the cursor. Recipients left unsent by
+    network errors are saved with the checkpoint that moves the cursor
+    past them and retried with backoff once the rest is done. The job is
+    finished and reported only after that, recipients still unsent after
+    the last pass count as failed.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        job: BroadcastJob,
+        concurrency: int = BROADCAST_CONCURRENCY,
+        progress_interval: float = BROADCAST_PROGRESS_INTERVAL,
+        checkpoint_batch: int = BROADCAST_CHECKPOINT_BATCH,
+    ) -> None:
+        self.bot = bot
+        self.job_id = job.job_id
+        self.admin_id = job.admin_id
+        self.progress_message_id = job.progress_message_id
+        self.post = json.loads(job.post)
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self.checkpoint_batch = checkpoint_batch
+        self.kb = get_post_keyboard(self.post)
+        self.template = PostTemplate(self.post["text"] or "")
+        # Text of a post without placeholders is the same for everyone
+        self.text = None
+        if not self.template.personalized:
+            self.text = self.template.render()
+        # Message of the admin copied to recipients, None to send in full
+        self.source_message_id = job.source_message_id
+        self.cursor = job.cursor
+        self.sent = job.sent
+        self.blocked = job.blocked
+        self.failed = job.failed
+        self.total = self.processed
+        # Counters of recipients up to the cursor, these are checkpointed
+        self._committed = {
+            "sent": job.sent,
+            "blocked": job.blocked,
+            "failed": job.failed,
+        }
+        # tg_id -> outcome or None while sending, in dispatch order
+        self._in_flight = {}
+        # Unsent recipients before the cursor and unsent recipients done
+        # by a retry pass, both saved by the next checkpoint
+        self._unsent_ids = []
+        self._resent_ids = []
+        self._last_pass = False
+        self._since_checkpoint = 0
+        self._checkpoint_lock = asyncio.Lock()
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.blocked + self.failed
+
+    async def run(self) -> None:
+        """Send the post to the rest of recipients and report the result"""
+        if self.text is not None and self.source_message_id is None:
+            await self._send_source()
+        self.total = (
+            self.processed
+            + await adb.get_broadcast_recipient_count(self.cursor)
+            + await adb.get_broadcast_unsent_count(self.job_id)
+        )
+        reporter = asyncio.create_task(self._report_progress())
+        try:
+            try:
+                await self._dispatch(
+                    self._track(
+                        adb.iter_broadcast_recipients(
+                            self.cursor, BROADCAST_CHUNK_SIZE
+                        )
+                    ),
+                    self._done,
+                )
+            finally:
+                await self._checkpoint()
+            await self._resend_unsent()
+        finally:
+            reporter.cancel()
+            await asyncio.gather(reporter, return_exceptions=True)
+        await adb.update_broadcast_job(
+            self.job_id, {"status": BroadcastJob.FINISHED}
+        )
+        logger.info(
+            f"Broadcast {self.job_id} finished: sent {self.sent}, "
+            f"blocked {self.blocked}, failed {self.failed}"
+        )
+        await self._report_result()
+
+    async def _resend_unsent(self) -> None:
+        for number in range(BROADCAST_UNSENT_PASSES):
+            unsent = await adb.get_broadcast_unsent_count(self.job_id)
+            if not unsent:
+                return
+            delay = BROADCAST_UNSENT_DELAY * 2**number
+            logger.warning(
+                f"Broadcast {self.job_id} left {unsent} recipients unsent, "
+                f"retrying in {delay}s"
+            )
+            await asyncio.sleep(delay)
+            self._last_pass = number == BROADCAST_UNSENT_PASSES - 1
+            try:
+                await self._dispatch(
+                    adb.iter_broadcast_unsent(
+                        self.job_id, BROADCAST_CHUNK_SIZE
+                    ),
+                    self._resent,
+                )
+            finally:
+                await self._checkpoint()
+
+    async def _dispatch(self, users, done) -> None:
+        """Send the post to `users` and pass outcomes to `done`"""
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [
+            asyncio.create_task(self._worker(queue, done))
+            for _ in range(self.concurrency)
+        ]
+        try:
+            async for user in users:
+                await queue.put(user)
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _track(self, users):
+        async for user in users:
+            self._in_flight[user.tg_id] = None
+            yield user
+
+    async def _worker(self, queue: asyncio.Queue, done) -> None:
+        # Workers are tasks of their own, the priority stays inside them
+        outbound.request_priority.set(outbound.BULK)
+        while True:
+            user = await queue.get()
+            try:
+                outcome = await self._send(user)
+            except Exception:
+                # E.g. the client is already closed, not the recipient's
+                # fault, so they are retried
+                logger.exception(f"Broadcast to {user.tg_id} failed")
+                outcome = UNSENT
+            await done(user.tg_id, outcome)
+            queue.task_done()
+
+    async def _done(self, tg_id: int, outcome: str) -> None:
+        self._in_flight[tg_id] = outcome
+        if outcome != UNSENT:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+        while self._in_flight:
+            first = next(iter(self._in_flight))
+            outcome = self._in_flight[first]
+            if outcome is None:
+                break
+            del self._in_flight[first]
+            if outcome == UNSENT:
+                self._unsent_ids.append(first)
+            else:
+                self._committed[outcome] += 1
+            self.cursor = first
+        await self._maybe_checkpoint()
+
+    async def _resent(self, tg_id: int, outcome: str) -> None:
+        if outcome == UNSENT:
+            if not self._last_pass:
+                return
+            logger.error(f"Broadcast to {tg_id} failed: still unsent")
+            outcome = "failed"
+        setattr(self, outcome, getattr(self, outcome) + 1)
+        self._committed[outcome] += 1
+        self._resent_ids.append(tg_id)
+        await self._maybe_checkpoint()
+
+    async def _maybe_checkpoint(self) -> None:
+        self._since_checkpoint += 1
+        if self._since_checkpoint < self.checkpoint_batch:
+            return
+        try:
+            await self._checkpoint()
+        except Exception:
+            logger.exception(f"Failed to checkpoint broadcast {self.job_id}")
+
+    async def _checkpoint(self) -> None:
+        # Checkpoints run in the db thread pool, keep them in order
+        async with self._checkpoint_lock:
+            self._since_checkpoint = 0
+            unsent, self._unsent_ids = self._unsent_ids, []
+            resent, self._resent_ids = self._resent_ids, []
+            try:
+                await adb.update_broadcast_job(
+                    self.job_id,
+                    {"cursor": self.cursor, **self._committed},
+                    unsent,
+                    resent,
+                )
+            except BaseException:
+                # Saved by the next checkpoint
+                self._unsent_ids[:0] = unsent
+                self._resent_ids[:0] = resent
+                raise
+
+    async def _send_source(self) -> None:
+        """Send the post to the admin, recipients get copies of it"""
+        try:
+            message = await send_post(
+                self.bot, self.admin_id, self.post, self.text, self.kb
+            )
+        except TelegramError as e:
+            logger.error(f"Failed to send broadcast post to the admin: {e}")
+            return
+        self.source_message_id = message.message_id
+        await adb.update_broadcast_job(
+            self.job_id, {"source_message_id": self.source_message_id}
+        )
+
+    async def _deliver(self, user, copy: bool) -> None:
+        if copy:
+            await copy_post(
+                self.bot,
+                user.tg_id,
+                self.admin_id,
+                self.source_message_id,
+                self.kb,
+            )
+            return
+        text = self.text
+        if text is None:
+            text = self.template.render(user.fullname, user.username)
+        await send_post(self.bot, user.tg_id, self.post, text, self.kb)
+
+    async def _send(self, user) -> str:
+        copy = self.source_message_id is not None
+        copy_failed = False
+        outcome = "failed"
+        for attempt in range(BROADCAST_MAX_RETRIES):
+            try:
+                await self._deliver(user, copy)
+            except RetryAfter as e:
+                # The request class is paused too, other workers wait
+                logger.warning(
+                    f"Broadcast flood limit, pausing for {e.retry_after}s"
+                )
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Forbidden:
+                block_buffer.buffer.mark(user.tg_id, True)
+                return "blocked"
+            except BadRequest as e:
+                if not copy:
+                    logger.error(f"Broadcast to {user.tg_id} failed: {e}")
+                    return "failed"
+                # The admin may have deleted the source message
+                logger.warning(f"Failed to copy post to {user.tg_id}: {e}")
+                copy = False
+                copy_failed = True
+                continue
+            except NetworkError as e:
+                logger.warning(f"Broadcast to {user.tg_id} failed: {e}")
+                outcome = UNSENT
+                if attempt + 1 < BROADCAST_MAX_RETRIES:
+                    await asyncio.sleep(BROADCAST_RETRY_DELAY * 2**attempt)
+                continue
+            except TelegramError as e:
+                logger.error(f"Broadcast to {user.tg_id} failed: {e}")
+                return "failed"
+            if copy_failed and self.source_message_id is not None:
+                logger.warning(
+                    f"Source of broadcast {self.job_id} is unavailable, "
+                    "sending the post in full"
+                )
+                self.source_message_id = None
+            return "sent"
+        logger.error(f"Broadcast to {user.tg_id} failed: retries exceeded")
+        return outcome
+
+    def _progress_text(self) -> str:
+        return (
+            f"Рассылка отправляется: {self.processed} из {self.total}\n"
+            f"Отправлено: {self.sent}\n"
+            f"Заблокировали бота: {self.blocked}\n"
+            f"Ошибок: {self.failed}"
+        )
+
+    async def _report_progress(self) -> None:
+        outbound.request_priority.set(outbound.BULK)
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            try:
+                await self.bot.edit_message_text(
+                    self._progress_text(),
+                    chat_id=self.admin_id,
+                    message_id=self.progress_message_id,
+                )
+            except BadRequest:
+                # Message is not modified
+                pass
+            except TelegramError as e:
+                logger.error(f"Failed to report broadcast progress: {e}")
+
+    async def _send_report(self, send) -> bool:
+        """Make a request reporting to the admin, waiting out flood limits
+
+        The job is already finished, so failures are only logged.
+
+        Args:
+            send (Callable): Coroutine function making the request
+
+        Returns:
+            bool: True if the request succeeded
+        """
+        for _ in range(BROADCAST_MAX_RETRIES):
+            try:
+                await send()
+                return True
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except TelegramError as e:
+                logger.error(
+                    f"Failed to report broadcast {self.job_id} result: {e}"
+                )
+                return False
+        logger.error(
+            f"Failed to report broadcast {self.job_id} result: "
+            "retries exceeded"
+        )
+        return False
+
+    async def _report_result(self) -> None:
+        text = (
+            f"Рассылка была отправлена {self.sent} пользователям!\n"
+            f"Пользователей, заблокировавших  бота: {self.blocked}.\n"
+            f"Ошибок при отправке: {self.failed}."
+        )
+        keyboard = ReplyKeyboardMarkup(
+            keyboard=constants.ADMIN_MENU_BTNS,
+            resize_keyboard=True,
+        )
+        if self.source_message_id is not None:
+            # The admin already has the post
+            await self._send_report(
+                lambda: self.bot.send_message(
+                    self.admin_id,
+                    text,
+                    reply_to_message_id=self.source_message_id,
+                    allow_sending_without_reply=True,
+                    reply_markup=keyboard,
+                )
+            )
+            return
+        reported = await self._send_report(
+            lambda: self.bot.send_message(
+                self.admin_id, text + "\n\nПост:", reply_markup=keyboard
+            )
+        )
+        if not reported:
+            return
+        text = self.text
+        if text is None:
+            admin = await adb.get_user(self.admin_id)
+            text = self.template.render(
+                admin.fullname if admin else None,
+                admin.username if admin else None,
+            )
+        await self._send_report(
+            lambda: send_post(
+                self.bot, self.admin_id, self.post, text, self.kb
+            )
+        )
+
+
+_tasks: dict[asyncio.Task, Broadcast] = {}
+
+
+def running() -> list[Broadcast]:
+    """Get broadcasts running in background"""
+    return list(_tasks.values())
+
+
+def _collect_recipients():
+    for broadcast in running():
+        for state in ("total", "sent", "blocked", "failed"):
+            yield (broadcast.job_id, state), getattr(broadcast, state)
+
+
+metrics.Gauge(
+    "bot_broadcast_recipients",
+    "Recipients of running broadcasts by state",
+    ("job_id", "state"),
+    collect=_collect_recipients,
+)
+
+
+def start(bot: Bot, job: BroadcastJob) -> asyncio.Task:
+    """Run broadcast of `job` in background
+
+    Args:
+        bot (Bot)
+        job (BroadcastJob)
+
+    Returns:
+        asyncio.Task
+    """
+    broadcast = Broadcast(bot, job)
+    task = asyncio.create_task(broadcast.run())
+    _tasks[task] = broadcast
+    task.add_done_callback(_task_done)
+    return task
+
+
+def _task_done(task: asyncio.Task) -> None:
+    _tasks.pop(task, None)
+    if not task.cancelled() and task.exception():
+        logger.error(
+            "Broadcast crashed, it will be resumed on next start",
+            exc_info=task.exception(),
+        )
+
+
+async def resume(application) -> None:
+    """Restart broadcasts interrupted by previous shutdown
+
+    Used as `post_init` of the application.
+    """
+    for job in await adb.get_running_broadcast_jobs():
+        logger.info(f"Resuming {job}")
+        start(application.bot, job)
+
+
+async def shutdown(application) -> None:
+    """Stop running broadcasts and checkpoint their progress
+
+    Registered with `ChatOrderedApplication.on_stop`, so it runs while
+    the Bot API clients are still open.
+    """
+    for task in list(_tasks):
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
@@ -0,0 +1,137 @@
+"""Concurrent update processing that keeps the order within each chat"""
+
+import asyncio
+import os
+import time
+
+from telegram import Update
+from telegram.ext import Application
+
+import custom_logging as cl
+import metrics
+from persistence import SQLPersistence
+
+logger = cl.logger
+
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 16))
+# Updates let into chat queues at once, the rest wait in the update queue
+MAX_QUEUED_UPDATES = 4096
+
+
+def _order_key(update: object) -> int | tuple[int, int] | None:
+    """Get key of updates that must be processed in order
+
+    Button presses only conflict with presses on the same message, so
+    moderators working through questions in one chat aren't serialized.
+    """
+    if not isinstance(update, Update):
+        return None
+    query = update.callback_query
+    if query and query.message:
+        return query.message.chat.id, query.message.message_id
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+class ChatOrderedApplication(Application):
+    """Application processing updates of different chats concurrently
+
+    Updates of one chat are processed one by one in the order they were
+    received, which `ConversationHandler` relies on. Callback queries are
+    ordered only with the other callback queries of their message. At most
+    `max_concurrent_updates` updates of different chats are processed at
+    the same time.
+
+    Set with `ApplicationBuilder.application_class` together with
+    `ApplicationBuilder.concurrent_updates`, which is how many updates
+    may wait in chat queues.
+
+    With `SQLPersistence` an update is processed holding its persistent
+    state, so processes sharing the db don't process updates of one user
+    or chat at the same time.
+
+    Callbacks registered with `on_stop` run before the application stops.
+    """
+
+    __slots__ = ("_slots", "_chats", "_stop_callbacks")
+
+    def __init__(
+        self,
+        *args,
+        max_concurrent_updates: int = UPDATE_CONCURRENCY,
+        **kwargs,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # chat id or (chat id, message id) of callback queries ->
+        # [lock, updates queued or being processed]
+        self._chats = {}
+        self._stop_callbacks = []
+
+    def on_stop(self, callback) -> None:
+        """Await `callback(application)` before the application stops
+
+        PTB closes the Bot API clients in `shutdown`, before it calls
+        `post_shutdown`, so tasks making requests in background must be
+        stopped here instead.
+
+        Args:
+            callback (Callable): Coroutine function
+        """
+        self._stop_callbacks.append(callback)
+
+    async def stop(self) -> None:
+        for callback in self._stop_callbacks:
+            try:
+                await callback(self)
+            except Exception:
+                logger.exception(f"Stop callback {callback} failed")
+        await super().stop()
+
+    def chat_queue_depths(self) -> dict[int, int]:
+        """Get number of queued or running updates of every busy chat"""
+        depths = {}
+        for key, state in self._chats.items():
+            chat_id = key[0] if isinstance(key, tuple) else key
+            depths[chat_id] = depths.get(chat_id, 0) + state[1]
+        return depths
+
+    async def process_update(self, update: object) -> None:
+        key = _order_key(update)
+        queued_at = time.perf_counter()
+        if key is None:
+            async with self._slots:
+                metrics.UPDATE_WAIT.observe(
+                    value=time.perf_counter() - queued_at
+                )
+                await self._process_update(update)
+            return
+
+        state = self._chats.setdefault(key, [asyncio.Lock(), 0])
+        state[1] += 1
+        try:
+            async with state[0], self._slots:
+                metrics.UPDATE_WAIT.observe(
+                    value=time.perf_counter() - queued_at
+                )
+                await self._process_update(update)
+        finally:
+            state[1] -= 1
+            if not state[1]:
+                del self._chats[key]
+
+    async def _process_update(self, update: object) -> None:
+        if isinstance(self.persistence, SQLPersistence):
+            async with self.persistence.shared(self, update):
+                await super().process_update(update)
+        else:
+            await super().process_update(update)
+
+    async def update_persistence(self) -> None:
+        await super().update_persistence()
+        # Also write changes collected in the persistence update interval
+        if isinstance(self.persistence, SQLPersistence):
+            await self.persistence.flush()
@@ -8,6 +8,20 @@ THANKS_FOR_QUESTION = "Спасибо за Ваш вопрос!\n\
 USER_ACCEPTED_QUESTION = "Ваш пост был опубликован!"
 LONG_TEXT = "Длина вопроса не должна превышать 250 символов.\nПожалуйста, \
 сократите вопрос, насколько это возможно"
+QUESTION_ERROR_TEXT = "Не удалось сохранить вопрос.\n\
+Пожалуйста, попробуйте отправить его позже."
+QUESTION_COOLDOWN_TEXT = "Вы отправляете вопросы слишком часто.\n\
+Попробуйте снова через {seconds} с."
+AD_STARTED_TEXT = "Рассылка запущена.\n\
+Здесь будет отображаться прогресс отправки."
+ALBUM_QUESTION_TEXT = "Вопрос с альбомом из {count} файлов"
+DIGEST_TITLE_TEXT = "<b>Вопросы на модерации: {total}</b>\n"
+DIGEST_EMPTY_TEXT = "Нет вопросов на модерации"
+DIGEST_HANDLED_TEXT = "Вопросы уже обработаны"
+PROFILE_USAGE_TEXT = "Использование:\n\
+/profile on 0.1 - профилировать 10% обновлений\n\
+/profile off - выключить профилирование\n\
+/profile dump - сохранить собранные замеры"
 
 # Buttons
 GET_QUESTIONS_TEXT = "Посмотреть вопросы"
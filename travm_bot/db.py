@@ -1,33 +1,204 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
-from models import Base, User, Question
+from sqlalchemy import (
+    URL,
+    Engine,
+    Select,
+    and_,
+    create_engine,
+    event,
+    func,
+    literal_column,
+    make_url,
+    or_,
+)
+from sqlalchemy.orm import Session as OrmSession, sessionmaker, scoped_session
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from models import (
+    BroadcastJob,
+    BroadcastUnsent,
+    Counter,
+    PersistentData,
+    User,
+    UserRecord,
+    Question,
+    QuestionAttachment,
+)
+from cache import TTLCache
+import dataclasses
 import datetime
+import contextvars
+import functools
+import json
+import threading
 import custom_logging as cl
+import duplicates
+import sqlite_backend
 
 import os
-import dotenv
-
-dotenv.load_dotenv()
 
 logger = cl.logger
 
-db_name = os.getenv("DB_NAME")
-db_user = os.getenv("DB_USER")
-db_pass = os.getenv("DB_PASS")
+# Created by `init`
+engine = None
+# Engine of SELECTs outside of writing transactions, `engine` unless the
+# backend has separate read-only connections
+read_engine = None
+_init_lock = threading.Lock()
+
+
+def database_url() -> str | URL:
+    """Get the db URL from env variables
+
+    `DB_URL` is used as is if set, otherwise the URL is built from
+    `DB_DRIVER`, `DB_USER`, `DB_PASS`, `DB_HOST`, `DB_PORT` and `DB_NAME`.
+    """
+    url = os.getenv("DB_URL")
+    if url:
+        return url
+    port = os.getenv("DB_PORT")
+    return URL.create(
+        os.getenv("DB_DRIVER") or "mysql+pymysql",
+        username=os.getenv("DB_USER") or None,
+        password=os.getenv("DB_PASS") or None,
+        host=os.getenv("DB_HOST") or "localhost",
+        port=int(port) if port else None,
+        database=os.getenv("DB_NAME") or None,
+    )
+
+
+def init(url: str | URL | None = None) -> Engine:
+    """Create the engine and bind sessions to it, once
+
+    Nothing connects to the db on import, the first session calls this
+    with the URL from env variables if it wasn't called before.
+
+    Args:
+        url (str | URL | None, optional): Db URL. Defaults to
+            `database_url()`
+
+    Returns:
+        Engine
+    """
+    global engine, read_engine
+    with _init_lock:
+        if engine is None:
+            url = make_url(url or database_url())
+            if sqlite_backend.is_file_db(url):
+                engine, read_engine = sqlite_backend.create_engines(url)
+            else:
+                engine = read_engine = create_engine(
+                    url,
+                    echo=False,
+                    pool_recycle=1800,
+                    pool_pre_ping=True,
+                )
+            _session_factory.configure(bind=engine)
+    return engine
+
+
+class UnitOfWork:
+    """Scope of the session shared by all queries of one update
+
+    Queries of a unit of work may run in different threads of the db
+    pool, `lock` makes sure they don't use the session at the same time.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self.closed = False
+
+
+current_unit_of_work = contextvars.ContextVar(
+    "current_unit_of_work", default=None
+)
+
+
+def _session_scope():
+    unit_of_work = current_unit_of_work.get()
+    if unit_of_work is None or unit_of_work.closed:
+        return threading.get_ident()
+    return unit_of_work
+
+
+class RoutingSession(OrmSession):
+    """Session sending plain SELECTs to `read_engine`
+
+    Once a transaction writes, it reads from `engine` until it ends, so
+    it sees its own changes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if (
+            read_engine is not engine
+            and not self._flushing
+            and not self.info.get("writing")
+            and isinstance(clause, Select)
+            and clause._for_update_arg is None
+        ):
+            return read_engine
+        self.info["writing"] = True
+        return engine
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _end_writing(session, transaction) -> None:
+    if transaction.parent is None:
+        session.info.pop("writing", None)
+
+
+# Objects are used outside of the worker thread that loaded them,
+# so they must stay readable after commit
+_session_factory = sessionmaker(class_=RoutingSession, expire_on_commit=False)
+
+
+def _new_session():
+    if engine is None:
+        init()
+    return _session_factory()
+
+
+Session = scoped_session(_new_session, scopefunc=_session_scope)
+
+
+def close_unit_of_work(unit_of_work: UnitOfWork) -> None:
+    """Close session of `unit_of_work`, following queries get their own"""
+    with unit_of_work.lock:
+        Session.remove()
+        unit_of_work.closed = True
 
-engine = create_engine(
-    f"mysql+pymysql://{db_user}:" f"{db_pass}@" f"localhost/{db_name}",
-    echo=False,
-    pool_recycle=1800,
-    pool_pre_ping=True,
+
+user_cache = TTLCache(
+    maxsize=int(os.getenv("USER_CACHE_SIZE", 10000)),
+    ttl=float(os.getenv("USER_CACHE_TTL", 300)),
 )
 
-Base.metadata.create_all(engine)
-Session = scoped_session(sessionmaker(engine))
+
+# Counters
+USERS_TOTAL = "users_total"
+USERS_BLOCKED = "users_blocked"
+USERS_NEW = "users_new"
+QUESTIONS_PENDING = "questions_pending"
+QUESTIONS_NEW = "questions_new"
+
+
+@functools.cache
+def get_admin_ids() -> frozenset[int]:
+    """Get ids of admins from `ADMIN_IDS` env variable
+
+    Returns:
+        frozenset[int]
+    """
+    return frozenset(
+        int(user_id) for user_id in os.getenv("ADMIN_IDS").split(",")
+    )
+
 
 # User
 def create_or_update_user(update) -> None:
-    """Create or update user
+    """Create or update user with a single upsert
+
+    The user is cached as not blocked: whoever writes to the bot hasn't
+    blocked it. The `is_blocked` column itself is changed through
+    `block_buffer`, which keeps the blocked users counter exact.
 
     Args:
         update (Update): Bot answer update
@@ -35,54 +206,108 @@ def create_or_update_user(update) -> None:
     session = Session()
 
     tg_user = update.effective_user
+    now = datetime.datetime.now()
+    values = {
+        "fullname": tg_user.full_name,
+        "username": tg_user.username,
+        "is_admin": tg_user.id in get_admin_ids(),
+        "last_seen": now,
+    }
     try:
-        user = get_user(tg_user.id)
-        is_admin = str(tg_user.id) in os.getenv("ADMIN_IDS").split(", ")
-
-        if not user:
-            user_db = User(
-                tg_id=tg_user.id,
-                fullname=tg_user.full_name,
-                username=tg_user.username,
-                first_start=datetime.datetime.now(),
-                is_admin=is_admin,
-                is_blocked=False,
-            )
-            logger.info(f"Added user {user_db}")
-            session.add(user_db)
-        else:
-            update_user(
-                user.tg_id,
-                {
-                    "fullname": tg_user.full_name,
-                    "username": tg_user.username,
-                    "is_admin": is_admin,
-                    "is_blocked": False,
-                },
-            )
-    except:
-        session.rollback()
-    finally:
+        inserted = _upsert_user(
+            session,
+            {
+                **values,
+                "tg_id": tg_user.id,
+                "first_start": now,
+                "is_blocked": False,
+            },
+            values,
+        )
+        if inserted:
+            logger.info(f"Added user {tg_user.id}")
+            _bump_counter(session, USERS_TOTAL, 1)
+            _bump_counter(session, USERS_NEW, 1, daily=True)
         session.commit()
+    except Exception as e:
+        logger.error(f"Error in create or update user\n{e}")
+        session.rollback()
+        return
+    user_cache.set(
+        tg_user.id,
+        UserRecord(
+            tg_id=tg_user.id,
+            fullname=values["fullname"],
+            username=values["username"],
+            is_admin=values["is_admin"],
+            is_blocked=False,
+        ),
+    )
 
 
-def get_user(user_id: int) -> User | None:
-    """Get user from db
+def _upsert_user(session, values: dict, update: dict) -> bool:
+    """Insert user or apply `update` to the existing row
+
+    Returns:
+        bool: True if the user was inserted
+    """
+    stmt = _upsert(User, values, lambda new: update)
+    if engine.dialect.name == "mysql":
+        # Affected rows are 1 for insert and 2 for update, `last_seen`
+        # always changes so an existing row is never left as is
+        return session.execute(stmt).rowcount == 1
+    if engine.dialect.name == "postgresql":
+        # xmax of a row is 0 unless an existing row was updated
+        return session.execute(
+            stmt.returning(literal_column("xmax = 0"))
+        ).scalar_one()
+    # SQLite stores naive datetimes as is, `first_start` of a new row
+    # comes back equal to the inserted one
+    first_start = session.execute(
+        stmt.returning(User.first_start)
+    ).scalar_one()
+    return first_start == values["first_start"]
+
+
+def get_user(user_id: int) -> UserRecord | None:
+    """Get user from cache or db
+
+    Args:
+        user_id (int)
+
+    Returns:
+        UserRecord | None: Return UserRecord or None if the result doesn't
+        contain any row.
+    """
+    user = user_cache.get(user_id)
+    if user is None:
+        user = load_user(user_id)
+    return user
+
+
+def load_user(user_id: int) -> UserRecord | None:
+    """Get user from db bypassing the cache and cache it
 
     Args:
         user_id (int)
 
     Returns:
-        User | None: Return User or None if the result doesn't contain any row.
+        UserRecord | None: Return UserRecord or None if the result doesn't
+        contain any row.
     """
     session: scoped_session = Session()
+    user = None
     try:
         user = session.query(User).get({"tg_id": user_id})
     except:
         session.rollback()
     finally:
         session.commit()
-    return user
+    if user is None:
+        return None
+    record = UserRecord.from_user(user)
+    user_cache.set(user_id, record)
+    return record
 
 
 def update_user(user_id: int, values: dict) -> None:
@@ -93,8 +318,20 @@ def update_user(user_id: int, values: dict) -> None:
         values (dict)
     """
     session: scoped_session = Session()
-    session.query(User).filter_by(tg_id=user_id).update(values)
+    changes = {k: v for k, v in values.items() if k != "is_blocked"}
+    if changes:
+        session.query(User).filter_by(tg_id=user_id).update(changes)
+    if "is_blocked" in values:
+        _set_blocked(session, [user_id], values["is_blocked"])
     session.commit()
+    cached = {
+        field.name: values[field.name]
+        for field in dataclasses.fields(UserRecord)
+        if field.name in values
+    }
+    user_cache.replace(
+        user_id, lambda user: dataclasses.replace(user, **cached)
+    )
 
 
 def get_all_users(inlcude_admin: bool = True) -> list[User]:
@@ -105,6 +342,46 @@ def get_all_users(inlcude_admin: bool = True) -> list[User]:
         return session.query(User).filter_by(is_admin=False).all()
 
 
+def get_broadcast_recipients(after: int, limit: int) -> list:
+    """Get next chunk of users a broadcast should be sent to
+
+    Only `tg_id`, `fullname` and `username` are loaded, blocked users
+    and admins are filtered out by the query.
+
+    Args:
+        after (int): Last processed `tg_id`
+        limit (int): Chunk size
+
+    Returns:
+        list[Row]: Rows ordered by `tg_id`
+    """
+    session = Session()
+    try:
+        return (
+            session.query(User.tg_id, User.fullname, User.username)
+            .filter_by(is_admin=False, is_blocked=False)
+            .filter(User.tg_id > after)
+            .order_by(User.tg_id)
+            .limit(limit)
+            .all()
+        )
+    finally:
+        session.commit()
+
+
+def get_broadcast_recipient_count(after: int = 0) -> int:
+    session = Session()
+    try:
+        return (
+            session.query(func.count(User.tg_id))
+            .filter_by(is_admin=False, is_blocked=False)
+            .filter(User.tg_id > after)
+            .scalar()
+        )
+    finally:
+        session.commit()
+
+
 def get_all_users_wtih_block_status(
     blocked: bool, inlcude_admin: bool = True
 ) -> list[User]:
@@ -120,31 +397,161 @@ def get_all_users_wtih_block_status(
     return result
 
 
-def get_blocked_user_count() -> int:
+def _set_blocked(session, user_ids: list[int], blocked: bool) -> int:
+    """Change block status of users and keep the counter in sync
+
+    Returns:
+        int: number of users whose status changed
+    """
+    changed = (
+        session.query(User)
+        .filter(User.tg_id.in_(user_ids), User.is_blocked != blocked)
+        .update({"is_blocked": blocked}, synchronize_session=False)
+    )
+    if changed:
+        _bump_counter(session, USERS_BLOCKED, changed if blocked else -changed)
+    return changed
+
+
+def set_users_blocked(user_ids: list[int], blocked: bool) -> int:
+    """Set block status of all `user_ids` with one UPDATE
+
+    Args:
+        user_ids (list[int])
+        blocked (bool)
+
+    Returns:
+        int: number of users whose status changed
+    """
+    session = Session()
+    changed = _set_blocked(session, user_ids, blocked)
+    session.commit()
+    for user_id in user_ids:
+        user_cache.replace(
+            user_id, lambda user: dataclasses.replace(user, is_blocked=blocked)
+        )
+    return changed
+
+
+def get_user_count() -> int:
+    session = Session()
+    try:
+        return session.query(func.count(User.tg_id)).scalar()
+    finally:
+        session.commit()
+
+
+def get_blocked_user_count(inlcude_admin: bool = True) -> int:
     """Get number of users who block bot
 
     Returns:
         int: number of users
     """
     session = Session()
-    result = session.query(User).filter(User.is_blocked).all()
-    return len(result)
+    query = session.query(func.count(User.tg_id)).filter_by(is_blocked=True)
+    if not inlcude_admin:
+        query = query.filter_by(is_admin=False)
+    try:
+        return query.scalar()
+    finally:
+        session.commit()
 
 
 def is_admin(user) -> bool:
-    return get_user(user.id).is_admin
+    return user.id in get_admin_ids()
 
 
 # Question
-def save_question(question: Question) -> None:
+def save_question(question: Question, attachments=()) -> Question | None:
+    """Save new `question` unless a near-duplicate of it is pending
+
+    A duplicate isn't saved, the `duplicates` counter of the pending
+    question is incremented instead. Only the author of the pending
+    question is notified when it is accepted.
+
+    Args:
+        question (Question)
+        attachments (list[QuestionAttachment]): Files of an album question
+
+    Returns:
+        Question | None: Pending question `question` was folded into,
+        None if it was saved as a new one
+
+    Raises:
+        Exception: If the question couldn't be saved, it must not be
+            sent to moderators then
+    """
+    key = duplicates.media_key(
+        question.media_type,
+        question.file_unique_id,
+        [attachment.file_unique_id for attachment in attachments],
+    )
     session = Session()
     try:
+        original_id = duplicates.index.find(question.text, key)
+        if original_id is not None:
+            folded = (
+                session.query(Question)
+                .filter_by(question_id=original_id)
+                .update({Question.duplicates: Question.duplicates + 1})
+            )
+            if folded:
+                session.commit()
+                logger.info(f"Duplicate of question {original_id}")
+                return session.get(Question, original_id)
+            # Deleted by another process
+            duplicates.index.remove(original_id)
+
         session.add(question)
+        if attachments:
+            session.flush()
+            for position, attachment in enumerate(attachments):
+                attachment.question_id = question.question_id
+                attachment.position = position
+            session.add_all(attachments)
+        _bump_counter(session, QUESTIONS_PENDING, 1)
+        _bump_counter(session, QUESTIONS_NEW, 1, daily=True)
         logger.info(f"New {question}")
         session.commit()
+        duplicates.index.add(question.question_id, question.text, key)
     except Exception as e:
-        logger.error(f"Error in save question/n{e}")
+        logger.error(f"Error in save question\n{e}")
         session.rollback()
+        raise
+    return None
+
+
+def index_pending_questions() -> int:
+    """Fill the duplicate index with all pending questions
+
+    Only the columns needed for fingerprints are loaded.
+
+    Returns:
+        int: Number of indexed questions
+    """
+    duplicates.index.clear()
+    if not duplicates.index.enabled:
+        return 0
+    session = Session()
+    albums = {}
+    attachments = session.query(
+        QuestionAttachment.question_id, QuestionAttachment.file_unique_id
+    ).order_by(QuestionAttachment.question_id, QuestionAttachment.position)
+    for question_id, file_unique_id in attachments:
+        albums.setdefault(question_id, []).append(file_unique_id)
+    questions = session.query(
+        Question.question_id,
+        Question.text,
+        Question.media_type,
+        Question.file_unique_id,
+    )
+    for question_id, text, media_type, file_unique_id in questions:
+        key = duplicates.media_key(
+            media_type, file_unique_id, albums.get(question_id, ())
+        )
+        duplicates.index.add(question_id, text, key)
+    session.commit()
+    return len(duplicates.index)
 
 
 def get_question(question_id) -> Question:
@@ -155,12 +562,505 @@ def get_question(question_id) -> Question:
     return question
 
 
+def get_question_with_owner(
+    question_id,
+) -> tuple[Question, UserRecord | None] | None:
+    """Get question and its owner in one query
+
+    The owner is taken from the user cache if it's there, the cache may
+    already hold block status changes not written to db yet.
+
+    Args:
+        question_id (int)
+
+    Returns:
+        tuple[Question, UserRecord | None] | None: Return None if there is
+        no such question.
+    """
+    session = Session()
+    row = (
+        session.query(Question, User)
+        .outerjoin(User, User.tg_id == Question.owner_id)
+        .filter(Question.question_id == question_id)
+        .first()
+    )
+    if row is None:
+        return None
+    question, user = row
+    owner = user_cache.get(question.owner_id)
+    if owner is None and user is not None:
+        owner = UserRecord.from_user(user)
+        user_cache.set(user.tg_id, owner)
+    return question, owner
+
+
 def get_question_count() -> int:
     session = Session()
-    return len(session.query(Question.question_id).all())
+    try:
+        return session.query(func.count(Question.question_id)).scalar()
+    finally:
+        session.commit()
+
+
+def get_pending_questions(after: int = 0, limit: int = 10) -> list[Question]:
+    """Get page of questions with id greater than `after`
+
+    Args:
+        after (int): Id of the last question of the previous page
+        limit (int): Page size
+
+    Returns:
+        list[Question]
+    """
+    session = Session()
+    try:
+        return (
+            session.query(Question)
+            .filter(Question.question_id > after)
+            .order_by(Question.question_id)
+            .limit(limit)
+            .all()
+        )
+    finally:
+        session.commit()
+
+
+def get_last_question_id() -> int:
+    session = Session()
+    try:
+        return session.query(func.max(Question.question_id)).scalar() or 0
+    finally:
+        session.commit()
+
+
+def get_question_attachments(question_id) -> list[QuestionAttachment]:
+    session = Session()
+    try:
+        return (
+            session.query(QuestionAttachment)
+            .filter_by(question_id=question_id)
+            .order_by(QuestionAttachment.position)
+            .all()
+        )
+    finally:
+        session.commit()
+
+
+def set_attachment_messages(question_id: int, message_ids: list[int]):
+    """Save messages the album of `question_id` was forwarded as
+
+    Args:
+        question_id (int)
+        message_ids (list[int]): Message ids in the order of the album
+    """
+    session = Session()
+    try:
+        for position, message_id in enumerate(message_ids):
+            session.query(QuestionAttachment).filter_by(
+                question_id=question_id, position=position
+            ).update({"message_id": message_id})
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
 
 
 def delete_question(question: Question):
     session = Session()
-    session.delete(question)
+    if question.media_type == Question.ALBUM:
+        session.query(QuestionAttachment).filter_by(
+            question_id=question.question_id
+        ).delete()
+    deleted = (
+        session.query(Question)
+        .filter_by(question_id=question.question_id)
+        .delete()
+    )
+    if deleted:
+        _bump_counter(session, QUESTIONS_PENDING, -deleted)
+    session.commit()
+    duplicates.index.remove(question.question_id)
+
+
+def pop_questions(question_ids: list[int]) -> list[Question]:
+    """Delete questions with `question_ids` in one transaction
+
+    Returns:
+        list[Question]: Deleted questions, handled ones are skipped
+    """
+    return _pop_questions(Question.question_id.in_(question_ids))
+
+
+def pop_questions_between(after: int, until: int) -> list[Question]:
+    """Delete questions with `after` < id <= `until` in one transaction
+
+    Returns:
+        list[Question]: Deleted questions
+    """
+    return _pop_questions(
+        Question.question_id > after, Question.question_id <= until
+    )
+
+
+def _pop_questions(*criteria) -> list[Question]:
+    session = Session()
+    questions = session.query(Question).filter(*criteria).all()
+    if not questions:
+        session.commit()
+        return []
+    question_ids = [question.question_id for question in questions]
+    session.query(QuestionAttachment).filter(
+        QuestionAttachment.question_id.in_(question_ids)
+    ).delete()
+    deleted = (
+        session.query(Question)
+        .filter(Question.question_id.in_(question_ids))
+        .delete()
+    )
+    _bump_counter(session, QUESTIONS_PENDING, -deleted)
+    session.commit()
+    for question_id in question_ids:
+        duplicates.index.remove(question_id)
+    return questions
+
+
+# Broadcast
+def create_broadcast_job(
+    admin_id: int, progress_message_id: int, post: dict
+) -> BroadcastJob:
+    """Save new running broadcast of `post`
+
+    Args:
+        admin_id (int): Admin who started the broadcast
+        progress_message_id (int): Message to report progress in
+        post (dict): Post built by the ad conversation
+
+    Returns:
+        BroadcastJob
+    """
+    session = Session()
+    job = BroadcastJob(
+        admin_id,
+        progress_message_id,
+        json.dumps(post, ensure_ascii=False),
+        datetime.datetime.now(),
+    )
+    # Users who blocked the bot earlier are skipped by the recipients
+    # query, they are counted once with the new job
+    job.blocked = get_blocked_user_count(inlcude_admin=False)
+    session.add(job)
+    session.commit()
+    logger.info(f"New {job}")
+    return job
+
+
+def update_broadcast_job(
+    job_id: int, values: dict, unsent=(), resent=()
+) -> None:
+    """Checkpoint `values` of broadcast with `job_id`
+
+    Unsent recipients are saved in the same transaction as the cursor
+    moving past them.
+
+    Args:
+        job_id (int)
+        values (dict)
+        unsent (Iterable[int], optional): Recipients left unsent
+        resent (Iterable[int], optional): Unsent recipients that are
+            done now, whatever the outcome
+    """
+    session = Session()
+    try:
+        session.add_all(BroadcastUnsent(job_id, tg_id) for tg_id in unsent)
+        resent = list(resent)
+        if resent:
+            session.query(BroadcastUnsent).filter(
+                BroadcastUnsent.job_id == job_id,
+                BroadcastUnsent.tg_id.in_(resent),
+            ).delete(synchronize_session=False)
+        values = {**values, "updated_at": datetime.datetime.now()}
+        session.query(BroadcastJob).filter_by(job_id=job_id).update(values)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+
+def get_broadcast_unsent(job_id: int, after: int, limit: int) -> list:
+    """Get next chunk of unsent recipients of broadcast with `job_id`
+
+    Args:
+        job_id (int)
+        after (int): Last processed `tg_id`
+        limit (int): Chunk size
+
+    Returns:
+        list[Row]: Rows with `tg_id`, `fullname` and `username` ordered
+            by `tg_id`
+    """
+    session = Session()
+    try:
+        return (
+            session.query(User.tg_id, User.fullname, User.username)
+            .join(BroadcastUnsent, BroadcastUnsent.tg_id == User.tg_id)
+            .filter(
+                BroadcastUnsent.job_id == job_id,
+                BroadcastUnsent.tg_id > after,
+            )
+            .order_by(BroadcastUnsent.tg_id)
+            .limit(limit)
+            .all()
+        )
+    finally:
+        session.commit()
+
+
+def get_broadcast_unsent_count(job_id: int) -> int:
+    session = Session()
+    try:
+        return (
+            session.query(func.count(BroadcastUnsent.tg_id))
+            .filter_by(job_id=job_id)
+            .scalar()
+        )
+    finally:
+        session.commit()
+
+
+def get_running_broadcast_jobs() -> list[BroadcastJob]:
+    session = Session()
+    return (
+        session.query(BroadcastJob)
+        .filter_by(status=BroadcastJob.RUNNING)
+        .order_by(BroadcastJob.job_id)
+        .all()
+    )
+
+
+# Persistence
+def _persistent_data_criteria(keys):
+    return or_(
+        *(
+            and_(PersistentData.kind == kind, PersistentData.key == key)
+            for kind, key in keys
+        )
+    )
+
+
+def lock_persistent_data(
+    keys: list[tuple[str, str]], owner: str, timeout: float
+) -> dict[tuple[str, str], str] | None:
+    """Lock existing rows of `keys` for `owner` and get their data
+
+    Missing rows aren't locked, there is nothing to share yet. Either all
+    rows are locked or none.
+
+    Args:
+        keys (list[tuple[str, str]]): (kind, key) of the rows
+        owner (str): Id of the locking process
+        timeout (float): Seconds after which the lock expires
+
+    Returns:
+        dict[tuple[str, str], str] | None: Data of the locked rows, None
+        if some of them are locked by another process
+    """
+    session = Session()
+    criteria = _persistent_data_criteria(keys)
+    if not session.query(PersistentData.kind).filter(criteria).first():
+        session.commit()
+        return {}
+    now = datetime.datetime.now()
+    session.query(PersistentData).filter(
+        criteria,
+        or_(
+            PersistentData.locked_by.is_(None),
+            PersistentData.locked_by == owner,
+            PersistentData.locked_until < now,
+        ),
+    ).update(
+        {
+            PersistentData.locked_by: owner,
+            PersistentData.locked_until: now
+            + datetime.timedelta(seconds=timeout),
+        },
+        synchronize_session=False,
+    )
+    rows = (
+        session.query(
+            PersistentData.kind,
+            PersistentData.key,
+            PersistentData.data,
+            PersistentData.locked_by,
+        )
+        .filter(criteria)
+        .all()
+    )
+    if any(row.locked_by != owner for row in rows):
+        _unlock_persistent_data(session, criteria, owner)
+        session.commit()
+        return None
+    session.commit()
+    return {(row.kind, row.key): row.data for row in rows}
+
+
+def renew_persistent_data_lock(
+    keys: list[tuple[str, str]], owner: str, timeout: float
+) -> int:
+    """Extend locks of `owner` on rows of `keys` by `timeout` seconds
+
+    Returns:
+        int: Number of rows still locked by `owner`
+    """
+    session = Session()
+    renewed = (
+        session.query(PersistentData)
+        .filter(
+            _persistent_data_criteria(keys), PersistentData.locked_by == owner
+        )
+        .update(
+            {
+                PersistentData.locked_until: datetime.datetime.now()
+                + datetime.timedelta(seconds=timeout)
+            },
+            synchronize_session=False,
+        )
+    )
+    session.commit()
+    return renewed
+
+
+def unlock_persistent_data(keys: list[tuple[str, str]], owner: str) -> None:
+    """Release locks of `owner` on rows of `keys`"""
+    session = Session()
+    _unlock_persistent_data(session, _persistent_data_criteria(keys), owner)
+    session.commit()
+
+
+def _unlock_persistent_data(session, criteria, owner: str) -> None:
+    session.query(PersistentData).filter(
+        criteria, PersistentData.locked_by == owner
+    ).update(
+        {PersistentData.locked_by: None, PersistentData.locked_until: None},
+        synchronize_session=False,
+    )
+
+
+def save_persistent_data(changes: dict[tuple[str, str], str | None]):
+    """Write changed persistent data in one transaction
+
+    Args:
+        changes (dict[tuple[str, str], str | None]): (kind, key) -> data,
+            rows with None are deleted
+    """
+    session = Session()
+    try:
+        deleted = [key for key, data in changes.items() if data is None]
+        if deleted:
+            session.query(PersistentData).filter(
+                _persistent_data_criteria(deleted)
+            ).delete(synchronize_session=False)
+        values = [
+            {"kind": kind, "key": key, "data": data}
+            for (kind, key), data in changes.items()
+            if data is not None
+        ]
+        if values:
+            session.execute(
+                _upsert(PersistentData, values, lambda new: {"data": new.data})
+            )
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+
+# Counters
+def _upsert(model, values: dict | list[dict], update):
+    """Build INSERT of `values` that updates the row on duplicate key
+
+    Args:
+        model: Mapped class
+        values (dict | list[dict]): Row or rows to insert
+        update (Callable): Gets the proxy of the row being inserted and
+            returns values to set on the existing row
+    """
+    if engine.dialect.name == "mysql":
+        stmt = mysql.insert(model).values(values)
+        return stmt.on_duplicate_key_update(update(stmt.inserted))
+    dialect = postgresql if engine.dialect.name == "postgresql" else sqlite
+    stmt = dialect.insert(model).values(values)
+    return stmt.on_conflict_do_update(
+        index_elements=model.__table__.primary_key.columns,
+        set_=update(stmt.excluded),
+    )
+
+
+def _bump_counter(session, name: str, delta: int, daily: bool = False):
+    """Add `delta` to counter `name` in the current transaction
+
+    Args:
+        session (Session)
+        name (str)
+        delta (int)
+        daily (bool, optional): Also add to today's counter.
+            Defaults to False.
+    """
+    values = [{"name": name, "value": delta}]
+    if daily:
+        values.append(
+            {
+                "name": f"{name}:{datetime.date.today().isoformat()}",
+                "value": delta,
+            }
+        )
+    session.execute(
+        _upsert(
+            Counter, values, lambda new: {"value": Counter.value + new.value}
+        )
+    )
+
+
+def refresh_counters() -> None:
+    """Recalculate total counters with aggregate queries"""
+    session = Session()
+    totals = {
+        USERS_TOTAL: session.query(func.count(User.tg_id)).scalar(),
+        USERS_BLOCKED: session.query(func.count(User.tg_id))
+        .filter_by(is_blocked=True)
+        .scalar(),
+        QUESTIONS_PENDING: session.query(
+            func.count(Question.question_id)
+        ).scalar(),
+    }
+    session.execute(
+        _upsert(
+            Counter,
+            [{"name": name, "value": value} for name, value in totals.items()],
+            lambda new: {"value": new.value},
+        )
+    )
+    session.commit()
+    logger.info(f"Counters refreshed: {totals}")
+
+
+def get_stats() -> dict[str, int]:
+    """Get total and today's counters
+
+    Returns:
+        dict[str, int]: Counter values by name, today's counters have
+        no date suffix
+    """
+    session = Session()
+    today = datetime.date.today().isoformat()
+    names = {
+        USERS_TOTAL: USERS_TOTAL,
+        USERS_BLOCKED: USERS_BLOCKED,
+        QUESTIONS_PENDING: QUESTIONS_PENDING,
+        f"{USERS_NEW}:{today}": USERS_NEW,
+        f"{QUESTIONS_NEW}:{today}": QUESTIONS_NEW,
+    }
+    rows = session.query(Counter).filter(Counter.name.in_(names)).all()
     session.commit()
+    stats = dict.fromkeys(names.values(), 0)
+    stats.update({names[row.name]: row.value for row in rows})
+    return stats
@@ -0,0 +1,189 @@
+"""Moderation digest: pending questions reviewed page by page
+
+In digest mode questions aren't forwarded to moderators one by one.
+Every `DIGEST_INTERVAL` seconds, if new questions arrived, a digest with
+the first page of pending questions is posted to `REPLY_USER_ID` and
+replaces the previous one. Pages are selected with keyset pagination
+over question ids. Buttons accept or decline a single question or the
+whole page.
+"""
+
+import asyncio
+import html
+import json
+import os
+
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import TelegramError
+
+import async_db as adb
+import constants
+import custom_logging as cl
+import outbound
+from models import Question
+
+logger = cl.logger
+
+MODERATION_MODE = os.getenv("MODERATION_MODE", "instant")
+DIGEST_PAGE_SIZE = int(os.getenv("DIGEST_PAGE_SIZE", 10))
+DIGEST_INTERVAL = float(os.getenv("DIGEST_INTERVAL", 60))
+
+MEDIA_LABELS = {
+    Question.PHOTO: "📷 фото",
+    Question.VIDEO: "🎬 видео",
+    Question.ALBUM: "🖼 альбом",
+    Question.UNAVAILABLE: "📎 файл недоступен",
+}
+
+
+def enabled() -> bool:
+    return MODERATION_MODE == "digest"
+
+
+def callback_data(action: str, **fields) -> str:
+    """Build callback data of a digest button, it must fit in 64 bytes"""
+    return json.dumps({"digest": action, **fields}, separators=(",", ":"))
+
+
+async def render_page(after: int = 0) -> tuple[str, InlineKeyboardMarkup]:
+    """Get text and keyboard of the page of questions following `after`
+
+    Falls back to the first page if there are no questions after `after`.
+
+    Args:
+        after (int): Id of the last question of the previous page
+
+    Returns:
+        tuple[str, InlineKeyboardMarkup | None]
+    """
+    questions = await adb.get_pending_questions(after, DIGEST_PAGE_SIZE)
+    if not questions and after:
+        after = 0
+        questions = await adb.get_pending_questions(after, DIGEST_PAGE_SIZE)
+    if not questions:
+        return constants.DIGEST_EMPTY_TEXT, None
+
+    total = await adb.get_question_count()
+    lines = [constants.DIGEST_TITLE_TEXT.format(total=total)]
+    rows = []
+    for number, question in enumerate(questions, 1):
+        header = f"<b>{number}.</b> User id: {question.owner_id}"
+        if question.media_type:
+            header += f" ({MEDIA_LABELS[question.media_type]})"
+        if question.duplicates:
+            header += f", повторов: {question.duplicates}"
+        lines.append(header)
+        if question.text:
+            lines.append(html.escape(question.text))
+        lines.append("")
+        row = [
+            InlineKeyboardButton(
+                f"✅ {number}",
+                callback_data=callback_data(
+                    "accept", question=question.question_id, after=after
+                ),
+            ),
+            InlineKeyboardButton(
+                f"❌ {number}",
+                callback_data=callback_data(
+                    "decline", question=question.question_id, after=after
+                ),
+            ),
+        ]
+        if question.media_type not in (None, Question.UNAVAILABLE):
+            row.append(
+                InlineKeyboardButton(
+                    f"👁 {number}",
+                    callback_data=callback_data(
+                        "show", question=question.question_id
+                    ),
+                )
+            )
+        rows.append(row)
+
+    until = questions[-1].question_id
+    rows.append(
+        [
+            InlineKeyboardButton(
+                "✅ Все на странице",
+                callback_data=callback_data(
+                    "accept_page", after=after, until=until
+                ),
+            ),
+            InlineKeyboardButton(
+                "❌ Все на странице",
+                callback_data=callback_data(
+                    "decline_page", after=after, until=until
+                ),
+            ),
+        ]
+    )
+    navigation = []
+    if after:
+        navigation.append(
+            InlineKeyboardButton(
+                "⏮ В начало", callback_data=callback_data("page", after=0)
+            )
+        )
+    if len(questions) == DIGEST_PAGE_SIZE:
+        navigation.append(
+            InlineKeyboardButton(
+                "Далее ▶", callback_data=callback_data("page", after=until)
+            )
+        )
+    if navigation:
+        rows.append(navigation)
+    return "\n".join(lines).strip(), InlineKeyboardMarkup(rows)
+
+
+class DigestPoster:
+    """Posts the digest to moderators when new questions arrive"""
+
+    def __init__(self, chat_id, interval: float) -> None:
+        self.chat_id = chat_id
+        self.interval = interval
+        self.message_id = None
+        # Id of the last question included in a posted digest
+        self._announced_id = 0
+        self._task = None
+
+    async def post(self, bot: Bot) -> None:
+        """Post the first page and delete the previous digest"""
+        last_id = await adb.get_last_question_id()
+        text, kb = await render_page()
+        with outbound.priority(outbound.MODERATION):
+            message = await bot.send_message(
+                self.chat_id,
+                text,
+                parse_mode=ParseMode.HTML,
+                reply_markup=kb,
+            )
+            if self.message_id:
+                try:
+                    await bot.delete_message(self.chat_id, self.message_id)
+                except TelegramError as e:
+                    logger.warning(f"Failed to delete old digest: {e}")
+        self.message_id = message.message_id
+        self._announced_id = last_id
+
+    async def _run(self, bot: Bot) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if await adb.get_last_question_id() > self._announced_id:
+                    await self.post(bot)
+            except Exception:
+                logger.exception("Failed to post moderation digest")
+
+    async def start(self, application) -> None:
+        if enabled():
+            self._task = asyncio.create_task(self._run(application.bot))
+
+    async def stop(self, application=None) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+poster = DigestPoster(os.getenv("REPLY_USER_ID"), DIGEST_INTERVAL)
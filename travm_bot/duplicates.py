@@ -0,0 +1,158 @@
+"""Near-duplicate detection of pending questions
+
+A question is fingerprinted by the files it has and the SimHash of its
+text. Questions with the same files whose text hashes differ in at most
+`DUPLICATE_MAX_DISTANCE` bits are duplicates. The hash is split into
+`BANDS` bands, two hashes within the distance share at least one band,
+so candidates are looked up by band instead of comparing with every
+pending question.
+"""
+
+import hashlib
+import os
+import re
+import threading
+
+# Max number of different bits of duplicate text hashes, below BANDS,
+# -1 turns detection off
+DUPLICATE_MAX_DISTANCE = int(os.getenv("DUPLICATE_MAX_DISTANCE", 3))
+HASH_BITS = 64
+BANDS = 4
+BAND_BITS = HASH_BITS // BANDS
+
+_word = re.compile(r"\w+")
+# Votes of all features for one bit of the hash are counted in a slot of
+# SLOT_BITS bits of one big integer, so a feature is added with 8 lookups
+# instead of 64 per-bit updates. _SPREAD[position][byte] has the bits of
+# the byte at `position` of a hash moved to their slots.
+SLOT_BITS = 16
+_SPREAD = [
+    [
+        sum(
+            1 << (position * 8 + bit) * SLOT_BITS
+            for bit in range(8)
+            if byte >> bit & 1
+        )
+        for byte in range(256)
+    ]
+    for position in range(HASH_BITS // 8)
+]
+
+
+def simhash(text: str) -> int:
+    """Get 64-bit SimHash of words and word pairs of `text`
+
+    Case, punctuation and spacing don't change the hash.
+    """
+    words = _word.findall(text.lower().replace("ё", "е"))
+    features = words + [
+        f"{first} {second}" for first, second in zip(words, words[1:])
+    ]
+    if not features:
+        # Only emoji or punctuation, such texts must match exactly
+        features = [text.strip()]
+    votes = 0
+    for feature in features:
+        digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+        for position, byte in enumerate(reversed(digest)):
+            votes += _SPREAD[position][byte]
+    mask = (1 << SLOT_BITS) - 1
+    # A bit is set if most features have it set
+    return sum(
+        1 << bit
+        for bit in range(HASH_BITS)
+        if 2 * (votes >> bit * SLOT_BITS & mask) > len(features)
+    )
+
+
+def media_key(
+    media_type: str | None, file_unique_id: str | None, album=()
+) -> str | None:
+    """Get key of files of a question, None for text questions
+
+    Args:
+        media_type (str | None): `Question.media_type`
+        file_unique_id (str | None): `Question.file_unique_id`
+        album (list[str]): `file_unique_id` of album files in order
+    """
+    if not media_type:
+        return None
+    if album:
+        return ",".join(album)
+    return file_unique_id
+
+
+class DuplicateIndex:
+    """Fingerprints of pending questions, safe to use from db threads"""
+
+    def __init__(self, max_distance: int) -> None:
+        self.max_distance = max_distance
+        # question id -> (media key, text hash or None)
+        self._fingerprints = {}
+        # (media key, band number, band value) -> question ids
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_distance >= 0
+
+    def _keys(self, key: str | None, text_hash: int | None):
+        if text_hash is None:
+            return [(key, None, None)]
+        mask = (1 << BAND_BITS) - 1
+        return [
+            (key, band, text_hash >> band * BAND_BITS & mask)
+            for band in range(BANDS)
+        ]
+
+    def find(self, text: str | None, key: str | None) -> int | None:
+        """Get id of a pending duplicate of a question, None if it's new
+
+        Args:
+            text (str | None): Text of the question
+            key (str | None): `media_key` of the question
+        """
+        if not self.enabled:
+            return None
+        text_hash = simhash(text) if text else None
+        with self._lock:
+            for bucket_key in self._keys(key, text_hash):
+                for question_id in self._buckets.get(bucket_key, ()):
+                    other = self._fingerprints[question_id][1]
+                    if text_hash is None or (
+                        (text_hash ^ other).bit_count() <= self.max_distance
+                    ):
+                        return question_id
+        return None
+
+    def add(self, question_id: int, text: str | None, key: str | None):
+        if not self.enabled:
+            return
+        text_hash = simhash(text) if text else None
+        with self._lock:
+            self._fingerprints[question_id] = (key, text_hash)
+            for bucket_key in self._keys(key, text_hash):
+                self._buckets.setdefault(bucket_key, set()).add(question_id)
+
+    def remove(self, question_id: int) -> None:
+        with self._lock:
+            fingerprint = self._fingerprints.pop(question_id, None)
+            if fingerprint is None:
+                return
+            for bucket_key in self._keys(*fingerprint):
+                bucket = self._buckets.get(bucket_key)
+                bucket.discard(question_id)
+                if not bucket:
+                    del self._buckets[bucket_key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._fingerprints.clear()
+            self._buckets.clear()
+
+    def __len__(self) -> int:
+        return len(self._fingerprints)
+
+
+index = DuplicateIndex(DUPLICATE_MAX_DISTANCE)
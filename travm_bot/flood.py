@@ -0,0 +1,109 @@
+"""Flood protection of question intake
+
+Every question costs a db insert, a message to moderators and a reply,
+so submissions are limited per user and in total before any of that
+happens. A rejected user is told once when to try again, further
+submissions during the cooldown are dropped silently.
+"""
+
+import math
+import os
+import time
+
+from telegram import Update
+
+import constants
+import custom_logging as cl
+import db
+import media
+import metrics
+from cache import TTLCache
+from rate_limit import RedisSlidingWindow, SlidingWindow
+
+logger = cl.logger
+
+# Questions per user in QUESTION_USER_WINDOW seconds, 0 for no limit
+QUESTION_USER_LIMIT = int(os.getenv("QUESTION_USER_LIMIT", 5))
+QUESTION_USER_WINDOW = float(os.getenv("QUESTION_USER_WINDOW", 60))
+# Questions of all users in QUESTION_GLOBAL_WINDOW seconds
+QUESTION_GLOBAL_LIMIT = int(os.getenv("QUESTION_GLOBAL_LIMIT", 0))
+QUESTION_GLOBAL_WINDOW = float(os.getenv("QUESTION_GLOBAL_WINDOW", 60))
+# Shared limits for several bot processes, in-memory if empty
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+
+QUESTIONS_DROPPED = metrics.Counter(
+    "bot_questions_dropped_total",
+    "Questions rejected by flood protection by exceeded limit",
+    ("limit",),
+)
+
+
+def _limiter(name: str, limit: int, window: float):
+    if not limit:
+        return None
+    if RATE_LIMIT_REDIS_URL:
+        return RedisSlidingWindow(
+            RATE_LIMIT_REDIS_URL, f"questions:{name}", limit, window
+        )
+    return SlidingWindow(limit, window)
+
+
+user_limiter = _limiter("user", QUESTION_USER_LIMIT, QUESTION_USER_WINDOW)
+global_limiter = _limiter(
+    "global", QUESTION_GLOBAL_LIMIT, QUESTION_GLOBAL_WINDOW
+)
+# user id -> end of the cooldown the user was told about
+_cooldowns = TTLCache(
+    maxsize=10000, ttl=max(QUESTION_USER_WINDOW, QUESTION_GLOBAL_WINDOW)
+)
+
+
+async def _hit(limiter, key) -> float:
+    try:
+        return await limiter.hit(key)
+    except Exception:
+        # A broken shared store mustn't stop the intake
+        logger.exception("Failed to check question rate limit")
+        return 0.0
+
+
+async def allow(update: Update) -> bool:
+    """Check whether the sender of `update` may submit a question now
+
+    Files of an album after the first one aren't counted, the album is
+    one question. Admins aren't limited.
+
+    Args:
+        update (Update)
+
+    Returns:
+        bool: False if the question must be dropped
+    """
+    message = update.message
+    if message.media_group_id and message.media_group_id in media.albums:
+        return True
+    if db.is_admin(update.effective_user):
+        return True
+
+    user_id = update.effective_user.id
+    limit = None
+    retry_after = 0.0
+    if user_limiter is not None:
+        retry_after = await _hit(user_limiter, user_id)
+        limit = "user"
+    if not retry_after and global_limiter is not None:
+        retry_after = await _hit(global_limiter, "all")
+        limit = "global"
+    if not retry_after:
+        return True
+
+    QUESTIONS_DROPPED.inc(limit)
+    now = time.monotonic()
+    if _cooldowns.get(user_id, 0) < now:
+        _cooldowns.set(user_id, now + retry_after)
+        await message.reply_text(
+            constants.QUESTION_COOLDOWN_TEXT.format(
+                seconds=math.ceil(retry_after)
+            )
+        )
+    return False
@@ -1,5 +1,6 @@
 from telegram.ext import (
     Application,
+    ApplicationBuilder,
     CallbackQueryHandler,
     CommandHandler,
     ConversationHandler,
@@ -9,22 +10,79 @@ from telegram.ext import (
 from sqlalchemy.exc import PendingRollbackError
 import os
 import dotenv
-from db import Session
+
+# Settings of the modules below are read from env variables on import
+dotenv.load_dotenv()
+
+import db
 import custom_logging as cl
+import async_db as adb
+import block_buffer
 import bot
+import broadcast
+import concurrency
 import constants
-
-dotenv.load_dotenv()
+import digest
+import media
+import metrics
+import middleware
+import migrations
+import outbound
+import persistence
+import profiling
+import webhook
 
 logger = cl.logger
 
 
-def main():
-    application = Application.builder().token(os.getenv("API_TOKEN")).build()
+async def post_init(application: Application) -> None:
+    await metrics.start(application)
+    await profiling.start(application)
+    await adb.refresh_counters()
+    indexed = await adb.index_pending_questions()
+    logger.info(f"Indexed {indexed} pending questions for duplicates")
+    await block_buffer.buffer.start(application)
+    await broadcast.resume(application)
+    await digest.poster.start(application)
+
+
+async def post_shutdown(application: Application) -> None:
+    await media.albums.stop(application)
+    await block_buffer.buffer.stop(application)
+    await adb.shutdown(application)
+    await metrics.stop(application)
+    await profiling.stop(application)
 
-    admin_ids = set(
-        [int(user_id) for user_id in os.getenv("ADMIN_IDS").split(", ")]
+
+def build_application(builder: ApplicationBuilder | None = None):
+    """Build the application with all handlers registered
+
+    Args:
+        builder (ApplicationBuilder | None): Builder with custom settings,
+            e.g. another Bot API server. Defaults to one with `API_TOKEN`
+
+    Returns:
+        Application
+    """
+    if builder is None:
+        builder = Application.builder().token(os.getenv("API_TOKEN"))
+    if persistence.enabled():
+        builder.persistence(persistence.SQLPersistence())
+    application = (
+        builder.request(outbound.PriorityRequest())
+        .application_class(concurrency.ChatOrderedApplication)
+        .concurrent_updates(concurrency.MAX_QUEUED_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
     )
+    metrics.instrument_module(db)
+    # These send requests in background, stop them while the Bot API
+    # clients are open
+    application.on_stop(broadcast.shutdown)
+    application.on_stop(digest.poster.stop)
+
+    admin_ids = db.get_admin_ids()
 
     # Conversation handler
     ad_conversation_handler = ConversationHandler(
@@ -54,6 +112,8 @@ def main():
             ],
         },
         fallbacks=[CommandHandler("cancel", bot.cancel)],
+        name="ad",
+        persistent=persistence.enabled(),
     )
 
     application.add_handler(ad_conversation_handler)
@@ -101,11 +161,49 @@ def main():
         )
     )
 
+    application.add_handler(
+        CommandHandler(
+            "profile",
+            bot.profile,
+            filters.User(admin_ids),
+        )
+    )
+
+    application.add_handler(
+        CommandHandler(
+            "digest",
+            bot.send_digest,
+            filters.User(admin_ids),
+        )
+    )
+
+    application.add_handler(
+        CallbackQueryHandler(bot.digest_callback, pattern=r'^\{"digest"')
+    )
     application.add_handler(CallbackQueryHandler(bot.callback_handler))
 
+    middleware.wrap_handlers(application, profiling.profiler.wrap)
+    middleware.wrap_handlers(application, middleware.session_per_update)
+    middleware.wrap_handlers(application, metrics.instrument_handler)
+
     # Err handler
     application.add_error_handler(bot.error_handler)
-    application.run_polling()
+    return application
+
+
+def main():
+    pending = migrations.pending(db.init())
+    if pending:
+        versions = ", ".join(str(version) for version, _ in pending)
+        raise SystemExit(
+            f"Db schema is outdated, pending migrations: {versions}. "
+            "Apply them with `python migrations.py`"
+        )
+    application = build_application()
+    if os.getenv("BOT_MODE", "polling") == "webhook":
+        webhook.run(application)
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
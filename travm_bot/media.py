@@ -0,0 +1,71 @@
+import asyncio
+import os
+
+from telegram import Message
+
+import custom_logging as cl
+
+logger = cl.logger
+
+ALBUM_WAIT = float(os.getenv("ALBUM_WAIT", 1))
+# Telegram doesn't allow more files in one media group
+ALBUM_MAX_SIZE = 10
+
+
+class AlbumBuffer:
+    """Collects messages of media groups (albums)
+
+    Telegram delivers every file of an album as a separate message with
+    the same `media_group_id`. An album is handed over to its callback
+    once no new file has arrived for `wait` seconds.
+    """
+
+    def __init__(self, wait: float) -> None:
+        self.wait = wait
+        # media_group_id -> messages in the order they arrived
+        self._albums = {}
+        self._timers = {}
+
+    def add(self, message: Message, callback) -> None:
+        """Add `message` to its album
+
+        Args:
+            message (Message): Message with `media_group_id`
+            callback: Coroutine function called with the list of album
+                messages when the album is complete
+        """
+        key = message.media_group_id
+        messages = self._albums.setdefault(key, [])
+        messages.append(message)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        wait = 0 if len(messages) >= ALBUM_MAX_SIZE else self.wait
+        self._timers[key] = asyncio.create_task(
+            self._complete(key, callback, wait)
+        )
+
+    def __contains__(self, media_group_id: str) -> bool:
+        return media_group_id in self._albums
+
+    async def _complete(self, key: str, callback, wait: float) -> None:
+        await asyncio.sleep(wait)
+        self._timers.pop(key, None)
+        messages = self._albums.pop(key)
+        messages.sort(key=lambda message: message.message_id)
+        try:
+            await callback(messages)
+        except Exception:
+            logger.exception(f"Failed to handle album {key}")
+
+    async def stop(self, application=None) -> None:
+        """Drop incomplete albums, the bot can't answer them anymore"""
+        for timer in self._timers.values():
+            timer.cancel()
+        if self._albums:
+            logger.warning(f"Dropped {len(self._albums)} incomplete albums")
+        self._albums.clear()
+        self._timers.clear()
+
+
+albums = AlbumBuffer(ALBUM_WAIT)
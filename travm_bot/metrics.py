@@ -0,0 +1,393 @@
+"""Prometheus metrics of handlers, db queries and Bot API requests
+
+Metrics are kept in memory and rendered in the Prometheus text format by
+the `/metrics` endpoint of a small HTTP server started with the bot.
+"""
+
+import asyncio
+import functools
+import inspect
+import os
+import threading
+import time
+
+import httpx
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+
+import custom_logging as cl
+
+logger = cl.logger
+
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+_metrics = []
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    labels = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+    )
+    return "{" + labels + "}"
+
+
+def _escape(value) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, *labels, value: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames=(),
+        buckets=LATENCY_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket..., count of +Inf, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, *labels, value: float) -> None:
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [
+                (labels, list(series))
+                for labels, series in self._series.items()
+            ]
+        labelnames = self.labelnames + ("le",)
+        for labels, series in items:
+            count = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), series):
+                count += bucket
+                yield (
+                    f"{self.name}_bucket",
+                    _format_labels(labelnames, labels + (bound,)),
+                    count,
+                )
+            labels = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum", labels, series[-1]
+            yield f"{self.name}_count", labels, count
+
+
+class Gauge:
+    """Value read from the bot state when metrics are rendered
+
+    `collect` returns pairs of label values and the current value.
+    """
+
+    type = "gauge"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames=(), collect=None
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        _metrics.append(self)
+
+    def samples(self):
+        for labels, value in self.collect():
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+def render() -> str:
+    """Get all metrics in the Prometheus text format"""
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        try:
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        except Exception:
+            logger.exception(f"Failed to collect metric {metric.name}")
+    return "\n".join(lines) + "\n"
+
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_duration_seconds",
+    "Time spent in update handlers",
+    ("handler",),
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total",
+    "Update handlers that raised an exception",
+    ("handler",),
+)
+DB_LATENCY = Histogram(
+    "bot_db_query_duration_seconds",
+    "Time spent in db functions",
+    ("function",),
+)
+DB_ERRORS = Counter(
+    "bot_db_query_errors_total",
+    "Db functions that raised an exception",
+    ("function",),
+)
+API_LATENCY = Histogram(
+    "bot_api_request_duration_seconds",
+    "Time spent in Bot API requests",
+    ("method",),
+)
+API_RATE_WAIT = Histogram(
+    "bot_api_rate_wait_seconds",
+    "Time Bot API requests wait for the rate budget of their priority",
+    ("priority",),
+)
+API_ERRORS = Counter(
+    "bot_api_request_errors_total",
+    "Failed Bot API requests by status code, `network` for no response",
+    ("method", "code"),
+)
+
+UPDATE_WAIT = Histogram(
+    "bot_update_wait_seconds",
+    "Time updates wait for earlier updates of their chat and a free slot",
+)
+CHAT_QUEUE_TOP = 10
+
+_application = None
+_server = None
+
+
+def _collect_update_queue():
+    if _application is not None:
+        yield (), _application.update_queue.qsize()
+
+
+def _chat_queue_depths() -> dict:
+    depths = getattr(_application, "chat_queue_depths", None)
+    return depths() if depths else {}
+
+
+def _collect_busy_chats():
+    if _application is not None:
+        yield (), len(_chat_queue_depths())
+
+
+def _collect_chat_queues():
+    depths = sorted(
+        _chat_queue_depths().items(), key=lambda item: item[1], reverse=True
+    )
+    for chat_id, depth in depths[:CHAT_QUEUE_TOP]:
+        yield (chat_id,), depth
+
+
+UPDATE_QUEUE_SIZE = Gauge(
+    "bot_update_queue_size",
+    "Updates waiting to be processed",
+    collect=_collect_update_queue,
+)
+BUSY_CHATS = Gauge(
+    "bot_busy_chats",
+    "Chats with updates queued or being processed",
+    collect=_collect_busy_chats,
+)
+CHAT_QUEUE_DEPTH = Gauge(
+    "bot_chat_queue_depth",
+    f"Queued and running updates of the {CHAT_QUEUE_TOP} busiest chats",
+    ("chat_id",),
+    collect=_collect_chat_queues,
+)
+
+
+def instrument_handler(callback):
+    """Record latency and errors of handler `callback`
+
+    Used with `middleware.wrap_handlers`.
+    """
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(name, value=time.perf_counter() - started)
+
+    return wrapper
+
+
+def instrument_module(module) -> None:
+    """Replace public functions of `module` with timed wrappers
+
+    Callers must look the functions up on the module at call time, as
+    `async_db` does.
+    """
+    for name, func in list(vars(module).items()):
+        if (
+            name.startswith("_")
+            or not inspect.isfunction(func)
+            or func.__module__ != module.__name__
+            or getattr(func, "__instrumented__", False)
+        ):
+            continue
+        setattr(module, name, _timed(func))
+
+
+def _timed(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(name)
+            raise
+        finally:
+            DB_LATENCY.observe(name, value=time.perf_counter() - started)
+
+    wrapper.__instrumented__ = True
+    return wrapper
+
+
+@functools.cache
+def _ssl_context():
+    # Loading CA certificates takes tens of ms, the priority pools share
+    # them instead of loading them once per client
+    return httpx.create_ssl_context()
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """`HTTPXRequest` recording latency and errors of every Bot API call"""
+
+    def _build_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(verify=_ssl_context(), **self._client_kwargs)
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(
+                url, method, *args, **kwargs
+            )
+        except Exception:
+            API_ERRORS.inc(endpoint, "network")
+            raise
+        finally:
+            API_LATENCY.observe(endpoint, value=time.perf_counter() - started)
+        if code >= 400:
+            API_ERRORS.inc(endpoint, str(code))
+        return code, payload
+
+
+async def _handle(reader, writer) -> None:
+    try:
+        request_line = await reader.readline()
+        # Skip headers
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.split()
+        if (
+            len(parts) >= 2
+            and parts[0] == b"GET"
+            and parts[1].split(b"?")[0] == b"/metrics"
+        ):
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b""
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start(application: Application) -> None:
+    """Serve `/metrics` on `METRICS_PORT` if it is set
+
+    Used in `post_init` of the application.
+    """
+    global _application, _server
+    _application = application
+    if not METRICS_PORT:
+        return
+    _server = await asyncio.start_server(_handle, METRICS_LISTEN, METRICS_PORT)
+    logger.info(f"Serving metrics on {METRICS_LISTEN}:{METRICS_PORT}")
+
+
+async def stop(application: Application) -> None:
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
@@ -0,0 +1,37 @@
+import functools
+
+from telegram.ext import Application, BaseHandler, ConversationHandler
+
+import async_db as adb
+
+
+def wrap_handlers(application: Application, decorator) -> None:
+    """Replace callbacks of all registered handlers with `decorator(callback)`
+
+    Handlers nested in conversation handlers are wrapped as well.
+    """
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _wrap_handler(handler, decorator)
+
+
+def _wrap_handler(handler: BaseHandler, decorator) -> None:
+    if isinstance(handler, ConversationHandler):
+        nested = handler.entry_points + handler.fallbacks
+        for state_handlers in handler.states.values():
+            nested += state_handlers
+        for nested_handler in nested:
+            _wrap_handler(nested_handler, decorator)
+    else:
+        handler.callback = decorator(handler.callback)
+
+
+def session_per_update(callback):
+    """Run `callback` in its own db unit of work"""
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        async with adb.unit_of_work():
+            return await callback(update, context)
+
+    return wrapper
@@ -0,0 +1,236 @@
+"""Versioned schema migrations
+
+Migrations are applied explicitly at deploy time, from the `travm_bot`
+directory:
+
+    python migrations.py           # apply pending migrations
+    python migrations.py status    # show applied and pending migrations
+
+Applied versions are recorded in the `schema_migrations` table. Earlier
+versions of the bot created tables on import, so a migration first checks
+what already exists and only adds what is missing.
+"""
+
+import argparse
+import datetime
+
+import dotenv
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    inspect,
+    select,
+    update,
+)
+from sqlalchemy.dialects import mysql
+from sqlalchemy.schema import CreateColumn
+
+import custom_logging as cl
+import db
+from models import Base, BroadcastUnsent, Question
+
+logger = cl.logger
+
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("name", String(64), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+# (version, name, function applying the migration to a connection)
+MIGRATIONS = []
+
+
+def migration(version: int, name: str):
+    """Register the decorated function as migration `version`"""
+
+    def decorator(func):
+        MIGRATIONS.append((version, name, func))
+        return func
+
+    return decorator
+
+
+def _add_column(connection, table: str, column: Column) -> None:
+    columns = inspect(connection).get_columns(table)
+    if any(existing["name"] == column.name for existing in columns):
+        return
+    ddl = CreateColumn(column).compile(dialect=connection.dialect)
+    connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {ddl}")
+
+
+def _create_index(connection, name: str, table: str, *columns: str):
+    # An index starting with the same columns serves the same queries,
+    # e.g. the one MySQL creates for a foreign key
+    for index in inspect(connection).get_indexes(table):
+        if index["column_names"][: len(columns)] == list(columns):
+            return
+    table = Table(table, MetaData(), autoload_with=connection)
+    Index(name, *(table.c[column] for column in columns)).create(connection)
+
+
+@migration(1, "create tables")
+def _create_tables(connection) -> None:
+    # Missing tables are created as the models define them now, the
+    # following migrations skip what they already have
+    Base.metadata.create_all(connection)
+
+
+@migration(2, "users last_seen")
+def _users_last_seen(connection) -> None:
+    _add_column(
+        connection,
+        "users",
+        Column(
+            "last_seen",
+            DateTime(True).with_variant(mysql.DATETIME(fsp=6), "mysql"),
+        ),
+    )
+
+
+@migration(3, "question file ids")
+def _question_file_ids(connection) -> None:
+    # Old questions with `attachment_path` are handled by migration 7
+    _add_column(connection, "questions", Column("file_id", String(255)))
+    _add_column(connection, "questions", Column("file_unique_id", String(64)))
+    _add_column(connection, "questions", Column("media_type", String(16)))
+
+
+@migration(4, "question duplicates")
+def _question_duplicates(connection) -> None:
+    _add_column(
+        connection,
+        "questions",
+        Column("duplicates", Integer, nullable=False, server_default="0"),
+    )
+
+
+@migration(5, "broadcast source message")
+def _broadcast_source_message(connection) -> None:
+    _add_column(
+        connection,
+        "broadcast_jobs",
+        Column("source_message_id", BigInteger),
+    )
+
+
+@migration(6, "users and questions indexes")
+def _indexes(connection) -> None:
+    _create_index(
+        connection,
+        "ix_users_is_admin_is_blocked_tg_id",
+        "users",
+        "is_admin",
+        "is_blocked",
+        "tg_id",
+    )
+    _create_index(connection, "ix_users_is_blocked", "users", "is_blocked")
+    _create_index(connection, "ix_questions_owner_id", "questions", "owner_id")
+
+
+@migration(7, "old question attachments")
+def _old_question_attachments(connection) -> None:
+    # Questions saved before file ids only have the download link of
+    # their file. It expired long ago and contains the bot token, so it
+    # is dropped and the file is marked as unavailable.
+    columns = inspect(connection).get_columns("questions")
+    if not any(column["name"] == "attachment_path" for column in columns):
+        return
+    questions = Table("questions", MetaData(), autoload_with=connection)
+    path = questions.c.attachment_path
+    connection.execute(
+        update(questions)
+        .where(path.is_not(None), questions.c.file_id.is_(None))
+        .values(media_type=Question.UNAVAILABLE)
+    )
+    connection.execute(
+        update(questions).where(path.is_not(None)).values(attachment_path=None)
+    )
+
+
+@migration(8, "broadcast unsent recipients")
+def _broadcast_unsent(connection) -> None:
+    BroadcastUnsent.__table__.create(connection, checkfirst=True)
+
+
+@migration(9, "album message ids")
+def _album_message_ids(connection) -> None:
+    _add_column(
+        connection, "question_attachments", Column("message_id", BigInteger)
+    )
+
+
+def applied(engine) -> dict[int, datetime.datetime]:
+    """Get applied migration versions and when they were applied"""
+    with engine.begin() as connection:
+        schema_migrations.create(connection, checkfirst=True)
+        rows = connection.execute(
+            select(schema_migrations.c.version, schema_migrations.c.applied_at)
+        )
+        return {version: applied_at for version, applied_at in rows}
+
+
+def pending(engine) -> list[tuple[int, str]]:
+    """Get (version, name) of migrations not applied yet"""
+    done = applied(engine)
+    return [
+        (version, name)
+        for version, name, _ in sorted(MIGRATIONS)
+        if version not in done
+    ]
+
+
+def upgrade(engine) -> list[tuple[int, str]]:
+    """Apply pending migrations in order, each in its own transaction
+
+    Returns:
+        list[tuple[int, str]]: Applied migrations
+    """
+    done = applied(engine)
+    result = []
+    for version, name, func in sorted(MIGRATIONS):
+        if version in done:
+            continue
+        with engine.begin() as connection:
+            func(connection)
+            connection.execute(
+                schema_migrations.insert().values(
+                    version=version,
+                    name=name,
+                    applied_at=datetime.datetime.now(),
+                )
+            )
+        logger.info(f"Applied migration {version}: {name}")
+        result.append((version, name))
+    return result
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Migrate the bot db")
+    parser.add_argument(
+        "command", nargs="?", choices=("upgrade", "status"), default="upgrade"
+    )
+    args = parser.parse_args(argv)
+    dotenv.load_dotenv()
+    engine = db.init()
+
+    if args.command == "status":
+        done = applied(engine)
+        for version, name, _ in sorted(MIGRATIONS):
+            state = done[version] if version in done else "pending"
+            print(f"{version:>4}  {name:<32}{state}")
+        return
+    applied_now = upgrade(engine)
+    print(f"Applied {len(applied_now)} migrations")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,22 +3,43 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
+    Integer,
     String,
     BigInteger,
+    Text,
 )
+from sqlalchemy.dialects import mysql
 from sqlalchemy.orm import declarative_base
+from dataclasses import dataclass
 
 Base = declarative_base()
 
+# SQLite only autoincrements INTEGER primary keys
+AutoIncrementId = BigInteger().with_variant(Integer, "sqlite")
+
+
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        # Broadcast recipients are scanned in tg_id order
+        Index(
+            "ix_users_is_admin_is_blocked_tg_id",
+            "is_admin",
+            "is_blocked",
+            "tg_id",
+        ),
+    )
 
     tg_id = Column(BigInteger, unique=True, primary_key=True)
     fullname = Column(String(130))
     username = Column(String(35))
     first_start = Column(DateTime(True))
     is_admin = Column(Boolean(False))
-    is_blocked = Column(Boolean(False))
+    is_blocked = Column(Boolean(False), index=True)
+    last_seen = Column(
+        DateTime(True).with_variant(mysql.DATETIME(fsp=6), "mysql")
+    )
 
     def __init__(
         self,
@@ -46,21 +67,220 @@ class User(Base):
         )
 
 
+@dataclass(frozen=True)
+class UserRecord:
+    """Compact copy of `User` row kept in the user cache"""
+
+    tg_id: int
+    fullname: str | None
+    username: str | None
+    is_admin: bool
+    is_blocked: bool
+
+    @classmethod
+    def from_user(cls, user: User) -> "UserRecord":
+        return cls(
+            tg_id=user.tg_id,
+            fullname=user.fullname,
+            username=user.username,
+            is_admin=user.is_admin,
+            is_blocked=user.is_blocked,
+        )
+
+
 class Question(Base):
     __tablename__ = "questions"
-    question_id = Column(BigInteger, unique=True, primary_key=True)
-    owner_id = Column(BigInteger, ForeignKey("users.tg_id"))
-    attachment_path = Column(String(255))
+    question_id = Column(AutoIncrementId, unique=True, primary_key=True)
+    owner_id = Column(BigInteger, ForeignKey("users.tg_id"), index=True)
+    # Attachment is kept as Telegram file id, it can be sent again any
+    # time and its download path is resolved only when needed
+    file_id = Column(String(255))
+    file_unique_id = Column(String(64))
+    media_type = Column(String(16))
     text = Column(String(255))
+    # Near-duplicates folded into this question
+    duplicates = Column(Integer, nullable=False, default=0)
+
+    PHOTO = "photo"
+    VIDEO = "video"
+    # Files of an album are kept in `QuestionAttachment`
+    ALBUM = "album"
+    # Saved before file ids, only with a download link that has expired
+    UNAVAILABLE = "unavailable"
 
-    def __init__(self, owner_id, attachment_path, text):
+    def __init__(
+        self,
+        owner_id,
+        text,
+        file_id=None,
+        file_unique_id=None,
+        media_type=None,
+    ):
         self.owner_id = owner_id
-        self.attachment_path = attachment_path
         self.text = text
+        self.file_id = file_id
+        self.file_unique_id = file_unique_id
+        self.media_type = media_type
+        self.duplicates = 0
 
     def __repr__(self):
         return (
             f"<Question(question_id={self.question_id}, "
             f"owner_id={self.owner_id}, "
-            f"attachment_filename={self.attachment_path}, text={self.text}>"
+            f"media_type={self.media_type}, "
+            f"file_unique_id={self.file_unique_id}, text={self.text}>"
+        )
+
+
+class QuestionAttachment(Base):
+    """File of an album question, in the order of the album"""
+
+    __tablename__ = "question_attachments"
+
+    attachment_id = Column(AutoIncrementId, primary_key=True)
+    question_id = Column(
+        BigInteger, ForeignKey("questions.question_id"), index=True
+    )
+    position = Column(Integer)
+    file_id = Column(String(255))
+    file_unique_id = Column(String(64))
+    media_type = Column(String(16))
+    # Message of the file in the moderator chat, deleted on moderation
+    message_id = Column(BigInteger)
+
+    def __init__(
+        self, file_id: str, file_unique_id: str, media_type: str
+    ) -> None:
+        self.file_id = file_id
+        self.file_unique_id = file_unique_id
+        self.media_type = media_type
+
+    def __repr__(self) -> str:
+        return (
+            f"<QuestionAttachment(question_id={self.question_id!r}, "
+            f"position={self.position!r}, "
+            f"media_type={self.media_type!r})>"
+        )
+
+
+class BroadcastJob(Base):
+    __tablename__ = "broadcast_jobs"
+
+    RUNNING = "running"
+    FINISHED = "finished"
+
+    job_id = Column(AutoIncrementId, unique=True, primary_key=True)
+    admin_id = Column(BigInteger)
+    progress_message_id = Column(BigInteger)
+    post = Column(Text)
+    status = Column(String(16))
+    cursor = Column(BigInteger)
+    sent = Column(Integer)
+    blocked = Column(Integer)
+    failed = Column(Integer)
+    created_at = Column(DateTime(True))
+    updated_at = Column(DateTime(True))
+    # Message with the post sent to the admin and copied to recipients
+    source_message_id = Column(BigInteger)
+
+    def __init__(
+        self,
+        admin_id: int,
+        progress_message_id: int,
+        post: str,
+        created_at,
+    ) -> None:
+        self.admin_id = admin_id
+        self.progress_message_id = progress_message_id
+        self.post = post
+        self.status = self.RUNNING
+        self.cursor = 0
+        self.sent = 0
+        self.blocked = 0
+        self.failed = 0
+        self.created_at = created_at
+        self.updated_at = created_at
+
+    def __repr__(self) -> str:
+        return (
+            f"<BroadcastJob(job_id={self.job_id!r}, "
+            f"status={self.status!r}, "
+            f"cursor={self.cursor!r}, "
+            f"sent={self.sent!r}, "
+            f"blocked={self.blocked!r}, "
+            f"failed={self.failed!r})>"
+        )
+
+
+class BroadcastUnsent(Base):
+    """Recipient a broadcast couldn't reach because of a network error
+
+    The cursor of the job moves past them, they are retried at the end of
+    the broadcast.
+    """
+
+    __tablename__ = "broadcast_unsent"
+
+    job_id = Column(BigInteger, primary_key=True)
+    tg_id = Column(BigInteger, primary_key=True)
+
+    def __init__(self, job_id: int, tg_id: int) -> None:
+        self.job_id = job_id
+        self.tg_id = tg_id
+
+    def __repr__(self) -> str:
+        return (
+            f"<BroadcastUnsent(job_id={self.job_id!r}, "
+            f"tg_id={self.tg_id!r})>"
+        )
+
+
+class Counter(Base):
+    """Statistics counter kept up to date by the db layer
+
+    Daily counters are stored as `<name>:<YYYY-MM-DD>`.
+    """
+
+    __tablename__ = "counters"
+
+    name = Column(String(64), primary_key=True)
+    value = Column(BigInteger, nullable=False)
+
+    def __init__(self, name: str, value: int) -> None:
+        self.name = name
+        self.value = value
+
+    def __repr__(self) -> str:
+        return f"<Counter(name={self.name!r}, value={self.value!r})>"
+
+
+class PersistentData(Base):
+    """user_data, chat_data or conversation state shared by bot processes
+
+    A process handling an update of the row's user or chat holds a lock
+    on the row until `locked_until`.
+    """
+
+    __tablename__ = "persistent_data"
+
+    USER = "user"
+    CHAT = "chat"
+    # Followed by the name of the conversation handler
+    CONVERSATION = "conversation:"
+
+    kind = Column(String(64), primary_key=True)
+    key = Column(String(64), primary_key=True)
+    data = Column(Text, nullable=False)
+    locked_by = Column(String(32))
+    locked_until = Column(DateTime(True))
+
+    def __init__(self, kind: str, key: str, data: str) -> None:
+        self.kind = kind
+        self.key = key
+        self.data = data
+
+    def __repr__(self) -> str:
+        return (
+            f"<PersistentData(kind={self.kind!r}, key={self.key!r}, "
+            f"locked_by={self.locked_by!r})>"
         )
@@ -0,0 +1,124 @@
+"""Priority classes of outgoing Bot API requests
+
+Every request belongs to one of the classes below, chosen by the
+`request_priority` context variable of the caller. Each class has its own
+connection pool and rate budget, so a running broadcast can't take the
+connections or the rate limit needed by replies to users.
+"""
+
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import time
+
+from telegram.request import BaseRequest
+
+import metrics
+from rate_limit import TokenBucket
+
+# Replies to users, the default
+INTERACTIVE = "interactive"
+# Questions sent to moderators and their answers
+MODERATION = "moderation"
+# Broadcasts
+BULK = "bulk"
+
+PRIORITIES = (INTERACTIVE, MODERATION, BULK)
+
+request_priority = contextvars.ContextVar(
+    "request_priority", default=INTERACTIVE
+)
+
+
+def _setting(name: str, priority: str, default):
+    value = os.getenv(f"REQUEST_{name}_{priority.upper()}")
+    return type(default)(value) if value else default
+
+
+# priority -> (connection pool size, requests per second, 0 for no limit)
+REQUEST_CLASSES = {
+    INTERACTIVE: (
+        _setting("POOL", INTERACTIVE, 128),
+        _setting("RATE", INTERACTIVE, 0.0),
+    ),
+    MODERATION: (
+        _setting("POOL", MODERATION, 32),
+        _setting("RATE", MODERATION, 0.0),
+    ),
+    BULK: (_setting("POOL", BULK, 32), _setting("RATE", BULK, 25.0)),
+}
+
+
+@contextlib.contextmanager
+def priority(name: str):
+    """Send requests made inside the block with priority `name`"""
+    token = request_priority.set(name)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+def with_priority(name: str):
+    """Send requests made by the decorated coroutine with priority `name`"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with priority(name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _retry_after(payload: bytes) -> float:
+    try:
+        return float(json.loads(payload)["parameters"]["retry_after"])
+    except (ValueError, TypeError, KeyError):
+        return 1.0
+
+
+class PriorityRequest(BaseRequest):
+    """Request dispatching every call to the pool of its priority class
+
+    Args:
+        classes (dict): Priority -> (connection pool size, rate limit)
+    """
+
+    def __init__(self, classes: dict = REQUEST_CLASSES) -> None:
+        self._requests = {}
+        self._buckets = {}
+        for name, (pool_size, rate) in classes.items():
+            self._requests[name] = metrics.InstrumentedRequest(
+                connection_pool_size=pool_size
+            )
+            self._buckets[name] = TokenBucket(rate) if rate else None
+
+    async def initialize(self) -> None:
+        for request in self._requests.values():
+            await request.initialize()
+
+    async def shutdown(self) -> None:
+        for request in self._requests.values():
+            await request.shutdown()
+
+    async def do_request(self, *args, **kwargs):
+        name = request_priority.get()
+        if name not in self._requests:
+            name = INTERACTIVE
+        bucket = self._buckets[name]
+        if bucket is not None:
+            started = time.perf_counter()
+            await bucket.acquire()
+            metrics.API_RATE_WAIT.observe(
+                name, value=time.perf_counter() - started
+            )
+        code, payload = await self._requests[name].do_request(*args, **kwargs)
+        if code == 429 and bucket is not None:
+            # Flood limit, the whole class waits before sending again
+            bucket.pause(_retry_after(payload))
+        return code, payload
@@ -0,0 +1,344 @@
+"""Conversation states, user_data and chat_data shared by bot processes
+
+With `PERSISTENCE=sql` the state is kept in the `persistent_data` table,
+so updates of one user may be handled by any of several bot processes,
+e.g. behind a webhook load balancer.
+
+While a process handles an update, it holds a lock on the rows of the
+update's user, chat and conversations, and loads the rows changed by
+other processes. The lock is renewed while the update is processed, so
+slow handlers keep it. Within the process, updates sharing a row wait
+for each other. Changes are written before the lock is released.
+Concurrent updates write their changes in one transaction, data that
+didn't change and empty data of users who never had any aren't written
+at all.
+"""
+
+import asyncio
+import contextlib
+import json
+import os
+import random
+import uuid
+
+from telegram import Update
+from telegram.ext import (
+    Application,
+    BasePersistence,
+    ConversationHandler,
+    PersistenceInput,
+)
+
+import async_db as adb
+import custom_logging as cl
+from models import PersistentData
+
+logger = cl.logger
+
+PERSISTENCE = os.getenv("PERSISTENCE", "")
+# Lock of a process that died is taken over after this many seconds,
+# live processes renew their locks three times per timeout
+PERSISTENCE_LOCK_TIMEOUT = float(os.getenv("PERSISTENCE_LOCK_TIMEOUT", 30))
+# Changes of non-blocking handlers are written in this interval
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", 5))
+
+
+def enabled() -> bool:
+    return PERSISTENCE == "sql"
+
+
+def _conversation_key(handler: ConversationHandler, update: Update):
+    """Build key of `update` in `handler` like `ConversationHandler` does
+
+    Returns None for per message conversations, their states aren't
+    shared.
+    """
+    if handler.per_message:
+        return None
+    key = []
+    if handler.per_chat:
+        if update.effective_chat is None:
+            return None
+        key.append(update.effective_chat.id)
+    if handler.per_user:
+        if update.effective_user is None:
+            return None
+        key.append(update.effective_user.id)
+    return tuple(key)
+
+
+class SQLPersistence(BasePersistence):
+    """Persistence shared by bot processes through the db
+
+    Nothing is loaded on startup, state of a user or chat is loaded when
+    their update is handled. Data must be JSON serializable.
+    """
+
+    def __init__(
+        self, update_interval: float = PERSISTENCE_FLUSH_INTERVAL
+    ) -> None:
+        super().__init__(
+            PersistenceInput(bot_data=False, callback_data=False),
+            update_interval,
+        )
+        self.owner = uuid.uuid4().hex
+        # (kind, key) -> data last read from or written to the db
+        self._known = {}
+        # Keys whose data in the db differs from the data in memory
+        self._stale = set()
+        # (kind, key) -> data to write, None to delete
+        self._pending = {}
+        self._flush_lock = asyncio.Lock()
+        # (kind, key) -> [lock, updates holding or waiting for it]. The db
+        # lease belongs to the process, these keep two updates of this
+        # process from using a row at the same time.
+        self._local_locks = {}
+
+    def _change(self, key: tuple[str, str], data: str | None) -> None:
+        # Data in memory wasn't refreshed, so no handler changed it
+        if key in self._stale or self._known.get(key) == data:
+            return
+        if data is None:
+            self._known.pop(key, None)
+        else:
+            self._known[key] = data
+        self._pending[key] = data
+
+    @staticmethod
+    def _dumps(data) -> str | None:
+        # Empty data is the same as no data
+        if not data:
+            return None
+        return json.dumps(data, ensure_ascii=False, sort_keys=True)
+
+    def _refresh(self, key: tuple[str, str], data: dict) -> None:
+        if key not in self._stale:
+            return
+        self._stale.discard(key)
+        data.clear()
+        if key in self._known:
+            data.update(json.loads(self._known[key]))
+
+    def _persistent_conversations(self, application: Application):
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler) and (
+                    handler.persistent
+                ):
+                    yield handler
+
+    def _keys(self, application: Application, update: Update):
+        """Get (kind, key) of all rows of `update`"""
+        keys = []
+        if update.effective_user:
+            keys.append((PersistentData.USER, str(update.effective_user.id)))
+        if update.effective_chat:
+            keys.append((PersistentData.CHAT, str(update.effective_chat.id)))
+        for handler in self._persistent_conversations(application):
+            key = _conversation_key(handler, update)
+            if key is not None:
+                keys.append(
+                    (
+                        PersistentData.CONVERSATION + handler.name,
+                        json.dumps(key),
+                    )
+                )
+        return keys
+
+    async def _lock(self, keys: list) -> list:
+        """Wait for the lock on rows of `keys` and load them
+
+        Returns:
+            list: Keys of the locked rows
+        """
+        delay = 0.01
+        while True:
+            rows = await adb.lock_persistent_data(
+                keys, self.owner, PERSISTENCE_LOCK_TIMEOUT
+            )
+            if rows is not None:
+                break
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, 1)
+        for key in keys:
+            data = rows.get(key)
+            if self._known.get(key) != data:
+                if data is None:
+                    self._known.pop(key, None)
+                else:
+                    self._known[key] = data
+                self._stale.add(key)
+        return list(rows)
+
+    async def _renew(self, keys: list) -> None:
+        """Renew the lock on rows of `keys` until cancelled"""
+        while True:
+            await asyncio.sleep(PERSISTENCE_LOCK_TIMEOUT / 3)
+            try:
+                renewed = await adb.renew_persistent_data_lock(
+                    keys, self.owner, PERSISTENCE_LOCK_TIMEOUT
+                )
+            except Exception:
+                logger.exception("Failed to renew persistent data lock")
+                continue
+            if renewed < len(keys):
+                logger.error(
+                    "Lock on persistent data was taken over by another "
+                    "process, its changes may be overwritten"
+                )
+
+    @contextlib.asynccontextmanager
+    async def _hold_locally(self, keys: list):
+        """Hold rows of `keys` against other updates of this process
+
+        Locks are taken in sorted order, so updates sharing some of the
+        rows can't deadlock.
+        """
+        states = []
+        for key in sorted(set(keys)):
+            state = self._local_locks.setdefault(key, [asyncio.Lock(), 0])
+            state[1] += 1
+            states.append((key, state))
+        acquired = []
+        try:
+            for _, state in states:
+                await state[0].acquire()
+                acquired.append(state[0])
+            yield
+        finally:
+            for lock in acquired:
+                lock.release()
+            for key, state in states:
+                state[1] -= 1
+                if not state[1]:
+                    del self._local_locks[key]
+
+    def _load_conversations(self, application: Application, update: Update):
+        # ConversationHandler checks updates against its own states before
+        # any persistence method is called, so they are replaced here
+        for handler in self._persistent_conversations(application):
+            key = _conversation_key(handler, update)
+            if key is None:
+                continue
+            row_key = (
+                PersistentData.CONVERSATION + handler.name,
+                json.dumps(key),
+            )
+            if row_key not in self._stale:
+                continue
+            self._stale.discard(row_key)
+            # PTB has no public way to replace states of a running
+            # handler, `_conversations` is the TrackingDict of PTB 20.0
+            # the version is pinned to
+            if row_key in self._known:
+                handler._conversations.update_no_track(
+                    {key: json.loads(self._known[row_key])}
+                )
+            else:
+                handler._conversations.pop(key, None)
+
+    @contextlib.asynccontextmanager
+    async def shared(self, application: Application, update: object):
+        """Hold state of `update` while it is processed
+
+        Args:
+            application (Application)
+            update (object): Update being processed
+        """
+        if not isinstance(update, Update):
+            yield
+            return
+        keys = self._keys(application, update)
+        async with self._hold_locally(keys):
+            locked = []
+            if keys:
+                try:
+                    locked = await self._lock(keys)
+                    self._load_conversations(application, update)
+                except Exception:
+                    logger.exception("Failed to load persistent data")
+            renewer = None
+            if locked:
+                renewer = asyncio.create_task(self._renew(locked))
+            try:
+                yield
+            finally:
+                if renewer is not None:
+                    renewer.cancel()
+                    await asyncio.gather(renewer, return_exceptions=True)
+                # Unsaved changes keep the rows locked until the lock
+                # expires
+                try:
+                    await application.update_persistence()
+                    await self.flush()
+                    if locked:
+                        await adb.unlock_persistent_data(locked, self.owner)
+                except Exception:
+                    logger.exception("Failed to save persistent data")
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(
+        self, name: str, key: tuple, new_state
+    ) -> None:
+        self._change(
+            (PersistentData.CONVERSATION + name, json.dumps(key)),
+            None if new_state is None else json.dumps(new_state),
+        )
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._change((PersistentData.USER, str(user_id)), self._dumps(data))
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._change((PersistentData.CHAT, str(chat_id)), self._dumps(data))
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._change((PersistentData.USER, str(user_id)), None)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._change((PersistentData.CHAT, str(chat_id)), None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        self._refresh((PersistentData.USER, str(user_id)), user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        self._refresh((PersistentData.CHAT, str(chat_id)), chat_data)
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Write all pending changes in one transaction
+
+        Changes made while a write is running are written by the next
+        caller, so concurrent updates share transactions.
+        """
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            changes, self._pending = self._pending, {}
+            try:
+                await adb.save_persistent_data(changes)
+            except Exception:
+                # Retry with the next flush unless changed again
+                self._pending = {**changes, **self._pending}
+                raise
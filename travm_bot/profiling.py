@@ -0,0 +1,200 @@
+"""Sampling profiler of update handlers
+
+A share of handler calls is watched by a background thread that records
+the stack of every watched call each `PROFILE_INTERVAL` seconds: the
+running stack if the handler is on the event loop at that moment,
+otherwise the chain of awaits it is suspended in (ending with e.g.
+`<Future>` while waiting for the db or Telegram). Stacks are aggregated
+per handler and written every `PROFILE_DUMP_INTERVAL` seconds in the
+collapsed format read by flamegraph.pl and speedscope.
+
+When profiling is off the only cost is one check per handler call.
+"""
+
+import collections
+import datetime
+import functools
+import os
+import random
+import sys
+import threading
+import time
+
+import custom_logging as cl
+
+logger = cl.logger
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE") or 0)
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))
+PROFILE_DUMP_INTERVAL = float(os.getenv("PROFILE_DUMP_INTERVAL", 60))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+
+def _label(frame) -> str:
+    code = frame.f_code
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+class Profiler:
+    """Samples stacks of watched handler calls in a background thread"""
+
+    def __init__(
+        self, interval: float, dump_interval: float, directory: str
+    ) -> None:
+        self.interval = interval
+        self.dump_interval = dump_interval
+        self.directory = directory
+        self.sample_rate = 0.0
+        # Coroutine of a watched call -> handler name
+        self._watched = {}
+        # (handler name, collapsed stack) -> number of samples
+        self._stacks = collections.Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._loop_thread_id = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+    def enable(self, sample_rate: float) -> None:
+        """Start watching `sample_rate` share of handler calls
+
+        Must be called from the thread of the event loop.
+
+        Args:
+            sample_rate (float): From 0 to 1
+        """
+        self.sample_rate = sample_rate
+        if self._thread is None:
+            self._loop_thread_id = threading.get_ident()
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="profiler", daemon=True
+            )
+            self._thread.start()
+        logger.info(f"Profiling {sample_rate:.0%} of handler calls")
+
+    def disable(self) -> None:
+        """Stop sampling and dump what was collected"""
+        self.sample_rate = 0.0
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            logger.info("Profiling stopped")
+
+    def wrap(self, callback):
+        """Watch a share of calls of handler `callback`
+
+        Used with `middleware.wrap_handlers`.
+        """
+        name = callback.__name__
+
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            if not self.sample_rate or random.random() >= self.sample_rate:
+                return await callback(update, context)
+            coro = callback(update, context)
+            self._watched[coro] = name
+            try:
+                return await coro
+            finally:
+                self._watched.pop(coro, None)
+
+        return wrapper
+
+    def dump(self) -> list[str]:
+        """Write stacks sampled since the previous dump
+
+        One file is written per handler and one with all handlers.
+
+        Returns:
+            list[str]: Paths of written files
+        """
+        with self._lock:
+            stacks, self._stacks = self._stacks, collections.Counter()
+        if not stacks:
+            return []
+        lines = collections.defaultdict(list)
+        for (name, stack), count in stacks.items():
+            lines[name].append(f"{stack} {count}")
+            lines["all"].append(f"{name};{stack} {count}")
+
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        paths = []
+        for name, handler_lines in lines.items():
+            path = os.path.join(self.directory, f"{stamp}-{name}.collapsed")
+            with open(path, "w") as f:
+                f.write("\n".join(sorted(handler_lines)) + "\n")
+            paths.append(path)
+        logger.info(f"Profiles written to {self.directory}")
+        return paths
+
+    def _run(self) -> None:
+        dumped_at = time.monotonic()
+        while not self._stop.wait(self.interval):
+            try:
+                self._sample()
+            except Exception:
+                logger.exception("Profiler failed to take a sample")
+            if time.monotonic() - dumped_at >= self.dump_interval:
+                self.dump()
+                dumped_at = time.monotonic()
+        self.dump()
+
+    def _sample(self) -> None:
+        watched = list(self._watched.items())
+        if not watched:
+            return
+        running = []
+        frame = sys._current_frames().get(self._loop_thread_id)
+        while frame is not None:
+            running.append(frame)
+            frame = frame.f_back
+        running.reverse()
+        with self._lock:
+            for coro, name in watched:
+                stack = self._stack(coro, running)
+                if stack:
+                    self._stacks[(name, stack)] += 1
+
+    def _stack(self, coro, running: list) -> str | None:
+        frame = coro.cr_frame
+        if frame is None:
+            # Finished between taking the list of calls and the sample
+            return None
+        for i, running_frame in enumerate(running):
+            if running_frame is frame:
+                return ";".join(_label(frame) for frame in running[i:])
+
+        labels = []
+        awaitable = coro
+        while awaitable is not None:
+            frame = getattr(awaitable, "cr_frame", None) or getattr(
+                awaitable, "gi_frame", None
+            )
+            if frame is None:
+                labels.append(f"<{type(awaitable).__name__}>")
+                break
+            labels.append(_label(frame))
+            awaitable = getattr(awaitable, "cr_await", None) or getattr(
+                awaitable, "gi_yieldfrom", None
+            )
+        return ";".join(labels)
+
+
+profiler = Profiler(PROFILE_INTERVAL, PROFILE_DUMP_INTERVAL, PROFILE_DIR)
+
+
+async def start(application=None) -> None:
+    """Enable profiling if `PROFILE_SAMPLE_RATE` is set"""
+    if PROFILE_SAMPLE_RATE:
+        profiler.enable(PROFILE_SAMPLE_RATE)
+
+
+async def stop(application=None) -> None:
+    profiler.disable()
@@ -0,0 +1,133 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict, deque
+
+
+class TokenBucket:
+    """Rate limiter shared by all senders of one kind of traffic.
+
+    Tokens are refilled continuously at `rate` per second up to
+    `capacity`. `pause` stops handing out tokens for everyone, which is
+    how a `RetryAfter` from Telegram is honored.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None) -> None:
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for `seconds`
+
+        Args:
+            seconds (float)
+        """
+        self._paused_until = max(
+            self._paused_until, time.monotonic() + seconds
+        )
+        self._tokens = 0
+
+    async def acquire(self) -> None:
+        """Wait until a token is available and take it"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    self._updated_at = time.monotonic()
+                    continue
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._updated_at) * self.rate,
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class SlidingWindow:
+    """Allows at most `limit` hits per key in any `window` seconds.
+
+    Keeps the times of accepted hits of every key, rejected hits aren't
+    recorded. Keys idle for the longest time are forgotten when there are
+    more than `maxsize` of them.
+    """
+
+    def __init__(self, limit: int, window: float, maxsize: int = 100000):
+        self.limit = limit
+        self.window = window
+        self.maxsize = maxsize
+        self._hits = OrderedDict()
+
+    async def hit(self, key) -> float:
+        """Record a hit of `key` if the limit allows it
+
+        Args:
+            key: Limited entity, e.g. user id
+
+        Returns:
+            float: 0 if the hit is accepted, otherwise seconds until it
+            would be
+        """
+        now = time.monotonic()
+        hits = self._hits.get(key)
+        if hits is None:
+            hits = self._hits[key] = deque(maxlen=self.limit)
+            while len(self._hits) > self.maxsize:
+                self._hits.popitem(last=False)
+        elif len(hits) == self.limit and now - hits[0] < self.window:
+            return hits[0] + self.window - now
+        hits.append(now)
+        self._hits.move_to_end(key)
+        return 0.0
+
+
+class RedisSlidingWindow:
+    """`SlidingWindow` kept in Redis, shared by all bot processes.
+
+    Hits of a key are stored in a sorted set scored by time, which expires
+    when the key is idle for `window` seconds.
+    """
+
+    # Returns a string, Redis truncates Lua numbers to integers
+    SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now - window)
+if redis.call("ZCARD", KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call("ZADD", KEYS[1], now, ARGV[4])
+    redis.call("PEXPIRE", KEYS[1], math.ceil(window * 1000))
+    return "0"
+end
+local oldest = redis.call("ZRANGE", KEYS[1], 0, 0, "WITHSCORES")
+return tostring(tonumber(oldest[2]) + window - now)
+"""
+
+    def __init__(self, url: str, prefix: str, limit: int, window: float):
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise RuntimeError(
+                "Shared rate limits require redis, install it with "
+                "`poetry install -E redis`"
+            )
+        self.prefix = prefix
+        self.limit = limit
+        self.window = window
+        self._redis = redis.asyncio.from_url(url)
+        self._script = self._redis.register_script(self.SCRIPT)
+
+    async def hit(self, key) -> float:
+        """Same as `SlidingWindow.hit`"""
+        # Wall clock, it's the only one shared between hosts
+        retry_after = await self._script(
+            keys=[f"{self.prefix}:{key}"],
+            args=[time.time(), self.window, self.limit, uuid.uuid4().hex],
+        )
+        return float(retry_after)
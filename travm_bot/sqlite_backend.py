@@ -0,0 +1,79 @@
+"""Embedded SQLite backend for single-node deployments
+
+Used when the db URL points to a SQLite file, e.g.
+`DB_URL=sqlite:////var/lib/bot/bot.db`, so queries don't leave the
+process.
+
+- The journal is in WAL mode, readers don't block the writer and the
+  writer doesn't block readers.
+- All writes go through one connection. Db threads wait for it in the
+  pool instead of failing with "database is locked" when two of them
+  upgrade their transactions to writes at the same time.
+- SELECTs outside of writing transactions use a pool of read-only
+  connections.
+"""
+
+import functools
+import os
+
+from sqlalchemy import Engine, create_engine, event
+from sqlalchemy.engine import URL
+
+# NORMAL doesn't sync every commit in WAL mode, a power loss may lose
+# the last transactions but never corrupts the db
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+# Bytes of the db file read through mmap
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+# Page cache of every connection, negative is in KiB
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", -64 * 1024))
+# Milliseconds to wait for a lock held by another process, e.g. migrations
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000))
+# Read-only connections, 0 to read through the writer connection too
+SQLITE_READERS = int(os.getenv("SQLITE_READERS", 8))
+
+
+def is_file_db(url: URL) -> bool:
+    """Check whether `url` is a SQLite db other connections can open"""
+    if url.get_backend_name() != "sqlite":
+        return False
+    database = url.database or ""
+    return database not in ("", ":memory:") and "mode=memory" not in database
+
+
+def _set_pragmas(dbapi_connection, connection_record, read_only: bool):
+    cursor = dbapi_connection.cursor()
+    try:
+        if not read_only:
+            # Persistent in the db file, switching needs a write lock
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+    finally:
+        cursor.close()
+
+
+def create_engines(url: URL) -> tuple[Engine, Engine]:
+    """Create engines of the single writer and of the readers
+
+    Returns:
+        tuple[Engine, Engine]: Writer and reader engines
+    """
+    writer = create_engine(url, echo=False, pool_size=1, max_overflow=0)
+    event.listen(
+        writer, "connect", functools.partial(_set_pragmas, read_only=False)
+    )
+    # The writer switches the db to WAL before any reader opens it
+    writer.connect().close()
+    if SQLITE_READERS <= 0:
+        return writer, writer
+    reader = create_engine(
+        url, echo=False, pool_size=SQLITE_READERS, max_overflow=0
+    )
+    event.listen(
+        reader, "connect", functools.partial(_set_pragmas, read_only=True)
+    )
+    return writer, reader
@@ -0,0 +1,17 @@
+"""Environment shared by the tests
+
+Imported by every test module before the modules of the bot, which read
+their settings on import. The db is a temporary SQLite file.
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp = tempfile.TemporaryDirectory()
+os.environ["DB_URL"] = f"sqlite:///{_tmp.name}/test.db"
+os.environ["ADMIN_IDS"] = "1"
+os.environ["BROADCAST_RETRY_DELAY"] = "0"
+os.environ["BROADCAST_UNSENT_DELAY"] = "0"
@@ -0,0 +1,87 @@
+"""Write-behind buffer of block statuses"""
+
+import unittest
+from unittest import mock
+
+# Sets up the environment, before modules of the bot are imported
+import support  # noqa: F401
+
+from sqlalchemy import delete, insert, select
+
+import async_db as adb
+import block_buffer
+import db
+import migrations
+from models import User
+
+USERS = list(range(100, 110))
+
+
+def _seed() -> None:
+    engine = db.init()
+    migrations.upgrade(engine)
+    with engine.begin() as connection:
+        connection.execute(delete(User))
+        connection.execute(
+            insert(User),
+            [
+                {"tg_id": tg_id, "is_admin": False, "is_blocked": False}
+                for tg_id in USERS
+            ],
+        )
+    db.user_cache.clear()
+
+
+def _blocked() -> set[int]:
+    with db.init().connect() as connection:
+        return set(
+            connection.scalars(select(User.tg_id).where(User.is_blocked))
+        )
+
+
+class BlockStatusBufferTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        await adb.run(_seed)
+        self.buffer = block_buffer.BlockStatusBuffer(
+            max_size=3, flush_interval=3600
+        )
+        await self.buffer.start()
+
+    async def asyncTearDown(self) -> None:
+        await self.buffer.stop()
+
+    async def test_mark_updates_cache_right_away(self):
+        await adb.load_user(USERS[0])
+        self.buffer.mark(USERS[0], True)
+        self.assertTrue(db.user_cache.get(USERS[0]).is_blocked)
+        self.assertEqual(await adb.run(_blocked), set())
+
+    async def test_full_buffer_is_flushed(self):
+        for tg_id in USERS[:3]:
+            self.buffer.mark(tg_id, True)
+        self.assertEqual(len(self.buffer._flushes), 1)
+        await next(iter(self.buffer._flushes))
+        self.assertEqual(await adb.run(_blocked), set(USERS[:3]))
+        self.assertEqual(self.buffer._flushes, set())
+
+    async def test_stop_flushes_pending_changes(self):
+        self.buffer.mark(USERS[0], True)
+        self.buffer.mark(USERS[1], True)
+        # The latest change of a user wins
+        self.buffer.mark(USERS[1], False)
+        await self.buffer.stop()
+        self.assertEqual(await adb.run(_blocked), {USERS[0]})
+
+    async def test_failed_flush_keeps_changes(self):
+        self.buffer.mark(USERS[0], True)
+        with mock.patch.object(
+            adb, "set_users_blocked", side_effect=RuntimeError("db is down")
+        ), self.assertLogs(level="ERROR"):
+            await self.buffer.flush()
+        self.assertEqual(await adb.run(_blocked), set())
+        await self.buffer.flush()
+        self.assertEqual(await adb.run(_blocked), {USERS[0]})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,209 @@
+"""Checkpoint and resume of broadcasts
+
+Run from the `travm_bot` directory:
+
+    python -m unittest discover -s tests
+
+Broadcasts run against a fake bot and the temporary SQLite db of
+`support`.
+"""
+
+import asyncio
+import collections
+import math
+import unittest
+
+# Sets up the environment, before modules of the bot are imported
+import support  # noqa: F401
+
+from sqlalchemy import delete, insert
+from telegram.error import NetworkError
+
+import async_db as adb
+import broadcast
+import db
+import migrations
+from models import BroadcastJob, BroadcastUnsent, User
+
+ADMIN_ID = 1
+RECIPIENTS = list(range(100, 140))
+
+
+class FakeMessage:
+    def __init__(self, message_id: int) -> None:
+        self.message_id = message_id
+
+
+class FakeBot:
+    """Records chats the post was copied to
+
+    Args:
+        fail (dict): Chat -> how many copies to it fail with a network
+            error, `math.inf` to fail all of them
+        hang_after (int | None): Copies after this many never complete
+    """
+
+    def __init__(self, fail=None, hang_after=None) -> None:
+        self.copies = []
+        self.fail = dict(fail or {})
+        self.hang_after = hang_after
+        self.hanging = asyncio.Event()
+
+    async def send_message(self, chat_id, *args, **kwargs):
+        return FakeMessage(1)
+
+    async def edit_message_text(self, *args, **kwargs):
+        pass
+
+    async def copy_message(self, chat_id, *args, **kwargs):
+        if self.hang_after is not None and (
+            len(self.copies) >= self.hang_after
+        ):
+            self.hanging.set()
+            await asyncio.Event().wait()
+        if self.fail.get(chat_id, 0) > 0:
+            self.fail[chat_id] -= 1
+            raise NetworkError("connection reset")
+        self.copies.append(chat_id)
+
+
+def _seed(blocked=()) -> None:
+    engine = db.init()
+    migrations.upgrade(engine)
+    with engine.begin() as connection:
+        connection.execute(delete(BroadcastUnsent))
+        connection.execute(delete(BroadcastJob))
+        connection.execute(delete(User))
+        connection.execute(
+            insert(User),
+            [
+                {
+                    "tg_id": tg_id,
+                    "is_admin": tg_id == ADMIN_ID,
+                    "is_blocked": tg_id in blocked,
+                }
+                for tg_id in [ADMIN_ID] + RECIPIENTS
+            ],
+        )
+
+
+def _load_job(job_id: int) -> BroadcastJob:
+    session = db.Session()
+    try:
+        return session.get(BroadcastJob, job_id)
+    finally:
+        db.Session.remove()
+
+
+class BroadcastResumeTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        await adb.run(_seed, {RECIPIENTS[0]})
+        post = {"type": "text", "text": "Hello", "button": None}
+        self.job = await adb.create_broadcast_job(ADMIN_ID, 1, post)
+
+    async def _run(self, bot: FakeBot) -> BroadcastJob:
+        job = await adb.run(_load_job, self.job.job_id)
+        await broadcast.Broadcast(
+            bot, job, concurrency=4, checkpoint_batch=5
+        ).run()
+        return await adb.run(_load_job, self.job.job_id)
+
+    async def test_resume_sends_everyone_after_cursor(self):
+        bot = FakeBot(hang_after=15)
+        job = await adb.run(_load_job, self.job.job_id)
+        task = asyncio.create_task(
+            broadcast.Broadcast(
+                bot, job, concurrency=4, checkpoint_batch=5
+            ).run()
+        )
+        await bot.hanging.wait()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+        job = await adb.run(_load_job, self.job.job_id)
+        cursor = job.cursor
+        self.assertEqual(job.status, BroadcastJob.RUNNING)
+        self.assertGreater(cursor, 0)
+        # Everybody up to the cursor got the post
+        self.assertLessEqual(
+            {tg_id for tg_id in RECIPIENTS[1:] if tg_id <= cursor},
+            set(bot.copies),
+        )
+
+        resumed = FakeBot()
+        job = await self._run(resumed)
+        self.assertEqual(job.status, BroadcastJob.FINISHED)
+        self.assertEqual(
+            sorted(resumed.copies),
+            [tg_id for tg_id in RECIPIENTS[1:] if tg_id > cursor],
+        )
+        self.assertEqual(job.blocked, 1)
+        self.assertEqual(job.sent, len(RECIPIENTS) - 1)
+
+    async def test_network_error_sends_everyone_once(self):
+        unlucky = RECIPIENTS[10]
+        # Every attempt of the first pass fails
+        bot = FakeBot(fail={unlucky: broadcast.BROADCAST_MAX_RETRIES})
+        job = await self._run(bot)
+        self.assertEqual(job.status, BroadcastJob.FINISHED)
+        self.assertEqual(
+            collections.Counter(bot.copies),
+            collections.Counter(RECIPIENTS[1:]),
+        )
+        self.assertEqual(job.sent, len(RECIPIENTS) - 1)
+        self.assertEqual(job.failed, 0)
+        self.assertEqual(await adb.get_broadcast_unsent_count(job.job_id), 0)
+
+    async def test_unsent_recipient_survives_resume(self):
+        unlucky = RECIPIENTS[3]
+        bot = FakeBot(
+            fail={unlucky: broadcast.BROADCAST_MAX_RETRIES}, hang_after=20
+        )
+        job = await adb.run(_load_job, self.job.job_id)
+        task = asyncio.create_task(
+            broadcast.Broadcast(
+                bot, job, concurrency=4, checkpoint_batch=5
+            ).run()
+        )
+        await bot.hanging.wait()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        job = await adb.run(_load_job, self.job.job_id)
+        self.assertGreater(job.cursor, unlucky)
+        self.assertEqual(await adb.get_broadcast_unsent_count(job.job_id), 1)
+
+        resumed = FakeBot()
+        job = await self._run(resumed)
+        self.assertEqual(job.status, BroadcastJob.FINISHED)
+        self.assertIn(unlucky, resumed.copies)
+        # Nobody got the post twice
+        self.assertEqual(sorted(bot.copies + resumed.copies), RECIPIENTS[1:])
+        self.assertEqual(job.sent, len(RECIPIENTS) - 1)
+
+    async def test_recipient_unsent_after_last_pass_fails(self):
+        unlucky = RECIPIENTS[10]
+        bot = FakeBot(fail={unlucky: math.inf})
+        job = await self._run(bot)
+        self.assertEqual(job.status, BroadcastJob.FINISHED)
+        self.assertNotIn(unlucky, bot.copies)
+        self.assertEqual(job.sent, len(RECIPIENTS) - 2)
+        self.assertEqual(job.failed, 1)
+        self.assertEqual(await adb.get_broadcast_unsent_count(job.job_id), 0)
+
+    async def test_blocked_users_counted_once(self):
+        # Interrupted before the cursor moved
+        bot = FakeBot(hang_after=0)
+        job = await adb.run(_load_job, self.job.job_id)
+        task = asyncio.create_task(broadcast.Broadcast(bot, job).run())
+        await bot.hanging.wait()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        self.assertEqual((await adb.run(_load_job, self.job.job_id)).cursor, 0)
+
+        job = await self._run(FakeBot())
+        self.assertEqual(job.blocked, 1)
+        self.assertEqual(job.sent, len(RECIPIENTS) - 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""Expiry and eviction of the user cache"""
+
+import unittest
+from unittest import mock
+
+# Sets up the environment, before modules of the bot are imported
+import support  # noqa: F401
+
+from cache import TTLCache
+
+
+class TTLCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.now = 1000.0
+        patcher = mock.patch("cache.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_entry_expires_after_ttl(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("user", 1)
+        self.now += 59
+        self.assertEqual(cache.get("user"), 1)
+        self.now += 2
+        self.assertIsNone(cache.get("user"))
+        # The expired entry is dropped on access
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "size": 0})
+
+    def test_set_restarts_ttl(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("user", 1)
+        self.now += 50
+        cache.set("user", 2)
+        self.now += 50
+        self.assertEqual(cache.get("user"), 2)
+
+    def test_replace_keeps_expiration(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("user", 1)
+        self.now += 50
+        cache.replace("user", lambda value: value + 1)
+        self.assertEqual(cache.get("user"), 2)
+        self.now += 11
+        self.assertIsNone(cache.get("user"))
+
+    def test_replace_of_missing_key_does_nothing(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.replace("user", lambda value: value + 1)
+        self.assertIsNone(cache.get("user"))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+"""Order of updates processed by `ChatOrderedApplication`"""
+
+import asyncio
+import unittest
+from unittest import mock
+
+# Sets up the environment, before modules of the bot are imported
+import support  # noqa: F401
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+
+from concurrency import ChatOrderedApplication
+
+CHAT_ID = 100
+USER = {"id": CHAT_ID, "is_bot": False, "first_name": "User"}
+CHAT = {"id": CHAT_ID, "type": "private"}
+
+
+class ChatOrderedApplicationTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.application = (
+            ApplicationBuilder()
+            .token("123:test")
+            .application_class(ChatOrderedApplication)
+            .concurrent_updates(16)
+            .build()
+        )
+        self.running = 0
+        self.most_running = 0
+        # Stands for the handlers, only the order of updates is checked
+        patcher = mock.patch.object(
+            ChatOrderedApplication, "_process_update", self._handle
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.update_ids = iter(range(1, 1000))
+
+    async def _handle(self, update) -> None:
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+
+    def _callback(self, message_id: int) -> Update:
+        update_id = next(self.update_ids)
+        return Update.de_json(
+            {
+                "update_id": update_id,
+                "callback_query": {
+                    "id": str(update_id),
+                    "from": USER,
+                    "chat_instance": "test",
+                    "data": "accept",
+                    "message": {
+                        "message_id": message_id,
+                        "date": 1700000000,
+                        "chat": CHAT,
+                    },
+                },
+            },
+            self.application.bot,
+        )
+
+    def _message(self) -> Update:
+        update_id = next(self.update_ids)
+        return Update.de_json(
+            {
+                "update_id": update_id,
+                "message": {
+                    "message_id": update_id,
+                    "date": 1700000000,
+                    "chat": CHAT,
+                    "from": USER,
+                    "text": "Hello",
+                },
+            },
+            self.application.bot,
+        )
+
+    async def _process(self, updates: list[Update]) -> None:
+        await asyncio.gather(
+            *(self.application.process_update(update) for update in updates)
+        )
+
+    async def test_callbacks_of_different_messages_run_concurrently(self):
+        await self._process([self._callback(i) for i in range(1, 5)])
+        self.assertEqual(self.most_running, 4)
+        self.assertEqual(self.application.chat_queue_depths(), {})
+
+    async def test_callbacks_of_one_message_run_in_order(self):
+        await self._process([self._callback(1) for _ in range(4)])
+        self.assertEqual(self.most_running, 1)
+
+    async def test_messages_of_one_chat_run_in_order(self):
+        await self._process([self._message() for _ in range(4)])
+        self.assertEqual(self.most_running, 1)
+
+    def test_queue_depths_are_summed_per_chat(self):
+        lock = asyncio.Lock()
+        self.application._chats.update(
+            {CHAT_ID: [lock, 1], (CHAT_ID, 1): [lock, 2], (200, 1): [lock, 1]}
+        )
+        self.assertEqual(
+            self.application.chat_queue_depths(), {CHAT_ID: 3, 200: 1}
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+"""Near-duplicate index of pending questions"""
+
+import unittest
+from unittest import mock
+
+# Sets up the environment, before modules of the bot are imported
+import support  # noqa: F401
+
+import duplicates
+from duplicates import BAND_BITS, DuplicateIndex, media_key, simhash
+
+
+def _bits(*positions: int) -> int:
+    return sum(1 << position for position in positions)
+
+
+class SimhashTest(unittest.TestCase):
+    def test_case_punctuation_and_spacing_are_ignored(self):
+        self.assertEqual(
+            simhash("Когда будет ответ?"),
+            simhash("  когда   будет ОТВЕТ!!! "),
+        )
+        self.assertEqual(simhash("ёлка"), simhash("елка"))
+
+    def test_similar_texts_are_close(self):
+        first = simhash(
+            "Когда откроется запись на летнюю практику в этом году"
+        )
+        second = simhash(
+            "Когда откроется запись на летнюю практику в том году"
+        )
+        other = simhash("Где найти расписание экзаменов для первого курса")
+        self.assertLess(
+            (first ^ second).bit_count(), (first ^ other).bit_count()
+        )
+
+    def test_texts_without_words_must_match_exactly(self):
+        self.assertEqual(simhash("🙂🙂"), simhash(" 🙂🙂 "))
+        self.assertNotEqual(simhash("🙂🙂"), simhash("🙂"))
+
+
+class DuplicateIndexTest(unittest.TestCase):
+    def setUp(self) -> None:
+        # Text of a question is its hash, so distances are exact
+        patcher = mock.patch.object(duplicates, "simhash", int)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.index = DuplicateIndex(max_distance=3)
+        self.original = _bits(1, 20, 40, 60)
+        self.index.add(1, str(self.original), None)
+
+    def _find(self, text_hash: int, key=None):
+        return self.index.find(str(text_hash), key)
+
+    def test_distance_threshold(self):
+        self.assertEqual(self._find(self.original), 1)
+        self.assertEqual(self._find(self.original ^ _bits(2, 3, 4)), 1)
+        self.assertIsNone(self._find(self.original ^ _bits(2, 3, 4, 5)))
+
+    def test_differences_in_several_bands(self):
+        # Three bands differ, the fourth one finds the candidate
+        changed = _bits(0, BAND_BITS, 2 * BAND_BITS)
+        self.assertEqual(self._find(self.original ^ changed), 1)
+        # Every band differs, more bits than the threshold anyway
+        changed |= _bits(3 * BAND_BITS)
+        self.assertIsNone(self._find(self.original ^ changed))
+
+    def test_files_must_match(self):
+        self.index.add(2, str(self.original), "photo-a")
+        self.assertEqual(self._find(self.original, "photo-a"), 2)
+        self.assertIsNone(self._find(self.original, "photo-b"))
+
+    def test_question_without_text_matches_by_files(self):
+        self.index.add(2, None, "photo-a")
+        self.assertEqual(self.index.find(None, "photo-a"), 2)
+        self.assertIsNone(self.index.find(None, None))
+
+    def test_removed_question_is_not_found(self):
+        self.index.remove(1)
+        self.assertIsNone(self._find(self.original))
+        self.assertEqual(len(self.index), 0)
+        # Removing twice is fine
+        self.index.remove(1)
+
+    def test_disabled_index(self):
+        index = DuplicateIndex(max_distance=-1)
+        index.add(1, str(self.original), None)
+        self.assertIsNone(index.find(str(self.original), None))
+
+
+class MediaKeyTest(unittest.TestCase):
+    def test_keys(self):
+        self.assertIsNone(media_key(None, None))
+        self.assertEqual(media_key("photo", "a"), "a")
+        self.assertEqual(media_key("album", None, ["a", "b"]), "a,b")
+
+
+if __name__ == "__main__":
+    unittest.main()
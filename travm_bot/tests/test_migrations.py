@@ -0,0 +1,126 @@
+"""Versioned schema migrations"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+# Sets up the environment, before modules of the bot are imported
+import support  # noqa: F401
+
+from sqlalchemy import create_engine, inspect, text
+
+import migrations
+
+ALL = [(version, name) for version, name, _ in sorted(migrations.MIGRATIONS)]
+
+# Tables of the bot before migrations, created on import back then
+OLD_SCHEMA = [
+    """CREATE TABLE users (
+        tg_id BIGINT PRIMARY KEY,
+        fullname VARCHAR(130),
+        username VARCHAR(35),
+        first_start DATETIME,
+        is_admin BOOLEAN,
+        is_blocked BOOLEAN
+    )""",
+    """CREATE TABLE questions (
+        question_id INTEGER PRIMARY KEY,
+        owner_id BIGINT REFERENCES users (tg_id),
+        attachment_path VARCHAR(255),
+        text VARCHAR(255)
+    )""",
+    "INSERT INTO users (tg_id, is_admin, is_blocked) VALUES (5, 0, 0)",
+    """INSERT INTO questions (owner_id, attachment_path, text) VALUES
+        (5, 'https://api.telegram.org/file/bot123:ABC/photos/1.jpg', 'a'),
+        (5, NULL, 'b')""",
+]
+
+
+class MigrationsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.engine = create_engine(
+            f"sqlite:///{os.path.join(tmp.name, 'migrations.db')}"
+        )
+        self.addCleanup(self.engine.dispose)
+
+    def test_fresh_db(self):
+        self.assertEqual(migrations.pending(self.engine), ALL)
+        with self.assertLogs(level="INFO"):
+            self.assertEqual(migrations.upgrade(self.engine), ALL)
+        self.assertEqual(migrations.pending(self.engine), [])
+        self.assertEqual(migrations.upgrade(self.engine), [])
+        self.assertEqual(
+            sorted(migrations.applied(self.engine)),
+            [version for version, _ in ALL],
+        )
+
+    def test_old_schema_is_upgraded(self):
+        with self.engine.begin() as connection:
+            for statement in OLD_SCHEMA:
+                connection.execute(text(statement))
+        with self.assertLogs(level="INFO"):
+            migrations.upgrade(self.engine)
+
+        inspector = inspect(self.engine)
+        users = {column["name"] for column in inspector.get_columns("users")}
+        self.assertIn("last_seen", users)
+        questions = {
+            column["name"] for column in inspector.get_columns("questions")
+        }
+        self.assertLessEqual(
+            {"file_id", "media_type", "duplicates"}, questions
+        )
+        self.assertIn(
+            ["is_admin", "is_blocked", "tg_id"],
+            [
+                index["column_names"]
+                for index in inspector.get_indexes("users")
+            ],
+        )
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                text(
+                    "SELECT text, attachment_path, file_id, media_type "
+                    "FROM questions ORDER BY text"
+                )
+            ).all()
+        # The expired download link with the bot token is dropped
+        self.assertEqual(
+            rows, [("a", None, None, "unavailable"), ("b", None, None, None)]
+        )
+
+    def test_failed_migration_is_not_recorded(self):
+        def broken(connection):
+            connection.execute(text("INSERT INTO counters VALUES ('x', 1)"))
+            raise RuntimeError("broken migration")
+
+        extra = migrations.MIGRATIONS + [(1000, "broken", broken)]
+        with mock.patch.object(migrations, "MIGRATIONS", extra):
+            with self.assertLogs(level="INFO"), self.assertRaises(
+                RuntimeError
+            ):
+                migrations.upgrade(self.engine)
+            # Migrations before it stay applied
+            self.assertEqual(
+                migrations.pending(self.engine), [(1000, "broken")]
+            )
+        with self.engine.connect() as connection:
+            self.assertEqual(
+                connection.scalar(text("SELECT COUNT(*) FROM counters")), 0
+            )
+
+    def test_bot_refuses_to_start_with_pending_migrations(self):
+        import main
+
+        with mock.patch.object(main.db, "init", return_value=self.engine):
+            with self.assertRaises(SystemExit) as raised:
+                main.main()
+        self.assertIn("python migrations.py", str(raised.exception))
+        self.assertIn(str(ALL[-1][0]), str(raised.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
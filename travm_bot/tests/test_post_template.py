@@ -0,0 +1,45 @@
+"""Broadcast post templates"""
+
+import unittest
+
+# Sets up the environment, before modules of the bot are imported
+import support  # noqa: F401
+
+from broadcast import PostTemplate
+
+
+class PostTemplateTest(unittest.TestCase):
+    def test_placeholders_are_replaced(self):
+        template = PostTemplate("Привет, {name}! Ваш ник: @{username}")
+        self.assertTrue(template.personalized)
+        self.assertEqual(
+            template.render("Иван", "ivan"), "Привет, Иван! Ваш ник: @ivan"
+        )
+
+    def test_values_are_escaped(self):
+        template = PostTemplate("<b>{name}</b>")
+        self.assertEqual(
+            template.render("<i>Tom & Jerry</i>", None),
+            "<b>&lt;i&gt;Tom &amp; Jerry&lt;/i&gt;</b>",
+        )
+
+    def test_missing_values(self):
+        template = PostTemplate("{name} {username}.")
+        self.assertEqual(template.render(), "Уважаемый пользователь .")
+
+    def test_double_braces_are_literal(self):
+        template = PostTemplate("{{name}} is {name}, {{}}")
+        self.assertEqual(template.render("Иван"), "{name} is Иван, {}")
+
+    def test_unknown_placeholders_are_kept(self):
+        template = PostTemplate("{unknown} {0} {name")
+        self.assertFalse(template.personalized)
+        self.assertEqual(template.render("Иван"), "{unknown} {0} {name")
+
+    def test_admin_html_is_kept(self):
+        text = '<a href="https://example.com/?a=1&b=2">ссылка</a>'
+        self.assertEqual(PostTemplate(text).render(), text)
+
+
+if __name__ == "__main__":
+    unittest.main()
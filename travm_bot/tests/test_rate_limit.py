@@ -0,0 +1,63 @@
+"""Sliding window limit of question intake"""
+
+import unittest
+from unittest import mock
+
+# Sets up the environment, before modules of the bot are imported
+import support  # noqa: F401
+
+from rate_limit import SlidingWindow
+
+
+class SlidingWindowTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.now = 1000.0
+        patcher = mock.patch("rate_limit.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_limit_within_window(self):
+        window = SlidingWindow(limit=3, window=60)
+        for _ in range(3):
+            self.assertEqual(await window.hit("user"), 0)
+            self.now += 10
+        # The first hit leaves the window 60s after it was made
+        self.assertEqual(await window.hit("user"), 30)
+
+    async def test_hits_leave_the_window(self):
+        window = SlidingWindow(limit=2, window=60)
+        await window.hit("user")
+        self.now += 30
+        await window.hit("user")
+        self.now += 30
+        self.assertEqual(await window.hit("user"), 0)
+        # The second hit is still in the window
+        self.assertEqual(await window.hit("user"), 30)
+
+    async def test_rejected_hits_are_not_recorded(self):
+        window = SlidingWindow(limit=1, window=60)
+        await window.hit("user")
+        for _ in range(5):
+            self.now += 10
+            self.assertGreater(await window.hit("user"), 0)
+        self.now += 10
+        self.assertEqual(await window.hit("user"), 0)
+
+    async def test_keys_are_limited_separately(self):
+        window = SlidingWindow(limit=1, window=60)
+        self.assertEqual(await window.hit("first"), 0)
+        self.assertEqual(await window.hit("second"), 0)
+        self.assertGreater(await window.hit("first"), 0)
+
+    async def test_idle_keys_are_forgotten(self):
+        window = SlidingWindow(limit=1, window=60, maxsize=2)
+        await window.hit("first")
+        await window.hit("second")
+        await window.hit("third")
+        # Forgetting a key only loses its limit
+        self.assertEqual(await window.hit("first"), 0)
+        self.assertGreater(await window.hit("third"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
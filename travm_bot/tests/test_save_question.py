@@ -0,0 +1,67 @@
+"""Questions that couldn't be saved aren't sent to moderators"""
+
+import unittest
+from unittest import mock
+
+# Sets up the environment, before modules of the bot are imported
+import support  # noqa: F401
+
+import bot
+import constants
+import db
+from models import Question
+
+
+class SaveQuestionTest(unittest.TestCase):
+    def test_db_error_is_raised(self):
+        question = Question(1, "Когда будет ответ?")
+        with mock.patch.object(
+            db, "_bump_counter", side_effect=RuntimeError("db is down")
+        ):
+            with self.assertRaises(RuntimeError):
+                db.save_question(question)
+        self.assertIsNone(db.duplicates.index.find(question.text, None))
+
+
+class SendTextTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        for patcher in (
+            mock.patch.object(
+                bot.flood, "allow", mock.AsyncMock(return_value=True)
+            ),
+            mock.patch.object(bot, "register_user", mock.AsyncMock()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.update = mock.MagicMock(edited_message=None)
+        self.update.effective_user.id = 100
+        self.update.message.text = "Когда будет ответ?"
+        self.update.message.reply_text = mock.AsyncMock()
+        self.context = mock.MagicMock()
+        self.context.bot.send_message = mock.AsyncMock()
+
+    async def test_question_is_not_forwarded_on_db_error(self):
+        with mock.patch.object(
+            bot.adb,
+            "save_question",
+            mock.AsyncMock(side_effect=RuntimeError("db is down")),
+        ), mock.patch.object(bot.digest, "enabled", return_value=False):
+            await bot.send_text(self.update, self.context)
+        self.context.bot.send_message.assert_not_called()
+        self.update.message.reply_text.assert_awaited_once_with(
+            constants.QUESTION_ERROR_TEXT
+        )
+
+    async def test_new_question_is_forwarded(self):
+        with mock.patch.object(
+            bot.adb, "save_question", mock.AsyncMock(return_value=None)
+        ), mock.patch.object(bot.digest, "enabled", return_value=False):
+            await bot.send_text(self.update, self.context)
+        self.context.bot.send_message.assert_awaited_once()
+        self.update.message.reply_text.assert_awaited_once_with(
+            constants.THANKS_FOR_QUESTION
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
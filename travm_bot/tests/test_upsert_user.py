@@ -0,0 +1,101 @@
+"""New user detection of the single-statement user upsert"""
+
+import datetime
+import unittest
+from unittest import mock
+
+# Sets up the environment, before modules of the bot are imported
+import support  # noqa: F401
+
+from sqlalchemy import delete
+from sqlalchemy.dialects import mysql, postgresql
+
+import db
+import migrations
+from models import User
+
+
+def _values(tg_id: int) -> tuple[dict, dict]:
+    now = datetime.datetime.now()
+    update = {
+        "fullname": "User",
+        "username": "user",
+        "is_admin": False,
+        "last_seen": now,
+    }
+    values = {
+        **update,
+        "tg_id": tg_id,
+        "first_start": now,
+        "is_blocked": False,
+    }
+    return values, update
+
+
+class FakeResult:
+    def __init__(self, rowcount=None, scalar=None) -> None:
+        self.rowcount = rowcount
+        self.scalar = scalar
+
+    def scalar_one(self):
+        return self.scalar
+
+
+class FakeSession:
+    """Records the statement instead of executing it"""
+
+    def __init__(self, result: FakeResult) -> None:
+        self.result = result
+        self.statement = None
+
+    def execute(self, statement):
+        self.statement = statement
+        return self.result
+
+
+class UpsertUserTest(unittest.TestCase):
+    def _upsert_with_dialect(self, dialect, result: FakeResult):
+        """Run `_upsert_user` as if the db were of `dialect`
+
+        Returns:
+            tuple[bool, str]: Result and the SQL of the statement
+        """
+        session = FakeSession(result)
+        engine = mock.Mock()
+        engine.dialect.name = dialect.dialect.name
+        with mock.patch.object(db, "engine", engine):
+            inserted = db._upsert_user(session, *_values(100))
+        sql = str(session.statement.compile(dialect=dialect.dialect()))
+        return inserted, sql
+
+    def test_sqlite(self):
+        migrations.upgrade(db.init())
+        session = db.Session()
+        try:
+            session.execute(delete(User))
+            self.assertTrue(db._upsert_user(session, *_values(100)))
+            self.assertFalse(db._upsert_user(session, *_values(100)))
+            self.assertTrue(db._upsert_user(session, *_values(101)))
+        finally:
+            session.rollback()
+            db.Session.remove()
+
+    def test_mysql(self):
+        inserted, sql = self._upsert_with_dialect(mysql, FakeResult(1))
+        self.assertTrue(inserted)
+        self.assertIn("ON DUPLICATE KEY UPDATE", sql)
+        inserted, _ = self._upsert_with_dialect(mysql, FakeResult(2))
+        self.assertFalse(inserted)
+
+    def test_postgresql(self):
+        for new in (True, False):
+            inserted, sql = self._upsert_with_dialect(
+                postgresql, FakeResult(scalar=new)
+            )
+            self.assertIs(inserted, new)
+        self.assertIn("ON CONFLICT (tg_id) DO UPDATE", sql)
+        self.assertTrue(sql.endswith("RETURNING xmax = 0"))
+
+
+if __name__ == "__main__":
+    unittest.main()
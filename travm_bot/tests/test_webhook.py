@@ -0,0 +1,114 @@
+"""Webhook endpoint fed with updates over ASGI"""
+
+import json
+import unittest
+from unittest import mock
+
+# Sets up the environment, before modules of the bot are imported
+import support  # noqa: F401
+
+from telegram.ext import ApplicationBuilder
+
+import webhook
+
+SECRET = "secret"
+UPDATE = {
+    "update_id": 42,
+    "message": {
+        "message_id": 1,
+        "date": 1700000000,
+        "chat": {"id": 100, "type": "private"},
+        "from": {"id": 100, "is_bot": False, "first_name": "User"},
+        "text": "Hello",
+    },
+}
+
+
+class WebhookAppTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.application = ApplicationBuilder().token("123:test").build()
+        self.app = webhook.WebhookApp(self.application, "/webhook", SECRET)
+
+    async def _post(
+        self, body, path="/webhook", method="POST", secret=SECRET
+    ) -> int:
+        """Make a request to the app
+
+        Returns:
+            int: Status of the response
+        """
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        headers = []
+        if secret is not None:
+            headers.append(
+                (b"x-telegram-bot-api-secret-token", secret.encode())
+            )
+        scope = {
+            "type": "http",
+            "path": path,
+            "method": method,
+            "headers": headers,
+        }
+        chunks = [body[:10], body[10:]]
+
+        async def receive():
+            body = chunks.pop(0)
+            return {
+                "type": "http.request",
+                "body": body,
+                "more_body": bool(chunks),
+            }
+
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        await self.app(scope, receive, send)
+        return messages[0]["status"]
+
+    async def test_update_is_queued(self):
+        self.assertEqual(await self._post(UPDATE), 200)
+        update = self.application.update_queue.get_nowait()
+        self.assertEqual(update.update_id, 42)
+        self.assertEqual(update.message.text, "Hello")
+
+    async def test_wrong_secret_is_rejected(self):
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(await self._post(UPDATE, secret="wrong"), 403)
+            self.assertEqual(await self._post(UPDATE, secret=None), 403)
+        self.assertTrue(self.application.update_queue.empty())
+
+    async def test_malformed_body_is_rejected(self):
+        bodies = [
+            b"not json",
+            [UPDATE],
+            "update",
+            {},
+            {"update_id": 1, "message": "Hello"},
+        ]
+        with self.assertLogs(level="ERROR"):
+            for body in bodies:
+                with self.subTest(body=body):
+                    self.assertEqual(await self._post(body), 400)
+        self.assertTrue(self.application.update_queue.empty())
+
+    async def test_too_large_body_is_rejected(self):
+        body = b" " * (webhook.WEBHOOK_MAX_BODY_SIZE + 1)
+        self.assertEqual(await self._post(body), 413)
+
+    async def test_other_paths_and_methods(self):
+        self.assertEqual(await self._post(UPDATE, path="/other"), 404)
+        self.assertEqual(await self._post(UPDATE, method="GET"), 405)
+
+    async def test_public_webhook_requires_secret(self):
+        with mock.patch.object(
+            webhook, "WEBHOOK_URL", "https://example.com"
+        ), mock.patch.object(webhook, "WEBHOOK_SECRET", ""):
+            with self.assertRaisesRegex(RuntimeError, "WEBHOOK_SECRET"):
+                await webhook.run_webhook(self.application)
+
+
+if __name__ == "__main__":
+    unittest.main()
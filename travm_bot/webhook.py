@@ -0,0 +1,153 @@
+import asyncio
+import hmac
+import json
+import os
+
+from telegram import Update
+from telegram.ext import Application
+
+import custom_logging as cl
+
+logger = cl.logger
+
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_BODY_SIZE = 1024 * 1024
+
+
+class WebhookApp:
+    """ASGI app that receives updates from Telegram
+
+    An update is acknowledged as soon as it is put into the update queue
+    of the application, it is processed after the response is sent.
+    """
+
+    def __init__(
+        self, application: Application, path: str, secret_token: str | None
+    ) -> None:
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            return
+        if scope["path"] != self.path:
+            await _respond(send, 404)
+        elif scope["method"] != "POST":
+            await _respond(send, 405)
+        elif not self._check_secret(scope):
+            logger.warning("Webhook request with wrong secret token")
+            await _respond(send, 403)
+        else:
+            await self._receive_update(receive, send)
+
+    def _check_secret(self, scope) -> bool:
+        if not self.secret_token:
+            return True
+        token = dict(scope["headers"]).get(
+            b"x-telegram-bot-api-secret-token", b""
+        )
+        return hmac.compare_digest(token, self.secret_token.encode())
+
+    async def _receive_update(self, receive, send) -> None:
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if len(body) > WEBHOOK_MAX_BODY_SIZE:
+                await _respond(send, 413)
+                return
+            if not message.get("more_body"):
+                break
+        try:
+            data = json.loads(body)
+            if not isinstance(data, dict):
+                raise ValueError("update is not an object")
+            # Nested values of wrong types raise AttributeError
+            update = Update.de_json(data, self.application.bot)
+            if update is None:
+                raise ValueError("update is empty")
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.error(f"Failed to parse webhook update: {e}")
+            await _respond(send, 400)
+            return
+        await self.application.update_queue.put(update)
+        await _respond(send, 200)
+
+
+async def _respond(send, status: int, body: bytes = b"") -> None:
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-length", str(len(body)).encode())],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def run_webhook(application: Application) -> None:
+    """Serve updates with an embedded ASGI server until stopped
+
+    The application lifecycle mirrors `Application.run_polling`. The
+    webhook is registered in Telegram only if `WEBHOOK_URL` is set, so
+    the server can also be fed with recorded updates locally. A public
+    webhook must have `WEBHOOK_SECRET`.
+    """
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        # Anyone could post forged updates to a public endpoint
+        raise RuntimeError(
+            "WEBHOOK_SECRET is required when the webhook is registered "
+            "with WEBHOOK_URL"
+        )
+    try:
+        import uvicorn
+    except ImportError:
+        raise RuntimeError(
+            "Webhook mode requires uvicorn, install it with "
+            "`poetry install -E webhook`"
+        )
+
+    server = uvicorn.Server(
+        uvicorn.Config(
+            WebhookApp(application, WEBHOOK_PATH, WEBHOOK_SECRET),
+            host=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            lifespan="off",
+            access_log=False,
+        )
+    )
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                allowed_updates=Update.ALL_TYPES,
+                secret_token=WEBHOOK_SECRET or None,
+            )
+        await application.start()
+        logger.info(
+            f"Serving webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}"
+            f"{WEBHOOK_PATH}"
+        )
+        await server.serve()
+    finally:
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run(application: Application) -> None:
+    """Blocking counterpart of `run_webhook`, like `run_polling`"""
+    try:
+        asyncio.run(run_webhook(application))
+    except (KeyboardInterrupt, SystemExit):
+        pass